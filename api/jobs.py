@@ -0,0 +1,419 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+from api.models import JobStatus
+
+
+def jobs_db_path() -> str:
+    return os.environ.get("JOBS_DB_PATH", os.path.join("data", "jobs.sqlite"))
+
+
+@dataclass
+class Job:
+    id: str
+    status: JobStatus
+    payload: dict
+    attempts: int
+    created_at: float
+    started_at: float | None = None
+    finished_at: float | None = None
+    error: str | None = None
+    cancel_requested_at: float | None = None
+    article_id: str | None = None
+
+
+@dataclass
+class Subscriber:
+    """A request waiting for the article of a job, to be sent to its callback URL."""
+
+    callback_url: str
+    custom_args: dict
+
+
+@dataclass
+class JobEvent:
+    id: int
+    type: str
+    data: dict
+    created_at: float
+
+
+class JobQueue:
+    """Durable job queue stored in a SQLite file.
+
+    The queue can be shared by several processes (the HTTP workers enqueue, the
+    generation workers claim). A claimed job is leased for `lease_seconds`: the
+    worker must renew the lease while it works on the job, otherwise the job is
+    considered abandoned (e.g. the worker was restarted) and is handed to another
+    worker.
+
+    A running job can't be stopped from another process: `request_cancel` flags
+    it, and the worker running it polls the flags with `cancel_requested`.
+
+    The progress events of the jobs (see `crew.events`) are stored alongside them,
+    so that the API can stream them whatever worker runs the job.
+
+    Identical requests share a job: `submit` attaches a request to the pending or
+    running job with the same fingerprint, and each of the job's subscribers gets
+    its own callback.
+    """
+
+    def __init__(self, path: str | None = None, lease_seconds: float = 120):
+        path = path or jobs_db_path()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.lease_seconds = lease_seconds
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    lease_expires_at REAL,
+                    error TEXT,
+                    cancel_requested_at REAL,
+                    fingerprint TEXT,
+                    article_id TEXT
+                )
+                """
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "cancel_requested_at" not in columns:
+                # Queues created before the cancellation of the jobs
+                conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested_at REAL")
+            if "fingerprint" not in columns:
+                # Queues created before the deduplication of the jobs
+                conn.execute("ALTER TABLE jobs ADD COLUMN fingerprint TEXT")
+            if "article_id" not in columns:
+                # Queues created before the result store
+                conn.execute("ALTER TABLE jobs ADD COLUMN article_id TEXT")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint, status)"
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS job_subscribers (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    callback_url TEXT NOT NULL,
+                    custom_args TEXT NOT NULL,
+                    idempotency_key TEXT UNIQUE,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS job_subscribers_job ON job_subscribers (job_id, id)"
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS job_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id, id)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # Autocommit mode, transactions are explicitly opened when needed
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _row_to_job(self, row) -> Job:
+        return Job(
+            id=row[0],
+            status=JobStatus(row[1]),
+            payload=json.loads(row[2]),
+            attempts=row[3],
+            created_at=row[4],
+            started_at=row[5],
+            finished_at=row[6],
+            error=row[7],
+            cancel_requested_at=row[8],
+            article_id=row[9],
+        )
+
+    def enqueue(self, payload: dict) -> str:
+        """Add a job to the queue and return its ID."""
+        job_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, status, payload, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, JobStatus.PENDING.value, json.dumps(payload), time.time()),
+            )
+        return job_id
+
+    def submit(
+        self,
+        payload: dict,
+        subscriber: Subscriber,
+        fingerprint: str | None = None,
+        idempotency_key: str | None = None,
+    ) -> tuple[str, bool]:
+        """Subscribe to the job of a request, enqueued if there is none yet.
+
+        A request with the `idempotency_key` of a previous request gets the job of
+        that request back, whatever its status, and isn't subscribed again.
+        Otherwise, the request is subscribed to the pending or running job with the
+        same `fingerprint`, if any, or to a new job.
+
+        Returns the ID of the job, and whether it was enqueued for this request.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = None
+                if idempotency_key is not None:
+                    row = conn.execute(
+                        "SELECT job_id FROM job_subscribers WHERE idempotency_key = ?",
+                        (idempotency_key,),
+                    ).fetchone()
+                if row is not None:
+                    conn.execute("COMMIT")
+                    return row[0], False
+
+                if fingerprint is not None:
+                    # A job being cancelled won't deliver its article
+                    row = conn.execute(
+                        """
+                        SELECT id FROM jobs
+                        WHERE fingerprint = ? AND status IN (?, ?) AND cancel_requested_at IS NULL
+                        ORDER BY created_at DESC
+                        LIMIT 1
+                        """,
+                        (
+                            fingerprint,
+                            JobStatus.PENDING.value,
+                            JobStatus.RUNNING.value,
+                        ),
+                    ).fetchone()
+
+                created = row is None
+                job_id = uuid.uuid4().hex if created else row[0]
+                if created:
+                    conn.execute(
+                        "INSERT INTO jobs (id, status, payload, created_at, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                        (
+                            job_id,
+                            JobStatus.PENDING.value,
+                            json.dumps(payload),
+                            now,
+                            fingerprint,
+                        ),
+                    )
+                conn.execute(
+                    "INSERT INTO job_subscribers (job_id, callback_url, custom_args, idempotency_key, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        job_id,
+                        subscriber.callback_url,
+                        json.dumps(subscriber.custom_args),
+                        idempotency_key,
+                        now,
+                    ),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        return job_id, created
+
+    def subscribers(self, job: Job) -> list[Subscriber]:
+        """Return the subscribers of a job, in the order they subscribed.
+
+        Jobs enqueued with `enqueue` have the callback URL and custom arguments of
+        their request in their payload instead.
+        """
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT callback_url, custom_args FROM job_subscribers WHERE job_id = ? ORDER BY id",
+                (job.id,),
+            ).fetchall()
+        if not rows and "callback_url" in job.payload:
+            return [
+                Subscriber(
+                    job.payload["callback_url"], job.payload.get("custom_args") or {}
+                )
+            ]
+        return [Subscriber(row[0], json.loads(row[1])) for row in rows]
+
+    def get(self, job_id: str) -> Job | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, status, payload, attempts, created_at, started_at, finished_at, error, cancel_requested_at, article_id FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def claim(self) -> Job | None:
+        """Lease the oldest pending (or abandoned) job, or return None if there is none."""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    """
+                    SELECT id FROM jobs
+                    WHERE status = ? OR (status = ? AND lease_expires_at < ?)
+                    ORDER BY created_at
+                    LIMIT 1
+                    """,
+                    (JobStatus.PENDING.value, JobStatus.RUNNING.value, now),
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+
+                conn.execute(
+                    """
+                    UPDATE jobs
+                    SET status = ?, attempts = attempts + 1, started_at = ?, lease_expires_at = ?
+                    WHERE id = ?
+                    """,
+                    (JobStatus.RUNNING.value, now, now + self.lease_seconds, row[0]),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        return self.get(row[0])
+
+    def renew(self, job_ids: list[str]) -> None:
+        """Extend the lease of jobs that are still being worked on."""
+        if not job_ids:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND status = ?",
+                [
+                    (time.time() + self.lease_seconds, job_id, JobStatus.RUNNING.value)
+                    for job_id in job_ids
+                ],
+            )
+
+    def _finish(
+        self,
+        job_id: str,
+        status: JobStatus,
+        error: str | None,
+        article_id: str | None = None,
+    ) -> None:
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, lease_expires_at = NULL, error = ?, article_id = ? WHERE id = ?",
+                (status.value, time.time(), error, article_id, job_id),
+            )
+
+    def complete(self, job_id: str, article_id: str | None = None) -> None:
+        """Mark a job as succeeded, with the ID of its article in the result store (see `crew.results`)."""
+        self._finish(job_id, JobStatus.SUCCEEDED, None, article_id)
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._finish(job_id, JobStatus.FAILED, error)
+
+    def cancel(self, job_id: str, error: str) -> None:
+        self._finish(job_id, JobStatus.CANCELLED, error)
+
+    def request_cancel(self, job_id: str) -> Job | None:
+        """Cancel a pending job right away, or ask the worker running it to stop.
+
+        Finished jobs are left unchanged. Returns the job as updated, or None if it
+        doesn't exist.
+        """
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, finished_at = ?, error = ?, cancel_requested_at = ? WHERE id = ? AND status = ?",
+                    (
+                        JobStatus.CANCELLED.value,
+                        now,
+                        "The article generation was cancelled.",
+                        now,
+                        job_id,
+                        JobStatus.PENDING.value,
+                    ),
+                )
+                conn.execute(
+                    "UPDATE jobs SET cancel_requested_at = ? WHERE id = ? AND status = ? AND cancel_requested_at IS NULL",
+                    (now, job_id, JobStatus.RUNNING.value),
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        return self.get(job_id)
+
+    def cancel_requested(self, job_ids: list[str]) -> list[str]:
+        """Return the IDs of the given jobs that were asked to stop."""
+        if not job_ids:
+            return []
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"SELECT id FROM jobs WHERE cancel_requested_at IS NOT NULL AND id IN ({', '.join('?' * len(job_ids))})",
+                job_ids,
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def add_events(self, job_id: str, events: list[tuple[str, dict]]) -> None:
+        """Store progress events of a job, as `(type, data)`."""
+        if not events:
+            return
+        now = time.time()
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT INTO job_events (job_id, type, data, created_at) VALUES (?, ?, ?, ?)",
+                [(job_id, type, json.dumps(data), now) for type, data in events],
+            )
+
+    def prune_events(self, max_age: float) -> int:
+        """Delete the events of the jobs finished more than `max_age` seconds ago, and return how many."""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM job_events WHERE job_id IN (SELECT id FROM jobs WHERE finished_at < ?)",
+                (time.time() - max_age,),
+            )
+        return cursor.rowcount
+
+    def get_events(
+        self, job_id: str, after_id: int = 0, limit: int = 500
+    ) -> list[JobEvent]:
+        """Return the events of a job following the event `after_id`, oldest first."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, type, data, created_at FROM job_events WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (job_id, after_id, limit),
+            ).fetchall()
+        return [JobEvent(row[0], row[1], json.loads(row[2]), row[3]) for row in rows]
@@ -1,16 +1,40 @@
-from fastapi import APIRouter, FastAPI, BackgroundTasks
+import asyncio
+import json
+from typing import AsyncIterator, Optional
+
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Response,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
+from api.jobs import Job, JobQueue, Subscriber
 from api.models import (
     ArticleGenerationRequest,
     ArticleGenerationStarted,
     ArticledGeneratedEvent,
+    CatalogCreate,
+    CatalogImport,
+    CatalogImportResult,
+    CatalogInfo,
+    ExistingArticle,
+    JobInfo,
+    JobStatus,
+    StoredArticle,
+    StoredArticleInfo,
 )
-import crew
-import requests
+from api.worker import request_fingerprint, send_callbacks
+from crew.catalog import get_article_catalog, read_csv, read_sitemap
+from crew.metrics import get_metrics_store
+from crew.results import MAX_LIMIT, get_result_store, results_max_age
 import logging
 
-from crew.ai_models import AIModel
-
 
 # Load environment variables
 load_dotenv()
@@ -19,40 +43,13 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# The generation itself is done by the workers of `api.worker`
+job_queue = JobQueue()
 
-# TODO : async this
-def generate_article_and_callback(
-    topic, language, context, callback_url, custom_args
-) -> None:
-    try:
-        logger.info(
-            f"Generating article for topic: {topic} in language: {language}.\nContext : {context}"
-        )
-        article = crew.generate_article(
-            llm=AIModel.CLAUDE_35_SONNET.to_client(),  # TODO : add choice
-            topic=topic,
-            language=language,
-            context=context,
-        )
-        response = requests.post(
-            callback_url,
-            json={
-                "article": article,
-                "custom_args": custom_args,
-            },
-        )
-        response.raise_for_status()
-        logger.info(f"Successfully posted article to {callback_url}")
-    except Exception as e:
-        error_message = str(e)
-        logger.error(f"Error generating article: {error_message}")
-        requests.post(
-            callback_url,
-            json={
-                "error": error_message,
-                "custom_args": custom_args,
-            },
-        )
+# The events are written by the workers in the job queue, and polled from there
+EVENTS_POLL_INTERVAL = 0.5
+# Comment sent when there is no event, so that proxies don't close the stream
+EVENTS_KEEP_ALIVE_INTERVAL = 15
 
 
 app = FastAPI(
@@ -74,26 +71,302 @@ def article_generated_notification(body: ArticledGeneratedEvent):
 @app.post(
     "/generate-article",
     response_model=ArticleGenerationStarted,
-    description="Triggers the generation of an article for a given topic, and sends the result to a callback URL.",
+    description=(
+        "Triggers the generation of an article for a given topic, and sends the result to a callback URL. "
+        "A request identical to one being generated (same topic, language, context and options, ignoring case "
+        "and whitespace) shares its job, and gets its own callback with its own custom_args. "
+        "A request retried with the same Idempotency-Key header gets the job of the first one back. "
+        "If an identical request was generated less than max_age seconds ago, its stored article is returned "
+        "right away (and sent to the callback URL) instead."
+    ),
     status_code=202,
     callbacks=generated_articles_callback_router.routes,
 )
 def generate_article(
     article_request: ArticleGenerationRequest,
     background_tasks: BackgroundTasks,
+    idempotency_key: Optional[str] = Header(None, max_length=255),
+):
+    if (
+        article_request.catalog_id is not None
+        and get_article_catalog().get(article_request.catalog_id) is None
+    ):
+        raise HTTPException(status_code=404, detail="Catalog not found")
+
+    payload = {
+        "topic": article_request.topic,
+        "language": article_request.language,
+        "context": article_request.context,
+        "catalog_id": article_request.catalog_id,
+        "priority": article_request.priority.value,
+        "timeout": article_request.timeout,
+        "model": article_request.model.value,
+        "fast_search": article_request.fast_search,
+        "stage_models": {
+            stage: model.value for stage, model in article_request.stage_models.items()
+        },
+    }
+    subscriber = Subscriber(
+        str(article_request.callback_url), article_request.custom_args or {}
+    )
+    fingerprint = request_fingerprint(**payload)
+
+    max_age = (
+        article_request.max_age
+        if article_request.max_age is not None
+        else results_max_age()
+    )
+    stored = get_result_store().latest(fingerprint, max_age) if max_age > 0 else None
+    if stored is not None:
+        logger.info(
+            f"Serving the stored article {stored.id} for topic: {article_request.topic}"
+        )
+        background_tasks.add_task(
+            send_callbacks,
+            [subscriber],
+            {"article": stored.article, "article_id": stored.id, "metrics": None},
+        )
+        return ArticleGenerationStarted(article_id=stored.id, article=stored.article)
+
+    job_id, created = job_queue.submit(
+        payload,
+        subscriber,
+        fingerprint=fingerprint,
+        idempotency_key=idempotency_key,
+    )
+    if created:
+        logger.info(
+            f"Queued article generation for topic: {article_request.topic} (job {job_id})"
+        )
+    else:
+        logger.info(
+            f"Article generation for topic: {article_request.topic} already in progress (job {job_id})"
+        )
+
+    return ArticleGenerationStarted(job_id=job_id, deduplicated=not created)
+
+
+@app.get(
+    "/jobs/{job_id}",
+    response_model=JobInfo,
+    description="Returns the status of an article generation job.",
+)
+def get_job(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job_info(job)
+
+
+def job_info(job: Job) -> JobInfo:
+    return JobInfo(
+        id=job.id,
+        status=job.status,
+        attempts=job.attempts,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+        error=job.error,
+        cancel_requested=job.cancel_requested_at is not None,
+        article_id=job.article_id,
+    )
+
+
+def send_cancellation_callback(job: Job) -> None:
+    send_callbacks(
+        job_queue.subscribers(job), {"error": job.error, "error_code": "cancelled"}
+    )
+
+
+@app.post(
+    "/jobs/{job_id}/cancel",
+    response_model=JobInfo,
+    description=(
+        "Cancels an article generation job. A pending job is cancelled right away, a running one is stopped "
+        "by its worker within a few seconds. Either way, an error is sent to the callback URL of each request "
+        "sharing the job. "
+        "Finished jobs are left unchanged."
+    ),
+)
+def cancel_job(job_id: str, background_tasks: BackgroundTasks):
+    previous = job_queue.get(job_id)
+    if previous is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    job = job_queue.request_cancel(job_id)
+    assert job is not None
+    if previous.status == JobStatus.PENDING and job.status == JobStatus.CANCELLED:
+        # No worker will pick the job up to send the callback
+        background_tasks.add_task(send_cancellation_callback, job)
+
+    return job_info(job)
+
+
+def format_sse(event: str, data: dict, id: int | None = None) -> str:
+    lines = [] if id is None else [f"id: {id}"]
+    lines += [f"event: {event}", f"data: {json.dumps(data)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+async def stream_job_events(job_id: str, after_id: int) -> AsyncIterator[str]:
+    last_sent = asyncio.get_running_loop().time()
+    while True:
+        # The status is read before the events, so that none is missed when the job finishes
+        job = await run_in_threadpool(job_queue.get, job_id)
+        events = await run_in_threadpool(job_queue.get_events, job_id, after_id)
+        for event in events:
+            yield format_sse(event.type, event.data, id=event.id)
+            after_id = event.id
+
+        if events:
+            last_sent = asyncio.get_running_loop().time()
+            continue
+        if job is None or job.status in (
+            JobStatus.SUCCEEDED,
+            JobStatus.FAILED,
+            JobStatus.CANCELLED,
+        ):
+            status = job.status.value if job else None
+            yield format_sse("end", {"status": status, "error": job and job.error})
+            return
+
+        if asyncio.get_running_loop().time() - last_sent >= EVENTS_KEEP_ALIVE_INTERVAL:
+            yield ": keep-alive\n\n"
+            last_sent = asyncio.get_running_loop().time()
+        await asyncio.sleep(EVENTS_POLL_INTERVAL)
+
+
+@app.get(
+    "/jobs/{job_id}/events",
+    response_class=StreamingResponse,
+    description=(
+        "Streams the progress of an article generation job as Server-Sent Events: "
+        '"stage_started", "stage_finished" (with the "output" of the stage), "stage_failed", '
+        '"tool_call" and "token" (chunks of the text being generated), then a final "end" event '
+        "with the status of the job. Reconnecting clients get the events following the Last-Event-ID header."
+    ),
+)
+def get_job_events(job_id: str, last_event_id: Optional[str] = Header(None)):
+    if job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    after_id = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+    return StreamingResponse(
+        stream_job_events(job_id, after_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get(
+    "/articles",
+    response_model=list[StoredArticleInfo],
+    description="Lists the generated articles matching all the given filters, the latest first.",
+)
+def list_articles(
+    topic: Optional[str] = Query(
+        None, description="Part of the topic, case insensitive."
+    ),
+    language: Optional[str] = None,
+    model: Optional[str] = None,
+    fingerprint: Optional[str] = None,
+    since: Optional[float] = Query(None, description="Unix timestamp."),
+    until: Optional[float] = Query(None, description="Unix timestamp."),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=MAX_LIMIT),
 ):
-    logger.info(f"Starting article generation for topic: {article_request.topic}")
-
-    background_tasks.add_task(
-        generate_article_and_callback,
-        topic=article_request.topic,
-        language=article_request.language,
-        context=article_request.context,
-        callback_url=article_request.callback_url,
-        custom_args=article_request.custom_args,
+    return get_result_store().search(
+        topic=topic,
+        language=language,
+        model=model,
+        fingerprint=fingerprint,
+        since=since,
+        until=until,
+        offset=offset,
+        limit=limit,
     )
 
-    return ArticleGenerationStarted()
+
+@app.get(
+    "/articles/{article_id}",
+    response_model=StoredArticle,
+    description="Returns a generated article.",
+)
+def get_article(article_id: str):
+    article = get_result_store().get(article_id)
+    if article is None:
+        raise HTTPException(status_code=404, detail="Article not found")
+    return article
+
+
+@app.post(
+    "/catalogs",
+    response_model=CatalogInfo,
+    status_code=201,
+    description="Creates a catalog of the existing articles of a blog, to reference in the article generation requests.",
+)
+def create_catalog(catalog: CatalogCreate):
+    catalog_id = get_article_catalog().create(catalog.name)
+    return get_article_catalog().get(catalog_id)
+
+
+@app.get("/catalogs/{catalog_id}", response_model=CatalogInfo)
+def get_catalog(catalog_id: str):
+    info = get_article_catalog().get(catalog_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="Catalog not found")
+    return info
+
+
+@app.delete("/catalogs/{catalog_id}", status_code=204)
+def delete_catalog(catalog_id: str):
+    get_article_catalog().delete(catalog_id)
+    return Response(status_code=204)
+
+
+@app.get("/catalogs/{catalog_id}/articles", response_model=list[ExistingArticle])
+def get_catalog_articles(catalog_id: str, offset: int = 0, limit: int = 100):
+    get_catalog(catalog_id)
+    return get_article_catalog().articles(catalog_id, offset=offset, limit=limit)
+
+
+@app.post(
+    "/catalogs/{catalog_id}/articles",
+    response_model=CatalogImportResult,
+    description=(
+        "Adds articles to a catalog, or updates those with the same URL, from a list, a CSV text and/or a sitemap. "
+        "The articles missing a summary get the description of their page, fetched in the background."
+    ),
+)
+def import_catalog_articles(
+    catalog_id: str, catalog_import: CatalogImport, background_tasks: BackgroundTasks
+):
+    get_catalog(catalog_id)
+
+    articles = [article.model_dump() for article in catalog_import.articles]
+    try:
+        if catalog_import.csv:
+            articles += read_csv(catalog_import.csv)
+        if catalog_import.sitemap_url:
+            articles += read_sitemap(str(catalog_import.sitemap_url))
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Invalid import: {e}")
+
+    added, updated = get_article_catalog().upsert(catalog_id, articles)
+    if catalog_import.fetch_details:
+        background_tasks.add_task(get_article_catalog().precompute, catalog_id)
+
+    return CatalogImportResult(added=added, updated=updated)
+
+
+@app.get(
+    "/metrics",
+    response_class=PlainTextResponse,
+    description="Metrics of the article generations, in the Prometheus text format.",
+)
+def get_metrics():
+    return get_metrics_store().render_prometheus()
 
 
 @app.get("/", include_in_schema=False)
@@ -1,8 +1,17 @@
-from pydantic import BaseModel, Field
-from typing import Optional, Dict
+from enum import Enum
+from pydantic import BaseModel, Field, field_validator
+from typing import Optional, Dict, List
 
 from pydantic import HttpUrl
 
+from crew.ai_models import AIModel
+from crew.routing import STAGES
+
+
+class GenerationPriority(str, Enum):
+    INTERACTIVE = "interactive"
+    BATCH = "batch"
+
 
 class ArticleGenerationRequest(BaseModel):
     topic: str = Field(
@@ -27,6 +36,50 @@ class ArticleGenerationRequest(BaseModel):
         description="Custom arguments that will be returned in the callback response.",
         examples=[{"requestId": "1234"}],
     )
+    catalog_id: Optional[str] = Field(
+        None,
+        description="ID of a catalog of existing articles (see POST /catalogs), to add links to the most relevant of them in the article.",
+        examples=["5f0c1e9ad2b84c43a1c1c0f4d1f9a6a2"],
+    )
+    priority: GenerationPriority = Field(
+        GenerationPriority.INTERACTIVE,
+        description="When the AI models' rate limits are reached, the calls of the interactive generations are served before those of the batch ones.",
+    )
+    timeout: Optional[float] = Field(
+        None,
+        description="Maximum duration of the generation in seconds, once started. Defaults to the GENERATION_TIMEOUT of the workers. A timed out generation sends an error to the callback URL.",
+        examples=[900],
+        gt=0,
+        le=3 * 3600,
+    )
+    model: AIModel = Field(
+        AIModel.CLAUDE_35_SONNET,
+        description="The main AI model, writing and revising the article. The other stages run on the fast model of the same provider, unless set in stage_models.",
+    )
+    stage_models: Dict[str, AIModel] = Field(
+        default_factory=dict,
+        description=f"AI models of some stages, by stage name. Stages are: {', '.join(STAGES)}. A stage whose output fails its validation is run again once with the main model, even if it already ran with it.",
+        examples=[{"evaluation": "claude-3-5-sonnet-20240620"}],
+    )
+
+    max_age: Optional[float] = Field(
+        None,
+        description="Return the stored article of an identical request generated at most this many seconds ago, instead of generating it again. 0 to always generate a new article. Defaults to the RESULTS_MAX_AGE of the API (24 hours).",
+        examples=[3600],
+        ge=0,
+    )
+    fast_search: bool = Field(
+        False,
+        description="Search the StackOverflow answers without an AI model, from queries made from the topic. Faster, but the queries aren't translated: better suited to topics in English.",
+    )
+
+    @field_validator("stage_models")
+    @classmethod
+    def check_stages(cls, stage_models: Dict[str, AIModel]) -> Dict[str, AIModel]:
+        unknown = set(stage_models) - set(STAGES)
+        if unknown:
+            raise ValueError(f"Unknown stages: {', '.join(sorted(unknown))}")
+        return stage_models
 
 
 class ArticledGeneratedEvent(BaseModel):
@@ -34,12 +87,160 @@ class ArticledGeneratedEvent(BaseModel):
         ...,
         description="The generated article in markdown format.",
     )
+    article_id: Optional[str] = Field(
+        None,
+        description="ID of the article in the store of the generated articles, see GET /articles/{article_id}.",
+    )
     custom_args: Optional[Dict] = Field(
         default_factory=dict,
         description="Custom arguments that were passed in the initial request.",
         examples=[{"requestId": "1234"}],
     )
+    metrics: Optional[Dict] = Field(
+        None,
+        description="Metrics of the generation: duration, LLM calls and tokens of each stage, tool calls, cache hits and HTTP retries.",
+        examples=[
+            {
+                "duration": 95.2,
+                "input_tokens": 48210,
+                "output_tokens": 6120,
+                "stages": {
+                    "search": {
+                        "duration": 12.4,
+                        "llm_calls": 3,
+                        "input_tokens": 4210,
+                        "output_tokens": 530,
+                    }
+                },
+                "tools": {
+                    "SearchStackOverflow": {"calls": 2, "errors": 0, "duration": 1.3}
+                },
+                "caches": {"search": {"hits": 1, "misses": 1}},
+                "http_retries": {},
+            }
+        ],
+    )
 
 
 class ArticleGenerationStarted(BaseModel):
     ok: bool = True
+    job_id: Optional[str] = Field(
+        None,
+        description="ID of the generation job, to follow its progress with GET /jobs/{job_id}. None if a stored article is returned.",
+    )
+    article_id: Optional[str] = Field(
+        None,
+        description="ID of the stored article of an identical request, returned instead of generating it again (see max_age).",
+    )
+    article: Optional[str] = Field(
+        None,
+        description="The stored article, in markdown format, if one is returned.",
+    )
+    deduplicated: bool = Field(
+        False,
+        description="Whether the request was attached to the job of an identical request already in progress, or of a request with the same Idempotency-Key.",
+    )
+
+
+class JobStatus(str, Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class JobInfo(BaseModel):
+    id: str
+    status: JobStatus
+    attempts: int = Field(
+        ...,
+        description="Number of times a worker picked up the job.",
+    )
+    created_at: float = Field(..., description="Unix timestamp.")
+    started_at: Optional[float] = Field(None, description="Unix timestamp.")
+    finished_at: Optional[float] = Field(None, description="Unix timestamp.")
+    error: Optional[str] = None
+    cancel_requested: bool = Field(
+        False,
+        description="Whether the job was asked to stop with POST /jobs/{job_id}/cancel.",
+    )
+    article_id: Optional[str] = Field(
+        None,
+        description="ID of the generated article, to get it with GET /articles/{article_id}.",
+    )
+
+
+class CatalogCreate(BaseModel):
+    name: str = Field(..., examples=["example.com blog"], min_length=1, max_length=200)
+
+
+class CatalogInfo(BaseModel):
+    id: str
+    name: str
+    created_at: float = Field(..., description="Unix timestamp.")
+    article_count: int
+    missing_summaries: int = Field(
+        ...,
+        description="Number of articles without a summary. The summaries are taken from the pages of the articles after an import, in the background.",
+    )
+
+
+class ExistingArticle(BaseModel):
+    url: str = Field(..., examples=["https://example.com/blog/rust-vs-python"])
+    title: Optional[str] = Field(
+        None,
+        description="Guessed from the URL if not given, until the page is fetched.",
+        examples=["Rust vs Python in 2024"],
+    )
+    summary: Optional[str] = Field(
+        None,
+        description="Taken from the description of the page if not given.",
+        examples=["A comparison of the performance and ecosystems of Rust and Python."],
+    )
+
+
+class CatalogImport(BaseModel):
+    articles: List[ExistingArticle] = Field(
+        default_factory=list, description="Articles to add or update, by URL."
+    )
+    csv: Optional[str] = Field(
+        None,
+        description="CSV text with a header, with an 'url' column and optionally 'title' and 'summary' columns.",
+        examples=["url,title\nhttps://example.com/blog/rust-vs-python,Rust vs Python"],
+    )
+    sitemap_url: Optional[HttpUrl] = Field(
+        None,
+        description="Sitemap (or sitemap index) listing the articles.",
+        examples=["https://example.com/sitemap.xml"],
+    )
+    fetch_details: bool = Field(
+        True,
+        description="Fetch the pages of the articles missing a summary (or a title) to take them from there, in the background.",
+    )
+
+
+class CatalogImportResult(BaseModel):
+    added: int
+    updated: int
+
+
+class StoredArticleInfo(BaseModel):
+    id: str
+    fingerprint: str = Field(
+        ...,
+        description="Hash of the parameters of the request, the same for identical requests.",
+    )
+    topic: str
+    language: str
+    model: str
+    title: str
+    created_at: float = Field(..., description="Unix timestamp.")
+
+
+class StoredArticle(StoredArticleInfo):
+    context: str
+    article: str = Field(..., description="The article in markdown format.")
+    metrics: Optional[Dict] = Field(
+        None, description="Metrics of the generation, as sent to the callback."
+    )
@@ -0,0 +1,472 @@
+"""Generation workers, running the jobs enqueued by the API and the Streamlit app.
+
+Run with `python -m api.worker` (the Streamlit app also runs a pool of its own). The number of concurrent generations is set by
+the GENERATION_WORKERS environment variable. Set LLM_CACHE=1 to cache the
+responses of the AI models.
+
+The progress events of the generations are stored in the job queue, to be
+streamed by `GET /jobs/{job_id}/events`.
+
+A generation is stopped when its job is cancelled (`POST /jobs/{job_id}/cancel`),
+or once it has run for the `timeout` of its request, GENERATION_TIMEOUT seconds
+by default (30 minutes). The callback then receives an error.
+
+A job can have several subscribers (identical requests, see `JobQueue.submit`):
+each of them receives the callback, with its own custom arguments.
+"""
+
+import logging
+import os
+import signal
+import threading
+import time
+
+from dotenv import load_dotenv
+
+import crew
+from api.jobs import Job, JobQueue, Subscriber
+from crew.ai_models import AIModel
+from crew.cache import get_llm_cache
+from crew.cancellation import CancelToken, RunCancelled, RunTimedOut
+from crew.catalog import get_article_catalog
+from crew.checkpoints import get_checkpoint_store
+from crew.http_client import get_http_client
+from crew.metrics import RunMetrics
+from crew.rate_limit import Priority, priority as call_priority
+from crew.crew import generation_fingerprint
+from crew.registry import get_llm_client
+from crew.results import get_result_store
+from crew.routing import get_stage_llm_clients
+
+logger = logging.getLogger(__name__)
+
+# Attempts are counted when a job is claimed, so a job abandoned this many times
+# (e.g. it keeps crashing its worker) is given up on.
+MAX_ATTEMPTS = 3
+
+# How often the cancellations of the running jobs are polled
+CANCELLATION_POLL_INTERVAL = 1.0
+
+# Tokens are streamed one by one, they are stored in chunks to spare the database
+TOKENS_FLUSH_INTERVAL = 0.5
+
+# How often the events of the old jobs are deleted
+EVENTS_PRUNE_INTERVAL = 60 * 60
+
+
+class JobEventRecorder:
+    """Listener storing the progress events of a job in the queue.
+
+    The tokens of each stage are merged into a single "token" event, written every
+    `TOKENS_FLUSH_INTERVAL` seconds or before the next other event of the stage.
+    Stages running concurrently stream their tokens at the same time, so they are
+    buffered separately.
+    """
+
+    def __init__(self, queue: JobQueue, job_id: str):
+        self.queue = queue
+        self.job_id = job_id
+        self._tokens: dict[str | None, list[str]] = {}
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _flush_tokens(self, stage: str | None = None) -> list[tuple[str, dict]]:
+        """Return the buffered tokens of `stage` as events, or those of all the stages."""
+        if stage is None:
+            self._last_flush = time.monotonic()
+            stages = list(self._tokens)
+        else:
+            stages = [stage] if stage in self._tokens else []
+        return [
+            ("token", {"stage": stage, "text": "".join(self._tokens.pop(stage))})
+            for stage in stages
+        ]
+
+    def __call__(self, type: str, data: dict) -> None:
+        with self._lock:
+            if type == "token":
+                self._tokens.setdefault(data.get("stage"), []).append(data["text"])
+                if time.monotonic() - self._last_flush < TOKENS_FLUSH_INTERVAL:
+                    return
+                events = self._flush_tokens()
+            else:
+                events = self._flush_tokens(data.get("stage")) + [(type, data)]
+            self.queue.add_events(self.job_id, events)
+
+    def flush(self) -> None:
+        with self._lock:
+            self.queue.add_events(self.job_id, self._flush_tokens())
+
+
+def generation_timeout() -> float:
+    return float(os.environ.get("GENERATION_TIMEOUT", 30 * 60))
+
+
+def job_events_retention() -> float:
+    """Seconds the progress events of a job are kept once it's finished."""
+    return float(os.environ.get("JOB_EVENTS_RETENTION", 7 * 24 * 60 * 60))
+
+
+def error_code(error: Exception) -> str:
+    if isinstance(error, RunTimedOut):
+        return "timeout"
+    if isinstance(error, RunCancelled):
+        return "cancelled"
+    return "error"
+
+
+def send_callbacks(subscribers: list[Subscriber], body: dict) -> None:
+    """Send `body` to the callback URL of each subscriber, with its custom arguments."""
+    for subscriber in subscribers:
+        # A subscriber failing to receive its callback doesn't deprive the others of theirs
+        try:
+            response = get_http_client().post(
+                subscriber.callback_url,
+                json={**body, "custom_args": subscriber.custom_args},
+            )
+            response.raise_for_status()
+            logger.info(f"Successfully posted to {subscriber.callback_url}")
+        except Exception:
+            logger.exception(f"Failed to post to {subscriber.callback_url}")
+
+
+def request_fingerprint(
+    topic,
+    language,
+    context,
+    model=AIModel.CLAUDE_35_SONNET.value,
+    catalog_id=None,
+    fast_search=False,
+    stage_models=None,
+    **_,
+) -> str:
+    """Fingerprint of the article requested by a job payload (see `generation_fingerprint`).
+
+    The other fields of the payload (priority, timeout...) don't change the article.
+    The current content of the catalog does, as it's given to the linking stage.
+    """
+    return generation_fingerprint(
+        topic,
+        language or "",
+        context or "",
+        model,
+        catalog_id=catalog_id,
+        catalog_version=get_article_catalog().version(catalog_id)
+        if catalog_id
+        else None,
+        fast_search=fast_search,
+        stage_models=stage_models,
+    )
+
+
+def generate_article_and_callback(
+    topic,
+    language,
+    context,
+    notify,
+    run_id=None,
+    on_event=None,
+    cancel_token=None,
+    catalog_id=None,
+    priority="interactive",
+    model=AIModel.CLAUDE_35_SONNET.value,
+    stage_models=None,
+    fast_search=False,
+) -> str | None:
+    """Generate an article and send it to `notify`.
+
+    Returns the ID of the article in the result store, or None if it couldn't be stored.
+    """
+    metrics = RunMetrics()
+    try:
+        logger.info(
+            f"Generating article for topic: {topic} in language: {language}.\nContext : {context}"
+        )
+        # Before the generation, to identify the article by the catalog it's given
+        fingerprint = request_fingerprint(
+            topic,
+            language,
+            context,
+            model=model,
+            catalog_id=catalog_id,
+            fast_search=fast_search,
+            stage_models=stage_models,
+        )
+        # Lets a job re-run after a failure reuse the completions of the first run
+        llm_cache = get_llm_cache() if os.environ.get("LLM_CACHE") else None
+        main_model = AIModel(model)
+        with call_priority(Priority[priority.upper()]):
+            article = crew.generate_article(
+                llm=get_llm_client(
+                    main_model, cache=llm_cache, streaming=on_event is not None
+                ),
+                stage_llms=get_stage_llm_clients(
+                    main_model,
+                    {
+                        stage: AIModel(stage_model)
+                        for stage, stage_model in (stage_models or {}).items()
+                    },
+                    cache=llm_cache,
+                    streaming=on_event is not None,
+                ),
+                topic=topic,
+                language=language,
+                context=context,
+                existing_articles=get_article_catalog().articles(catalog_id)
+                if catalog_id
+                else None,
+                run_id=run_id,
+                metrics=metrics,
+                on_event=on_event,
+                cancel_token=cancel_token,
+                fast_search=fast_search,
+            )
+    except Exception as e:
+        error_message = str(e)
+        logger.error(f"Error generating article: {error_message}")
+        notify(
+            {
+                "error": error_message,
+                "error_code": error_code(e),
+                "metrics": metrics.summary(),
+            }
+        )
+        raise
+
+    article_id = None
+    # Storing the article must not deprive the subscribers of it
+    try:
+        article_id = get_result_store().add(
+            fingerprint,
+            topic=topic,
+            language=language,
+            context=context,
+            model=model,
+            article=article,
+            metrics=metrics.summary(),
+        )
+    except Exception:
+        logger.exception("Failed to store the article")
+
+    notify({"article": article, "article_id": article_id, "metrics": metrics.summary()})
+    return article_id
+
+
+class JobNotifier:
+    """Sends the callback of a job to its subscribers.
+
+    Requests can subscribe to the job until it's finished, so `finish` must be
+    called once it is, to send the callback to the latecomers too.
+    """
+
+    def __init__(self, queue: JobQueue, job: Job):
+        self.queue = queue
+        self.job = job
+        self._body: dict | None = None
+        self._notified = 0
+
+    def _send(self) -> None:
+        subscribers = self.queue.subscribers(self.job)
+        send_callbacks(subscribers[self._notified :], self._body or {})
+        self._notified = len(subscribers)
+
+    def __call__(self, body: dict) -> None:
+        self._body = body
+        self._send()
+
+    def finish(self) -> None:
+        if self._body is not None:
+            self._send()
+
+
+class WorkerPool:
+    """Pool of threads that claim jobs from the queue and run them."""
+
+    def __init__(
+        self, queue: JobQueue, concurrency: int = 2, poll_interval: float = 1.0
+    ):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        self._threads: list[threading.Thread] = []
+        self._active: dict[str, CancelToken] = {}
+        self._active_lock = threading.Lock()
+
+    def start(self) -> None:
+        for i in range(self.concurrency):
+            thread = threading.Thread(
+                target=self._work, name=f"generation-worker-{i}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+        self._heartbeat_thread = threading.Thread(
+            target=self._heartbeat, name="generation-heartbeat", daemon=True
+        )
+        self._heartbeat_thread.start()
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Stop claiming jobs and wait for the running ones to finish."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._heartbeat_thread.join(timeout)
+
+    def _heartbeat(self) -> None:
+        """Renew the leases of the running jobs and stop the cancelled ones, until every worker has exited.
+
+        The events of the jobs finished for longer than `job_events_retention` are deleted too.
+        """
+        last_renewal = last_prune = 0.0
+        while any(thread.is_alive() for thread in self._threads):
+            with self._active_lock:
+                active = dict(self._active)
+
+            try:
+                for job_id in self.queue.cancel_requested(list(active)):
+                    active[job_id].cancel()
+            except Exception:
+                logger.exception("Failed to poll the job cancellations")
+
+            if time.monotonic() - last_renewal >= self.queue.lease_seconds / 3:
+                try:
+                    self.queue.renew(list(active))
+                except Exception:
+                    logger.exception("Failed to renew the job leases")
+                last_renewal = time.monotonic()
+
+            if time.monotonic() - last_prune >= EVENTS_PRUNE_INTERVAL:
+                try:
+                    pruned = self.queue.prune_events(job_events_retention())
+                    if pruned:
+                        logger.info(f"Deleted {pruned} events of old jobs")
+                except Exception:
+                    logger.exception("Failed to delete the events of old jobs")
+                last_prune = time.monotonic()
+            time.sleep(CANCELLATION_POLL_INTERVAL)
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim()
+            except Exception:
+                logger.exception("Failed to claim a job")
+                job = None
+
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+
+            payload = dict(job.payload)
+            # The deadline counts from the start of the attempt, not from the request
+            cancel_token = CancelToken(
+                timeout=payload.pop("timeout", None) or generation_timeout()
+            )
+            with self._active_lock:
+                self._active[job.id] = cancel_token
+            try:
+                self._run(job, payload, cancel_token)
+            finally:
+                with self._active_lock:
+                    self._active.pop(job.id, None)
+
+    def _run(self, job: Job, payload: dict, cancel_token: CancelToken) -> None:
+        # Sent to the subscribers of the job instead, see `JobNotifier`
+        payload.pop("callback_url", None)
+        payload.pop("custom_args", None)
+
+        notify = JobNotifier(self.queue, job)
+        try:
+            self._run_job(job, payload, cancel_token, notify)
+        finally:
+            notify.finish()
+
+    def _run_job(
+        self,
+        job: Job,
+        payload: dict,
+        cancel_token: CancelToken,
+        notify: JobNotifier,
+    ) -> None:
+        if job.cancel_requested_at is not None:
+            # Cancelled while a previous attempt was running, before a restart
+            error = "The article generation was cancelled."
+            try:
+                notify({"error": error, "error_code": "cancelled"})
+            finally:
+                self.queue.cancel(job.id, error)
+            self._delete_checkpoints(job.id)
+            return
+
+        if job.attempts > MAX_ATTEMPTS:
+            logger.error(f"Job {job.id} abandoned too many times, giving up")
+            error = f"Article generation failed after {MAX_ATTEMPTS} attempts."
+            try:
+                notify({"error": error, "error_code": "error"})
+            finally:
+                self.queue.fail(job.id, error)
+            self._delete_checkpoints(job.id)
+            return
+
+        logger.info(f"Starting job {job.id} (attempt {job.attempts})")
+        recorder = JobEventRecorder(self.queue, job.id)
+        try:
+            # A job picked up again after a restart resumes from its checkpoints
+            article_id = generate_article_and_callback(
+                **payload,
+                notify=notify,
+                run_id=job.id,
+                on_event=recorder,
+                cancel_token=cancel_token,
+            )
+        except RunCancelled as e:
+            recorder.flush()
+            if isinstance(e, RunTimedOut):
+                self.queue.fail(job.id, str(e))
+            else:
+                self.queue.cancel(job.id, str(e))
+        except Exception as e:
+            recorder.flush()
+            self.queue.fail(job.id, str(e))
+        else:
+            recorder.flush()
+            self.queue.complete(job.id, article_id)
+        self._delete_checkpoints(job.id)
+        logger.info(f"Finished job {job.id}")
+
+    def _delete_checkpoints(self, job_id: str) -> None:
+        """Delete the checkpoints of a finished job, which is never run again.
+
+        Only called once the job is marked as finished: an attempt interrupted
+        before (e.g. by a restart) is retried, and resumes from them.
+        """
+        try:
+            get_checkpoint_store().delete(job_id)
+        except Exception:
+            logger.exception(f"Failed to delete the checkpoints of job {job_id}")
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    concurrency = int(os.environ.get("GENERATION_WORKERS", 2))
+    pool = WorkerPool(JobQueue(), concurrency=concurrency)
+    pool.start()
+    logger.info(f"Started {concurrency} generation workers")
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        pass
+
+    logger.info("Stopping, waiting for the running jobs to finish...")
+    pool.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 # Layout inspired by :
 # https://github.com/tonykipkemboi/trip_planner_agent/blob/main/streamlit_app.py
 
+import os
+import time
+
 import streamlit as st
+from api.jobs import JobQueue
+from api.models import JobStatus
+from api.worker import WorkerPool
 from crew.ai_models import AIModel
-from crew.crew import generate_article
+from crew.catalog import get_article_catalog, read_sitemap
+from crew.results import get_result_store
+from crew.routing import STAGES
 import pandas as pd
 import lorem
 
@@ -26,59 +34,116 @@ def mock_article(
     return result
 
 
+# The existing articles are kept in this catalog, from one session to the next
+APP_CATALOG_ID = os.environ.get("APP_CATALOG_ID", "streamlit")
+
+
+def load_existing_articles() -> pd.DataFrame:
+    catalog = get_article_catalog()
+    catalog.create("Streamlit", catalog_id=APP_CATALOG_ID)
+    return pd.DataFrame(
+        catalog.articles(APP_CATALOG_ID), columns=["title", "url", "summary"]
+    )
+
+
 if "existing_articles" not in st.session_state:
-    # create empty dataframe with "title", "url" and "summary" columns
-    df = pd.DataFrame(columns=["title", "url", "summary"])
-    st.session_state["existing_articles"] = df
+    st.session_state["existing_articles"] = load_existing_articles()
 
 
-# From https://github.com/tonykipkemboi/trip_planner_agent/blob/main/trip_agents.py
-def streamlit_callback(step_output):
-    st.markdown("---")
-    for step in step_output:
-        if isinstance(step, tuple) and len(step) == 2:
-            action, observation = step
-            if (
-                isinstance(action, dict)
-                and "tool" in action
-                and "tool_input" in action
-                and "log" in action
-            ):
-                st.markdown("# Action")
-                st.markdown(f"**Tool:** {action['tool']}")
-                st.markdown(f"**Tool Input** {action['tool_input']}")
-                st.markdown(f"**Log:** {action['log']}")
-                st.markdown(f"**Action:** {action['Action']}")
-                st.markdown(f"**Action Input:** ```json\n{action['tool_input']}\n```")
-            elif isinstance(action, str):
-                st.markdown(f"**Action:** {action}")
-            else:
-                st.markdown(f"**Action:** {str(action)}")
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Return the job queue of the generations, with the workers running them.
 
-            st.markdown("**Observation**")
-            if isinstance(observation, str):
-                observation_lines = observation.split("\n")
-                for line in observation_lines:
-                    if line.startswith("Title: "):
-                        st.markdown(f"**Title:** {line[7:]}")
-                    elif line.startswith("Link: "):
-                        st.markdown(f"**Link:** {line[6:]}")
-                    elif line.startswith("Snippet: "):
-                        st.markdown(f"**Snippet:** {line[9:]}")
-                    elif line.startswith("Question title: "):
-                        st.markdown(f"**Question title:** {line[16:]}")
-                    elif line.startswith("Question link: "):
-                        st.markdown(f"**Question link:** {line[15:]}")
-                    elif line.startswith("Best answer URL: "):
-                        st.markdown(f"**Best answer URL:** {line[17:]}")
-                    elif line.startswith("-"):
-                        st.markdown(line)
-                    else:
-                        st.markdown(line)
-            else:
-                st.markdown(str(observation))
+    The queue and its workers are shared by all the sessions: a generation goes on
+    whatever happens to the page that started it, and is followed by its job ID.
+    With GENERATION_WORKERS=0, the jobs are left to `python -m api.worker`.
+    """
+    queue = JobQueue()
+    WorkerPool(queue, concurrency=int(os.environ.get("GENERATION_WORKERS", 2))).start()
+    return queue
+
+
+STAGE_LABELS = {
+    "search": "🔎 Recherche sur StackOverflow",
+    "report": "📄 Rapport des réponses",
+    "reliable_sources": "📚 Sources fiables",
+    "write": "✍️ Rédaction",
+    "evaluation": "🧐 Évaluation",
+    "revision": "🖋️ Relecture",
+    "internal_linking": "🔗 Maillage interne",
+}
+
+# How often the progress of a running generation is polled
+JOB_POLL_INTERVAL = 1.0
+
+
+# From https://github.com/tonykipkemboi/trip_planner_agent/blob/main/trip_agents.py
+def show_observation(observation: str):
+    for line in observation.split("\n"):
+        if line.startswith("Title: "):
+            st.markdown(f"**Title:** {line[7:]}")
+        elif line.startswith("Link: "):
+            st.markdown(f"**Link:** {line[6:]}")
+        elif line.startswith("Snippet: "):
+            st.markdown(f"**Snippet:** {line[9:]}")
+        elif line.startswith("Question title: "):
+            st.markdown(f"**Question title:** {line[16:]}")
+        elif line.startswith("Question link: "):
+            st.markdown(f"**Question link:** {line[15:]}")
+        elif line.startswith("Best answer URL: "):
+            st.markdown(f"**Best answer URL:** {line[17:]}")
         else:
-            st.markdown(step)
+            st.markdown(line)
+
+
+class JobProgress:
+    """Shows the progress events of a generation job (see `crew.events`), from the first one."""
+
+    def __init__(self, queue: JobQueue, job_id: str):
+        self.queue = queue
+        self.job_id = job_id
+        self._after_id = 0
+        # The text being generated, until its stage is finished
+        self._text = ""
+        self._text_placeholder = None
+
+    def update(self):
+        """Show the events stored since the last update."""
+        while events := self.queue.get_events(self.job_id, self._after_id):
+            for event in events:
+                self._show(event.type, event.data)
+            self._after_id = events[-1].id
+
+    def _show(self, type: str, data: dict):
+        if type == "token":
+            if self._text_placeholder is None:
+                self._text_placeholder = st.empty()
+            self._text += data["text"]
+            self._text_placeholder.markdown(self._text)
+            return
+
+        if self._text_placeholder is not None:
+            self._text_placeholder.empty()
+            self._text_placeholder = None
+            self._text = ""
+
+        stage = STAGE_LABELS.get(data.get("stage", ""), data.get("stage"))
+        if type == "stage_started":
+            st.markdown("---")
+            st.markdown(f"#### {stage}")
+        elif type == "tool_call":
+            st.markdown(f"**Tool:** {data['tool']}")
+            st.markdown(f"**Tool Input:** {data['input']}")
+            st.markdown("**Observation**")
+            show_observation(data["observation"])
+        elif type == "stage_fallback":
+            st.warning(f"Résultat invalide, l'étape est refaite : {data['reason']}")
+        elif type == "stage_finished":
+            # Expanders can't be nested in the status
+            with st.container(border=True):
+                st.markdown(data.get("output", ""))
+        elif type == "stage_failed":
+            st.error(data["error"])
 
 
 st.set_page_config(
@@ -143,8 +208,50 @@ def show_existing_articles():
 
     # TODO : check if modified
 
+    sitemap_url = st.text_input(
+        "Importer les articles d'un sitemap :",
+        placeholder="https://example.com/sitemap.xml",
+    )
+    if sitemap_url and st.button("🗺️ Importer"):
+        try:
+            articles = read_sitemap(sitemap_url)
+        except Exception as e:
+            st.error(f"Impossible de lire le sitemap : {e}")
+        else:
+            catalog = get_article_catalog()
+            added, _ = catalog.upsert(APP_CATALOG_ID, articles)
+            # The titles and summaries are taken from the pages, which can take a while
+            catalog.precompute_in_background(APP_CATALOG_ID)
+            st.session_state["existing_articles"] = load_existing_articles()
+            st.success(
+                f"{added} articles ajoutés ! Leurs résumés seront complétés dans quelques minutes."
+            )
+            st.rerun()
+
     if st.button("💾 Sauvegarder les modifications"):
-        st.session_state["existing_articles"] = edited_df
+        # Only the edits of the table are applied: the catalog is shared by all
+        # the sessions, which may have changed other articles since it was loaded
+        initial = {
+            article["url"]: article
+            for article in initial_df.fillna("").to_dict(orient="records")
+            if article["url"]
+        }
+        edited = {
+            article["url"]: article
+            for article in edited_df.fillna("").to_dict(orient="records")
+            if article["url"]
+        }
+        catalog = get_article_catalog()
+        catalog.upsert(
+            APP_CATALOG_ID,
+            [
+                article
+                for url, article in edited.items()
+                if initial.get(url) != article
+            ],
+        )
+        catalog.remove(APP_CATALOG_ID, [url for url in initial if url not in edited])
+        st.session_state["existing_articles"] = load_existing_articles()
         st.success("Modifications sauvegardées !")
         st.rerun()
 
@@ -152,6 +259,10 @@ def show_existing_articles():
         st.rerun()
 
 
+job_queue = get_job_queue()
+job = job_queue.get(st.query_params["job"]) if "job" in st.query_params else None
+generating = job is not None and job.status in (JobStatus.PENDING, JobStatus.RUNNING)
+
 st.subheader(
     "Les agents IA travaillent pour vous ✨",
     divider=True,
@@ -199,24 +310,13 @@ with st.sidebar:
         index=0,
         format_func=lambda x: x.value,
     )
+    fast_stages = st.checkbox(
+        "⚡ Modèle rapide pour la recherche et l'évaluation",
+        help="Seules la rédaction et la relecture utilisent le modèle choisi, les autres étapes le modèle rapide du même fournisseur. Une étape dont le résultat est invalide est refaite avec le modèle choisi.",
+        value=True,
+    )
 
-    submitted = st.button(":sparkles: Générer")  # TODO : disable if already generating
-
-
-def get_selected_articles() -> list[dict] | None:
-    if not make_internal_links:
-        print("Linkage disabled")
-        return None
-
-    # show number of articles
-    print(f"Number of articles selected : {len(st.session_state['existing_articles'])}")
-
-    articles = st.session_state["existing_articles"].to_dict(orient="records")
-    assert isinstance(articles, list)
-    assert all("title" in article for article in articles)
-    assert all("url" in article for article in articles)
-
-    return articles
+    submitted = st.button(":sparkles: Générer", disabled=generating)
 
 
 if submitted:
@@ -224,38 +324,62 @@ if submitted:
         st.error("Veuillez choisir un modèle d'IA.")
         st.stop()
 
+    payload = {
+        "topic": topic,
+        "language": language,
+        "context": context,
+        "catalog_id": APP_CATALOG_ID if make_internal_links else None,
+        "model": model.value,
+    }
+    if not fast_stages:
+        # Every stage uses the chosen model
+        payload["stage_models"] = {stage: model.value for stage in STAGES}
+    # In the URL, so that the generation is followed again after a refresh
+    st.query_params["job"] = job_queue.enqueue(payload)
+    st.rerun()
+
+if job is not None:
+    if generating and st.button("⏹️ Arrêter la génération"):
+        job = job_queue.request_cancel(job.id) or job
+
+    progress = JobProgress(job_queue, job.id)
     with st.status(
         "🤖 **Agents au travail... Cela peut prendre quelques    minutes...**",
         state="running",
         expanded=True,
     ) as status:
         with st.container(height=500, border=False):
-            try:
-                result = generate_article(
-                    llm=model.to_client(),
-                    topic=topic,
-                    language=language,
-                    context=context,
-                    existing_articles=get_selected_articles(),
-                    global_step_callback=streamlit_callback,
-                )
-                status.update(
-                    label="Article rédigé !", state="complete", expanded=False
-                )
-            except Exception as e:
-                st.error(e)
-                status.update(label="Une erreur est survenue !", state="error")
-                result = None
-
-    if result:
-        st.markdown(result)
+            progress.update()
+            # A rerun stops the polling, the next run shows the events again from the job
+            while job.status in (JobStatus.PENDING, JobStatus.RUNNING):
+                time.sleep(JOB_POLL_INTERVAL)
+                # The status is read before the events, so that none is missed when the job finishes
+                job = job_queue.get(job.id) or job
+                progress.update()
+
+        if job.status == JobStatus.SUCCEEDED:
+            status.update(label="Article rédigé !", state="complete", expanded=False)
+        else:
+            status.update(label="Une erreur est survenue !", state="error")
+
+    stored = (
+        get_result_store().get(job.article_id)
+        if job.status == JobStatus.SUCCEEDED and job.article_id
+        else None
+    )
+    if stored is not None:
+        st.markdown(stored.article)
         st_copy_to_clipboard(
-            result,
+            stored.article,
             before_copy_label="📋 Copier l'article généré",
             after_copy_label="✅ Texte copié !",
         )
+    elif job.status == JobStatus.SUCCEEDED:
+        st.error("L'article n'a pas pu être enregistré.")
+    else:
+        st.error(job.error)
 
-else:  # if not submitted
+else:  # no generation yet
     st.markdown(
         """
         ## 📝 Instructions
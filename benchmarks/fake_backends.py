@@ -0,0 +1,135 @@
+"""Local stand-ins for the external services, serving recorded fixtures."""
+
+import json
+import os
+import re
+import threading
+import time
+from unittest import mock
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+
+from benchmarks.fake_llm import FakeChatModel
+from crew.ai_models import AIModel
+from crew.http_client import get_http_client
+from crew.cancellation import CancellationCallbackHandler
+from crew.events import EventsCallbackHandler
+from crew.metrics import MetricsCallbackHandler
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
+
+SERPER_HOST = "google.serper.dev"
+STACKEXCHANGE_HOST = "api.stackexchange.com"
+CALLBACK_URL = "http://callback.benchmark/articles"
+
+
+def load_fixture(name: str) -> dict:
+    with open(os.path.join(FIXTURES_DIR, name), encoding="utf-8") as f:
+        return json.load(f)
+
+
+class FixturesAdapter(BaseAdapter):
+    """Transport adapter answering the Serper, StackExchange and callback requests.
+
+    Serper searches all get the recorded search response. StackExchange questions
+    and answers are looked up in the recorded ones, and the answer IDs that
+    weren't recorded get a copy of a recorded answer. The bodies posted to the
+    callback URL are kept in `callbacks`.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.search = load_fixture("serper_search.json")
+        self.answers = {
+            str(item["answer_id"]): item
+            for item in load_fixture("stackexchange_answers.json")["items"]
+        }
+        self.questions = {
+            str(item["question_id"]): item
+            for item in load_fixture("stackexchange_questions.json")["items"]
+        }
+        self.callbacks: list[dict] = []
+        self._lock = threading.Lock()
+
+    def _answers(self, path: str) -> dict:
+        ids = re.search(r"/answers/([\d;]+)", path).group(1).split(";")  # type: ignore
+        recorded = list(self.answers.values())
+        items = []
+        for i, answer_id in enumerate(ids):
+            item = self.answers.get(answer_id) or {
+                **recorded[i % len(recorded)],
+                "answer_id": int(answer_id),
+            }
+            items.append(item)
+        return {"items": items, "has_more": False, "quota_remaining": 9999}
+
+    def _questions(self, path: str) -> dict:
+        ids = re.search(r"/questions/([\d;]+)", path).group(1).split(";")  # type: ignore
+        items = [self.questions[i] for i in ids if i in self.questions]
+        return {"items": items, "has_more": False, "quota_remaining": 9999}
+
+    def send(self, request, **kwargs) -> requests.Response:
+        time.sleep(self.latency)
+
+        url = urlsplit(request.url)
+        if url.netloc == SERPER_HOST:
+            body = self.search
+        elif url.netloc == STACKEXCHANGE_HOST and "/questions/" in url.path:
+            body = self._questions(url.path)
+        elif url.netloc == STACKEXCHANGE_HOST:
+            body = self._answers(url.path)
+        else:
+            with self._lock:
+                self.callbacks.append(json.loads(request.body or "null"))
+            body = {"ok": True}
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps(body).encode()
+        response.headers["Content-Type"] = "application/json"
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+def install_fakes(
+    llm_latency: float,
+    llm_latency_per_token: float = 0.0,
+    http_latency: float = 0.0,
+    answer_words: int = 400,
+) -> FixturesAdapter:
+    """Replace the AI models by `FakeChatModel` and the external services by fixtures."""
+
+    def to_client(self, max_tokens=4096, max_retries=20, cache=None, streaming=False):
+        return FakeChatModel(
+            latency=llm_latency,
+            latency_per_token=llm_latency_per_token,
+            answer_words=answer_words,
+            cache=cache,
+            callbacks=[
+                MetricsCallbackHandler(),
+                EventsCallbackHandler(),
+                CancellationCallbackHandler(),
+            ],
+        )
+
+    mock.patch.object(AIModel, "to_client", to_client).start()
+
+    adapter = FixturesAdapter(latency=http_latency)
+    session = get_http_client().session
+    for prefix in (
+        f"https://{SERPER_HOST}",
+        f"https://{STACKEXCHANGE_HOST}",
+        CALLBACK_URL,
+    ):
+        session.mount(prefix, adapter)
+
+    os.environ.setdefault("SERPER_API_KEY", "benchmark")
+    return adapter
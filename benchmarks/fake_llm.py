@@ -0,0 +1,99 @@
+import hashlib
+import json
+import random
+import re
+import time
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+WORDS = (
+    "asyncio event loop coroutine task await future executor thread blocking "
+    "concurrency semaphore timeout cancel gather result exception callback queue "
+    "python function example code beginner explain simple detail error solution"
+).split()
+
+ANSWER_URL = re.compile(r"https://stackoverflow\.com/a/\d+")
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model following the ReAct format of the crewAI agents.
+
+    The first call of an agent having tools uses its tool once, every other call
+    gives a final answer made of pseudo-random words (seeded by the prompt) and
+    of the StackOverflow answer URLs found in the prompt, so that they flow from
+    the search to the report stage as with a real model.
+
+    Each call sleeps `latency` seconds, plus `latency_per_token` seconds per
+    output token, and reports an estimation of its token usage.
+    """
+
+    latency: float = 1.0
+    latency_per_token: float = 0.0
+    answer_words: int = 400
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _tool_call(self, prompt: str) -> str | None:
+        match = re.search(r"only one name of \[(.*?)\]", prompt)
+        if match is None:
+            return None
+
+        tool = match.group(1).split(",")[0].strip()
+        if f"Action: {tool}" in prompt:
+            # The tool was already used
+            return None
+
+        topic_match = re.search(r'related to "(.*?)"', prompt)
+        topic = topic_match.group(1) if topic_match else "python asyncio"
+
+        if tool == "GetAnswersFromStackOverflow":
+            arguments = {"answer_ids": sorted(set(ANSWER_URL.findall(prompt)))}
+        elif tool == "SearchStackOverflow":
+            arguments = {"query": topic}
+        else:
+            arguments = {"search_query": topic}
+
+        return f"Thought: I should use {tool}\nAction: {tool}\nAction Input: {json.dumps(arguments)}"
+
+    def _final_answer(self, prompt: str) -> str:
+        rng = random.Random(hashlib.sha256(prompt.encode()).hexdigest())
+        paragraphs = []
+        for _ in range(max(self.answer_words // 80, 1)):
+            paragraphs.append(" ".join(rng.choice(WORDS) for _ in range(80)))
+
+        code = "```python\nimport asyncio\n\nasync def main():\n    await asyncio.sleep(1)\n\nasyncio.run(main())\n```"
+        links = "\n".join(f"- {url}" for url in sorted(set(ANSWER_URL.findall(prompt))))
+        body = "\n\n".join(["# Benchmark article", *paragraphs, code, links])
+
+        return f"Thought: I now know the final answer\nFinal Answer: {body}"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        prompt = "\n".join(str(message.content) for message in messages)
+        text = self._tool_call(prompt) or self._final_answer(prompt)
+
+        # Roughly 4 characters per token
+        input_tokens = len(prompt) // 4
+        output_tokens = len(text) // 4
+        time.sleep(self.latency + self.latency_per_token * output_tokens)
+
+        message = AIMessage(
+            content=text,
+            usage_metadata={
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
@@ -0,0 +1,321 @@
+"""Offline benchmark of the article generation.
+
+The AI models are replaced by a deterministic fake model with a configurable
+latency, and the Serper, StackExchange and callback requests are answered from
+recorded fixtures, so nothing is billed and the results only depend on the
+orchestration overhead.
+
+Each scenario runs in its own process (with its own caches, job queue and
+metrics), and reports per-stage and end-to-end latency, articles per minute and
+peak memory:
+
+- cli: `generate_article.py` invoked once per article;
+- api: the articles are requested through `POST /generate-article` and generated
+  by the `api.worker` pool;
+- batch: the batch mode of `generate_article.py`.
+
+Usage: python -m benchmarks.run --scenarios cli api batch --concurrency 1 2 4
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = ["cli", "api", "batch"]
+
+
+def topics(articles: int) -> list[str]:
+    return [f"Python asyncio, part {i + 1}" for i in range(articles)]
+
+
+def run_cli(articles: int, concurrency: int, fast_search: bool) -> None:
+    import generate_article as cli
+
+    # The CLI generates a single article per invocation
+    for topic in topics(articles):
+        sys.argv = ["generate_article.py", topic, "--language", "English"]
+        if fast_search:
+            sys.argv.append("--fast-search")
+        cli.main()
+
+
+def run_api(articles: int, concurrency: int, fast_search: bool) -> None:
+    from fastapi.testclient import TestClient
+
+    from api.main import app, job_queue
+    from api.models import JobStatus
+    from api.worker import WorkerPool
+    from benchmarks.fake_backends import CALLBACK_URL
+
+    client = TestClient(app)
+    job_ids = []
+    for topic in topics(articles):
+        response = client.post(
+            "/generate-article",
+            json={
+                "topic": topic,
+                "language": "English",
+                "context": "",
+                "callback_url": CALLBACK_URL,
+                "fast_search": fast_search,
+            },
+        )
+        response.raise_for_status()
+        job_ids.append(response.json()["job_id"])
+
+    pool = WorkerPool(job_queue, concurrency=concurrency, poll_interval=0.1)
+    pool.start()
+    try:
+        finished = (JobStatus.SUCCEEDED, JobStatus.FAILED)
+        while not all(job_queue.get(job_id).status in finished for job_id in job_ids):  # type: ignore
+            time.sleep(0.1)
+    finally:
+        pool.stop()
+
+
+def run_batch(articles: int, concurrency: int, fast_search: bool) -> None:
+    import generate_article as cli
+    from crew.ai_models import AIModel
+
+    items = [
+        cli.BatchItem(topic, "English", "", AIModel.GPT_4O_MINI)
+        for topic in topics(articles)
+    ]
+    cli.run_batch(
+        items,
+        progress_path="batch.progress.jsonl",
+        workers=concurrency,
+        fast_search=fast_search,
+    )
+
+
+def stage_latencies(samples: list[tuple[str, dict, float]]) -> dict[str, float]:
+    sums, counts = {}, {}
+    for name, labels, value in samples:
+        if name == "article_stage_duration_seconds_sum":
+            sums[labels["stage"]] = value
+        elif name == "article_stage_duration_seconds_count":
+            counts[labels["stage"]] = value
+    return {stage: sums[stage] / counts[stage] for stage in sums if counts.get(stage)}
+
+
+def run_scenario(args) -> dict:
+    """Run a scenario in the current process, and return its results."""
+    from benchmarks.fake_backends import install_fakes
+    from crew.metrics import get_metrics_store
+
+    install_fakes(
+        llm_latency=args.llm_latency,
+        llm_latency_per_token=args.llm_latency_per_token,
+        http_latency=args.http_latency,
+        answer_words=args.answer_words,
+    )
+    scenario = {"cli": run_cli, "api": run_api, "batch": run_batch}[args.scenario]
+
+    start = time.perf_counter()
+    # The agents are verbose
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        scenario(args.articles, args.concurrency, args.fast_search)
+    wall_time = time.perf_counter() - start
+
+    samples = get_metrics_store().totals()
+    generations = {
+        labels["status"]: value
+        for name, labels, value in samples
+        if name == "article_generations_total"
+    }
+    durations = {
+        name: value
+        for name, labels, value in samples
+        if name.startswith("article_generation_duration_seconds")
+    }
+
+    return {
+        "scenario": args.scenario,
+        "concurrency": args.concurrency,
+        "articles": args.articles,
+        "succeeded": int(generations.get("succeeded", 0)),
+        "failed": int(generations.get("failed", 0)),
+        "wall_time": wall_time,
+        "articles_per_minute": generations.get("succeeded", 0) / wall_time * 60,
+        "mean_latency": durations.get("article_generation_duration_seconds_sum", 0)
+        / max(durations.get("article_generation_duration_seconds_count", 0), 1),
+        "stage_latencies": stage_latencies(samples),
+        # Kilobytes on Linux
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_in_subprocess(args, scenario: str, concurrency: int) -> dict:
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as directory:
+        env = {
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join(
+                filter(None, [REPO_DIR, os.environ.get("PYTHONPATH")])
+            ),
+            "CACHE_DIR": os.path.join(directory, "cache"),
+            "CHECKPOINTS_DIR": os.path.join(directory, "checkpoints"),
+            "JOBS_DB_PATH": os.path.join(directory, "jobs.sqlite"),
+            "METRICS_DB_PATH": os.path.join(directory, "metrics.sqlite"),
+            "RESULTS_DB_PATH": os.path.join(directory, "results.sqlite"),
+            "OTEL_SDK_DISABLED": "true",
+            "LANGCHAIN_TRACING_V2": "false",
+        }
+        output = os.path.join(directory, "result.json")
+        command = [
+            sys.executable,
+            "-m",
+            "benchmarks.run",
+            "--scenario-process",
+            "--scenario",
+            scenario,
+            "--concurrency",
+            str(concurrency),
+            "--articles",
+            str(args.articles),
+            "--llm-latency",
+            str(args.llm_latency),
+            "--llm-latency-per-token",
+            str(args.llm_latency_per_token),
+            "--http-latency",
+            str(args.http_latency),
+            "--answer-words",
+            str(args.answer_words),
+            "--output",
+            output,
+        ]
+        if args.fast_search:
+            command.append("--fast-search")
+        process = subprocess.run(
+            command,
+            cwd=directory,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if process.returncode != 0:
+            raise RuntimeError(
+                f"Scenario {scenario} failed:\n{process.stderr.decode(errors='replace')[-3000:]}"
+            )
+
+        with open(output, encoding="utf-8") as f:
+            return json.load(f)
+
+
+def print_results(results: list[dict]) -> None:
+    print(
+        f"{'scenario':<8} {'conc.':>5} {'articles':>8} {'failed':>6} {'wall (s)':>9} "
+        f"{'art./min':>8} {'latency (s)':>11} {'peak (MB)':>9}"
+    )
+    for result in results:
+        print(
+            f"{result['scenario']:<8} {result['concurrency']:>5} {result['succeeded']:>8} "
+            f"{result['failed']:>6} {result['wall_time']:>9.1f} {result['articles_per_minute']:>8.1f} "
+            f"{result['mean_latency']:>11.1f} {result['peak_memory_mb']:>9.0f}"
+        )
+
+    print("\nMean latency per stage (s):")
+    stages = list(dict.fromkeys(s for r in results for s in r["stage_latencies"]))
+    print(f"{'scenario':<8} {'conc.':>5} " + " ".join(f"{s:>16}" for s in stages))
+    for result in results:
+        latencies = result["stage_latencies"]
+        print(
+            f"{result['scenario']:<8} {result['concurrency']:>5} "
+            + " ".join(f"{latencies.get(s, 0):>16.2f}" for s in stages)
+        )
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the article generation with a fake AI model and recorded fixtures."
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        nargs="+",
+        default=[1, 2, 4],
+        help="Numbers of concurrent generations of the api and batch scenarios (default: 1 2 4). The cli scenario always runs one at a time.",
+    )
+    parser.add_argument(
+        "--articles", type=int, default=4, help="Articles per run (default: 4)."
+    )
+    parser.add_argument(
+        "--llm-latency",
+        type=float,
+        default=0.5,
+        help="Seconds per LLM call (default: 0.5).",
+    )
+    parser.add_argument(
+        "--llm-latency-per-token",
+        type=float,
+        default=0.0,
+        help="Additional seconds per output token of the LLM calls (default: 0).",
+    )
+    parser.add_argument(
+        "--http-latency",
+        type=float,
+        default=0.05,
+        help="Seconds per Serper/StackExchange request (default: 0.05).",
+    )
+    parser.add_argument(
+        "--answer-words",
+        type=int,
+        default=400,
+        help="Length of the final answers of the fake model (default: 400).",
+    )
+    parser.add_argument(
+        "--fast-search",
+        action="store_true",
+        help="Search the StackOverflow answers without the search agent (see crew.fast_search).",
+    )
+    parser.add_argument(
+        "--json", type=str, help="Also write the results to this JSON file."
+    )
+
+    # Used to run a single scenario in a subprocess
+    parser.add_argument(
+        "--scenario-process", action="store_true", help=argparse.SUPPRESS
+    )
+    parser.add_argument("--scenario", choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument("--output", type=str, help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+
+    if args.scenario_process:
+        args.concurrency = args.concurrency[0]
+        result = run_scenario(args)
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    results = []
+    for scenario in args.scenarios:
+        concurrencies = [1] if scenario == "cli" else args.concurrency
+        for concurrency in concurrencies:
+            print(
+                f"Running {scenario} with concurrency {concurrency}...", file=sys.stderr
+            )
+            results.append(run_in_subprocess(args, scenario, concurrency))
+
+    print_results(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
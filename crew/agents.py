@@ -1,6 +1,10 @@
 from crewai import Agent
-from crewai_tools import SerperDevTool
-from crew.tools import SearchStackOverflowTool, StackOverflowAnswerTool
+from crew.registry import agent_llm, get_tool
+from crew.tools import (
+    SearchStackOverflowTool,
+    SerperSearchTool,
+    StackOverflowAnswersTool,
+)
 
 
 class CustomAgents:
@@ -8,8 +12,9 @@ class CustomAgents:
 
     def __init__(self, default_llm):
         self.default_llm = default_llm
-        self.search_stackoverflow_tool = SearchStackOverflowTool()  # type: ignore
-        self.get_stackoverflow_answer = StackOverflowAnswerTool()
+        # The tools are shared by the concurrent generations
+        self.search_stackoverflow_tool = get_tool(SearchStackOverflowTool)
+        self.get_stackoverflow_answers = get_tool(StackOverflowAnswersTool)
 
     def stackoverflow_search_agent(self, llm=None):
         """Agent that searches Stack Overflow for relevant posts related to a topic."""
@@ -24,7 +29,7 @@ class CustomAgents:
             ),
             tools=[self.search_stackoverflow_tool],
             allow_delegation=False,
-            llm=self.default_llm if llm is None else llm,
+            llm=agent_llm(self.default_llm if llm is None else llm),
         )
 
     def stackoverflow_report_agent(
@@ -42,9 +47,9 @@ class CustomAgents:
                 "the key points and solutions from the best Stack Overflow answers. Your goal is to create "
                 "a detailed technical report that captures all important information and technical details."
             ),
-            tools=[self.get_stackoverflow_answer],
+            tools=[self.get_stackoverflow_answers],
             allow_delegation=False,
-            llm=self.default_llm if llm is None else llm,
+            llm=agent_llm(self.default_llm if llm is None else llm),
         )
 
     def reliable_sources_agent(self, llm=None):
@@ -61,9 +66,9 @@ class CustomAgents:
                 "You know how to identify outdated sources and won't include them in your recommendations."
                 "You know that your personal knowledge is not enough to provide reliable sources, so you ALWAYS rely on the tools and context provided."
             ),
-            tools=[SerperDevTool()],
+            tools=[get_tool(SerperSearchTool)],
             allow_delegation=False,
-            llm=self.default_llm if llm is None else llm,
+            llm=agent_llm(self.default_llm if llm is None else llm),
         )
 
     def blog_writer_agent(self, llm=None):
@@ -88,7 +93,7 @@ class CustomAgents:
             ),
             tools=[],
             allow_delegation=False,
-            llm=self.default_llm if llm is None else llm,
+            llm=agent_llm(self.default_llm if llm is None else llm),
         )
 
     def evaluator_agent(self, llm=None):
@@ -104,7 +109,7 @@ class CustomAgents:
             ),
             tools=[],
             allow_delegation=False,
-            llm=self.default_llm if llm is None else llm,
+            llm=agent_llm(self.default_llm if llm is None else llm),
         )
 
     def internal_linking_agent(self, llm=None):
@@ -121,5 +126,5 @@ class CustomAgents:
             ),
             tools=[],
             allow_delegation=False,
-            llm=self.default_llm if llm is None else llm,
+            llm=agent_llm(self.default_llm if llm is None else llm),
         )
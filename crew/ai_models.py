@@ -1,8 +1,14 @@
 from enum import Enum
+from langchain_core.caches import BaseCache
 from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_openai import ChatOpenAI
 from langchain_anthropic import ChatAnthropic
 
+from crew.cancellation import CancellationCallbackHandler
+from crew.events import EventsCallbackHandler
+from crew.metrics import MetricsCallbackHandler
+from crew.rate_limit import RateLimitCallbackHandler
+
 
 class AIModel(Enum):
     CLAUDE_35_SONNET = "claude-3-5-sonnet-20240620"
@@ -10,29 +16,63 @@ class AIModel(Enum):
     GPT_4O_MINI = "gpt-4o-mini"
     CLAUDE_3_HAIKU = "claude-3-haiku-20240307"
 
+    @property
+    def provider(self) -> str:
+        match self:
+            case AIModel.GPT_4O | AIModel.GPT_4O_MINI:
+                return "openai"
+            case AIModel.CLAUDE_35_SONNET | AIModel.CLAUDE_3_HAIKU:
+                return "anthropic"
+
     def to_client(
         self,
         max_tokens: int = 4096,
-        max_retries: int = 20,
+        max_retries: int = 6,
+        cache: BaseCache | None = None,
+        streaming: bool = False,
     ) -> BaseChatModel:
+        """Create a chat model client.
+
+        Args:
+            cache : Cache of the model's responses, e.g. `crew.cache.get_llm_cache()`. Defaults to no cache.
+            streaming : Stream the responses, so that their tokens are emitted as "token" events (see `crew.events`) while they're generated.
+
+        The LLM calls and tokens of the client are recorded in the metrics of the current run (see `crew.metrics`), its calls are aborted once the run is cancelled (see `crew.cancellation`), and they wait for the rate limits of the model (see `crew.rate_limit`).
+        """
+        callbacks = [
+            MetricsCallbackHandler(),
+            EventsCallbackHandler(),
+            CancellationCallbackHandler(),
+            RateLimitCallbackHandler(self.value),
+        ]
         match self:
             case AIModel.GPT_4O_MINI:
                 return ChatOpenAI(
                     model_name=self.value,  # type: ignore
                     max_tokens=max_tokens,
                     max_retries=max_retries,
+                    cache=cache,
+                    streaming=streaming,
+                    stream_usage=True,
+                    callbacks=callbacks,
                 )
             case AIModel.CLAUDE_35_SONNET:
                 return ChatAnthropic(
                     model_name=self.value,
                     max_tokens=max_tokens,  # type: ignore
                     max_retries=max_retries,
+                    cache=cache,
+                    streaming=streaming,
+                    callbacks=callbacks,
                 )
             case AIModel.CLAUDE_3_HAIKU:
                 return ChatAnthropic(
                     model_name=self.value,
                     max_tokens=max_tokens,  # type: ignore
                     max_retries=max_retries,
+                    cache=cache,
+                    streaming=streaming,
+                    callbacks=callbacks,
                 )
 
             case AIModel.GPT_4O:
@@ -40,4 +80,8 @@ class AIModel(Enum):
                     model_name=self.value,  # type: ignore
                     max_tokens=max_tokens,
                     max_retries=max_retries,
+                    cache=cache,
+                    streaming=streaming,
+                    stream_usage=True,
+                    callbacks=callbacks,
                 )
@@ -0,0 +1,244 @@
+"""Structured representation of the StackExchange answers.
+
+The `body_markdown` of an answer is parsed once into prose paragraphs, code
+blocks (with their language) and outbound links, with the HTML entities
+decoded, so that the agents get a compact text and the code can be picked
+without asking a model.
+"""
+
+import html
+import re
+import time
+from dataclasses import dataclass, field
+
+from crew.compaction import trim_boilerplate
+
+FENCED_CODE_BLOCK = re.compile(
+    r"^```[ \t]*([\w+#.-]*)[^\n]*\n(.*?)^```[ \t]*$", re.M | re.S
+)
+
+# StackOverflow syntax highlighting hints: "<!-- language: lang-python -->"
+LANGUAGE_HINT = re.compile(r"<!--\s*language(-all)?:\s*(?:lang-)?([\w+#.-]+)\s*-->")
+
+INLINE_LINK = re.compile(r"!?\[([^\]]*)\]\((\S+?)(?:\s+\"[^\"]*\")?\)")
+REFERENCE_LINK = re.compile(r"!?\[([^\]]*)\]\[([^\]]*)\]")
+REFERENCE_DEFINITION = re.compile(r"^\s*\[([^\]]+)\]:\s*(\S+).*$", re.M)
+BARE_URL = re.compile(r"(?<![(<\[])\bhttps?://[^\s)>\]]+")
+
+# Guessed from the code when the answer doesn't tell the language, first match wins
+LANGUAGE_PATTERNS = [
+    (
+        "python",
+        re.compile(
+            r"^\s*(def |import |from \w+ import|class \w+.*:$)|print\(|self\.", re.M
+        ),
+    ),
+    (
+        "javascript",
+        re.compile(
+            r"\b(const|let|var) \w+ =|=>|console\.log|function\s*\w*\(|require\("
+        ),
+    ),
+    (
+        "sql",
+        re.compile(
+            r"^\s*(SELECT|INSERT|UPDATE|DELETE|CREATE TABLE|ALTER TABLE)\b", re.M | re.I
+        ),
+    ),
+    (
+        "html",
+        re.compile(
+            r"^\s*<(!DOCTYPE|html|div|span|head|body|script|p|a)\b", re.M | re.I
+        ),
+    ),
+    ("java", re.compile(r"\bpublic (static )?(class|void)\b|System\.out\.println")),
+    ("csharp", re.compile(r"\busing System\b|Console\.WriteLine")),
+    (
+        "bash",
+        re.compile(r"^\s*(\$ |sudo |pip install|npm |apt-get |cd |export \w+=)", re.M),
+    ),
+    ("json", re.compile(r"^\s*[\[{]\s*\"", re.S)),
+]
+
+LANGUAGE_ALIASES = {
+    "py": "python",
+    "python3": "python",
+    "js": "javascript",
+    "sh": "bash",
+    "shell": "bash",
+    "c#": "csharp",
+}
+
+
+@dataclass(slots=True)
+class CodeBlock:
+    language: str
+    code: str
+
+
+@dataclass(slots=True)
+class Answer:
+    """An answer, parsed from a StackExchange API item.
+
+    `paragraphs` holds the prose in order, with a "[code N]" placeholder where
+    the N-th code block (counting from 1) of `code_blocks` is.
+    """
+
+    answer_id: int
+    question_title: str
+    link: str
+    score: int
+    is_accepted: bool
+    last_activity_days: int | None
+    paragraphs: list[str] = field(default_factory=list)
+    code_blocks: list[CodeBlock] = field(default_factory=list)
+    links: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_item(cls, item: dict, default_language: str = "") -> "Answer":
+        last_activity_date = item.get("last_activity_date")
+        answer = cls(
+            answer_id=item.get("answer_id", 0),
+            question_title=html.unescape(item.get("title") or ""),
+            link=item.get("link") or "",
+            score=item.get("score", 0),
+            is_accepted=bool(item.get("is_accepted")),
+            last_activity_days=int((time.time() - last_activity_date) // 86400)
+            if last_activity_date
+            else None,
+        )
+        answer._parse_body(item.get("body_markdown") or "", default_language)
+        return answer
+
+    def _add_code(self, code: str, language: str) -> str:
+        code = code.strip("\n")
+        language = LANGUAGE_ALIASES.get(language.lower(), language.lower())
+        language = language or guess_language(code)
+        if not language and self.code_blocks:
+            # Short snippets are usually in the language of the previous ones
+            language = self.code_blocks[-1].language
+        self.code_blocks.append(CodeBlock(language, code))
+        return f"[code {len(self.code_blocks)}]"
+
+    def _add_link(self, url: str) -> None:
+        if url not in self.links:
+            self.links.append(url)
+
+    def _parse_body(self, body: str, default_language: str) -> None:
+        # Decoded once: the API escapes the markdown as HTML
+        body = html.unescape(body).replace("\r\n", "\n")
+
+        references = {}
+        for name, url in REFERENCE_DEFINITION.findall(body):
+            references[name.lower()] = url
+        body = REFERENCE_DEFINITION.sub("", body)
+
+        def replace_inline_link(match: re.Match) -> str:
+            self._add_link(match.group(2))
+            return match.group(1)
+
+        def replace_reference_link(match: re.Match) -> str:
+            url = references.get((match.group(2) or match.group(1)).lower())
+            if url:
+                self._add_link(url)
+            return match.group(1)
+
+        # Paragraphs are separated by blank lines, but so are the lines of an
+        # indented code block, so consecutive indented blocks are merged.
+        language_all = default_language
+        language_next = ""
+        pending_code: list[str] = []
+
+        def flush_code() -> None:
+            nonlocal language_next
+            if pending_code:
+                code = "\n\n".join(
+                    re.sub(r"^( {4}|\t)", "", block, flags=re.M)
+                    for block in pending_code
+                )
+                self.paragraphs.append(
+                    self._add_code(code, language_next or language_all)
+                )
+                pending_code.clear()
+                language_next = ""
+
+        for part_index, part in enumerate(FENCED_CODE_BLOCK.split(body)):
+            # The split alternates text, fence language, fence content
+            if part_index % 3 == 1:
+                fence_language = part
+                continue
+            if part_index % 3 == 2:
+                flush_code()
+                self.paragraphs.append(
+                    self._add_code(
+                        part, fence_language or language_next or language_all
+                    )
+                )
+                language_next = ""
+                continue
+
+            for block in re.split(r"\n\s*\n", part):
+                if not block.strip():
+                    continue
+
+                hint = LANGUAGE_HINT.search(block)
+                if hint:
+                    if hint.group(1):
+                        language_all = hint.group(2)
+                    else:
+                        language_next = hint.group(2)
+                    block = LANGUAGE_HINT.sub("", block)
+                    if not block.strip():
+                        continue
+
+                lines = [line for line in block.splitlines() if line.strip()]
+                if all(line.startswith(("    ", "\t")) for line in lines):
+                    pending_code.append(block)
+                    continue
+
+                flush_code()
+                block = INLINE_LINK.sub(replace_inline_link, block)
+                block = REFERENCE_LINK.sub(replace_reference_link, block)
+                for url in BARE_URL.findall(block):
+                    self._add_link(url.rstrip(".,;:"))
+                block = trim_boilerplate(block.strip())
+                if block:
+                    self.paragraphs.append(block)
+
+        flush_code()
+
+    def to_prompt(self) -> str:
+        """Serialize the answer for a prompt, with the code blocks in place."""
+        header = [f"Answer {self.answer_id}", f"score {self.score}"]
+        if self.is_accepted:
+            header.append("accepted")
+        if self.last_activity_days is not None:
+            header.append(f"last activity {self.last_activity_days} days ago")
+
+        lines = [" | ".join(header)]
+        if self.question_title:
+            lines.append(f"Question: {self.question_title}")
+        if self.link:
+            lines.append(f"Link: {self.link}")
+
+        body = []
+        for paragraph in self.paragraphs:
+            match = re.fullmatch(r"\[code (\d+)\]", paragraph)
+            if match:
+                block = self.code_blocks[int(match.group(1)) - 1]
+                body.append(f"```{block.language}\n{block.code}\n```")
+            else:
+                body.append(paragraph)
+        lines.append("\n\n".join(body))
+
+        if self.links:
+            lines.append("Links: " + " ".join(self.links))
+
+        return "\n".join(lines)
+
+
+def guess_language(code: str) -> str:
+    for language, pattern in LANGUAGE_PATTERNS:
+        if pattern.search(code):
+            return language
+    return ""
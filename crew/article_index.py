@@ -0,0 +1,287 @@
+"""Vector index of the existing articles, to select the candidates of the internal links.
+
+Giving the Linking Agent every article of a large blog would blow its context, so
+only the `top_k` articles closest to the new article are given to it. The
+articles are embedded locally with feature hashing (no model to download, no API
+call): words and word pairs are hashed into a fixed-size vector, weighted by
+their log-frequency. This is enough to find the articles sharing the vocabulary of
+the new one, which is what the agent needs to pick a few relevant links.
+
+The vectors are stored in a memory-mapped file, and the articles (with the row of
+their vector) in a SQLite file next to it. Articles are added incrementally: an
+article already indexed with the same title and summary isn't embedded again.
+"""
+
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import zlib
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator
+
+import numpy as np
+
+# Words too common to tell articles apart, in the languages of the blog
+STOP_WORDS = set(
+    """
+    a an and are as at be by for from how in into is it its of on or that the this to
+    what when why with you your can do does use using vs
+    au aux avec ce ces comment dans de des du en est et la le les leur mais ou par
+    pour qui que quoi sur un une vos votre
+    """.split()
+)
+
+WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def index_path() -> str:
+    return os.environ.get("ARTICLE_INDEX_PATH", os.path.join("data", "article_index"))
+
+
+class HashingEmbedder:
+    """Embed texts as normalized vectors of hashed words and word pairs."""
+
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    def _features(self, text: str) -> Counter:
+        words = [
+            word
+            for word in WORD.findall(text.lower())
+            if len(word) > 1 and word not in STOP_WORDS
+        ]
+        features = Counter(words)
+        features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature, count in self._features(text).items():
+            # crc32 rather than `hash`, which changes with each process
+            h = zlib.crc32(feature.encode())
+            sign = 1.0 if h & 0x80000000 else -1.0
+            vector[h % self.dim] += sign * (1 + math.log(count))
+
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+def article_text(article: dict) -> str:
+    # The title is repeated to weigh more than the summary
+    return f"{article['title']}\n{article['title']}\n{article.get('summary') or ''}"
+
+
+def article_fingerprint(article: dict) -> str:
+    return hashlib.sha1(article_text(article).encode()).hexdigest()
+
+
+class ArticleIndex:
+    """Vector index of articles, identified by their URL.
+
+    The index can be shared by several processes: the additions are serialized by
+    a SQLite transaction, and the readers reopen the vectors file when it grows.
+    """
+
+    def __init__(
+        self, path: str | None = None, embedder: HashingEmbedder | None = None
+    ):
+        self.path = path or index_path()
+        os.makedirs(self.path, exist_ok=True)
+        self.embedder = embedder or HashingEmbedder()
+        self.vectors_path = os.path.join(self.path, "vectors.f32")
+
+        self._vectors: np.memmap | None = None
+        self._lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS articles (
+                    row INTEGER PRIMARY KEY,
+                    url TEXT NOT NULL UNIQUE,
+                    title TEXT NOT NULL,
+                    summary TEXT,
+                    fingerprint TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+            conn.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)",
+                (str(self.embedder.dim),),
+            )
+            dim = int(
+                conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()[0]
+            )
+        if dim != self.embedder.dim:
+            raise ValueError(
+                f"The index at {self.path} has {dim} dimensions, the embedder {self.embedder.dim}."
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(
+            os.path.join(self.path, "articles.sqlite"),
+            timeout=30,
+            isolation_level=None,
+        )
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _capacity(self) -> int:
+        try:
+            size = os.path.getsize(self.vectors_path)
+        except FileNotFoundError:
+            return 0
+        return size // (4 * self.embedder.dim)
+
+    def _open_vectors(self, rows: int) -> np.memmap:
+        """Return the memory map of the vectors, grown to hold at least `rows` rows."""
+        capacity = self._capacity()
+        if capacity < rows:
+            # Grown by doubling, so that adding articles one by one stays cheap
+            capacity = max(rows, 2 * capacity, 1024)
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(capacity * 4 * self.embedder.dim)
+            self._vectors = None
+
+        if self._vectors is None or self._vectors.shape[0] != capacity:
+            self._vectors = np.memmap(
+                self.vectors_path,
+                dtype=np.float32,
+                mode="r+",
+                shape=(capacity, self.embedder.dim),
+            )
+        return self._vectors
+
+    def add(self, articles: list[dict]) -> list[int]:
+        """Add or update articles (with a "title", a "url" and optionally a "summary").
+
+        Returns the rows of the articles in the index, in the same order.
+        """
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                indexed = {
+                    url: (row, fingerprint)
+                    for row, url, fingerprint in conn.execute(
+                        "SELECT row, url, fingerprint FROM articles"
+                    )
+                }
+                next_row = max((row for row, _ in indexed.values()), default=-1) + 1
+
+                rows = []
+                changed = []
+                for article in articles:
+                    fingerprint = article_fingerprint(article)
+                    row, indexed_fingerprint = indexed.get(article["url"], (None, None))
+                    if row is None:
+                        row = next_row
+                        next_row += 1
+                    if fingerprint != indexed_fingerprint:
+                        changed.append((row, article, fingerprint))
+                        indexed[article["url"]] = (row, fingerprint)
+                    rows.append(row)
+
+                if changed:
+                    vectors = self._open_vectors(next_row)
+                    for row, article, _ in changed:
+                        vectors[row] = self.embedder.embed(article_text(article))
+                    vectors.flush()
+
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO articles (row, url, title, summary, fingerprint) VALUES (?, ?, ?, ?, ?)",
+                        [
+                            (
+                                row,
+                                article["url"],
+                                article["title"],
+                                article.get("summary"),
+                                fingerprint,
+                            )
+                            for row, article, fingerprint in changed
+                        ],
+                    )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        return rows
+
+    def remove(self, urls: list[str]) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "DELETE FROM articles WHERE url = ?", [(url,) for url in urls]
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def search(
+        self, text: str, top_k: int = 20, rows: list[int] | None = None
+    ) -> list[dict]:
+        """Return the `top_k` articles closest to `text`, best first, with their "score".
+
+        If `rows` is given, only these articles (as returned by `add`) are considered.
+        """
+        with self._connect() as conn:
+            articles = {
+                row: {"url": url, "title": title}
+                | ({"summary": summary} if summary else {})
+                for row, url, title, summary in conn.execute(
+                    "SELECT row, url, title, summary FROM articles"
+                )
+            }
+        candidates = np.array(
+            sorted(articles if rows is None else set(rows) & set(articles)),
+            dtype=np.int64,
+        )
+        if not len(candidates):
+            return []
+
+        with self._lock:
+            vectors = self._open_vectors(int(candidates.max()) + 1)
+            scores = vectors[candidates] @ self.embedder.embed(text)
+
+        best = np.argsort(-scores, kind="stable")[:top_k]
+        return [
+            {**articles[int(candidates[i])], "score": float(scores[i])} for i in best
+        ]
+
+
+def select_link_candidates(articles: list[dict], text: str, top_k: int) -> list[dict]:
+    """Return the (at most) `top_k` articles most relevant to `text`."""
+    if len(articles) <= top_k:
+        return articles
+
+    index = get_article_index()
+    rows = index.add(articles)
+    by_url = {article["url"]: article for article in articles}
+    # The articles as given by the caller, which may hold more than the indexed fields
+    return [by_url[found["url"]] for found in index.search(text, top_k, rows=rows)]
+
+
+_article_index: ArticleIndex | None = None
+_article_index_lock = threading.Lock()
+
+
+def get_article_index() -> ArticleIndex:
+    """Return the article index shared by the whole process."""
+    global _article_index
+    with _article_index_lock:
+        if _article_index is None:
+            _article_index = ArticleIndex()
+        return _article_index
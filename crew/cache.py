@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Iterable, Optional, Sequence
+
+from langchain_core.caches import RETURN_VAL_TYPE, BaseCache
+from langchain_core.load import dumps, loads
+
+from crew.metrics import record_cache_lookups
+
+
+def cache_dir() -> str:
+    return os.environ.get("CACHE_DIR", ".cache")
+
+
+class SQLiteCache:
+    """Persistent key/value cache stored in a SQLite file.
+
+    Every entry has its own expiry date, and the least recently used entries are
+    evicted once the cache holds more than `max_entries` items. Values must be
+    JSON serializable.
+    """
+
+    # Name of the cache in the metrics
+    name = "cache"
+
+    def __init__(self, path: str, max_entries: int = 10_000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Any | None:
+        """Return the cached value for `key`, or None if missing or expired."""
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys: Iterable[str]) -> dict[str, Any]:
+        """Return the cached values of all the `keys` found in the cache."""
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+
+        now = time.time()
+        placeholders = ",".join("?" * len(keys))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT key, value FROM cache WHERE key IN ({placeholders}) AND expires_at > ?",
+                (*keys, now),
+            ).fetchall()
+            found = {key: json.loads(value) for key, value in rows}
+            if found:
+                self._conn.executemany(
+                    "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._conn.commit()
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        record_cache_lookups(self.name, len(found), len(keys) - len(found))
+        return found
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """Store `value` under `key` for `ttl` seconds."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        self._conn.execute(
+            """
+            DELETE FROM cache WHERE key IN (
+                SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_entries,),
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self)}
+
+
+class AnswerCache(SQLiteCache):
+    """Cache of raw StackExchange answer items, keyed by answer ID.
+
+    An answer that hasn't been edited for years is very unlikely to change, while a
+    recently active one may still be edited. The TTL of each entry is therefore a
+    fraction of the time elapsed since the answer's `last_activity_date`.
+    """
+
+    name = "answers"
+
+    MIN_TTL = 60 * 60  # 1 hour
+    MAX_TTL = 30 * 24 * 60 * 60  # 30 days
+    TTL_RATIO = 0.1
+
+    def ttl_for(self, item: dict) -> float:
+        last_activity_date = item.get("last_activity_date")
+        if not last_activity_date:
+            return self.MIN_TTL
+
+        age = max(time.time() - last_activity_date, 0)
+        return min(max(age * self.TTL_RATIO, self.MIN_TTL), self.MAX_TTL)
+
+    def get_answer(self, answer_id: str) -> dict | None:
+        return self.get(str(answer_id))
+
+    def put_answer(self, item: dict) -> None:
+        self.set(str(item["answer_id"]), item, ttl=self.ttl_for(item))
+
+
+_answer_cache: AnswerCache | None = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache() -> AnswerCache:
+    """Return the answer cache shared by the whole process."""
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache(
+                os.environ.get(
+                    "ANSWER_CACHE_PATH",
+                    os.path.join(cache_dir(), "stackoverflow_answers.sqlite"),
+                ),
+                max_entries=int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", 5000)),
+            )
+        return _answer_cache
+
+
+class QuestionCache(SQLiteCache):
+    """Cache of StackExchange question metadata (score, answers, tags...), keyed by question ID."""
+
+    name = "questions"
+
+    def __init__(self, path: str, max_entries: int = 5000, ttl: float = 24 * 60 * 60):
+        super().__init__(path, max_entries=max_entries)
+        self.ttl = ttl
+
+    def put_question(self, item: dict) -> None:
+        self.set(str(item["question_id"]), item, ttl=self.ttl)
+
+
+_question_cache: QuestionCache | None = None
+_question_cache_lock = threading.Lock()
+
+
+def get_question_cache() -> QuestionCache:
+    """Return the question cache shared by the whole process."""
+    global _question_cache
+    with _question_cache_lock:
+        if _question_cache is None:
+            _question_cache = QuestionCache(
+                os.environ.get(
+                    "QUESTION_CACHE_PATH",
+                    os.path.join(cache_dir(), "stackoverflow_questions.sqlite"),
+                ),
+                max_entries=int(os.environ.get("QUESTION_CACHE_MAX_ENTRIES", 5000)),
+                ttl=float(os.environ.get("QUESTION_CACHE_TTL", 24 * 60 * 60)),
+            )
+        return _question_cache
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query so that near-identical queries share a cache entry.
+
+    Case, whitespace, punctuation, duplicated words and word order are ignored, and
+    `site:` filters are canonicalized ("site:https://www.StackOverflow.com/" ->
+    "site:stackoverflow.com").
+    """
+    tokens = set()
+    for token in query.lower().split():
+        if token.startswith("site:"):
+            site = re.sub(r"^(https?://)?(www\.)?", "", token[len("site:") :])
+            tokens.add(f"site:{site.rstrip('/')}")
+        else:
+            token = token.strip(".,;:!?\"'()[]")
+            if token:
+                tokens.add(token)
+
+    return " ".join(sorted(tokens))
+
+
+class SearchCache(SQLiteCache):
+    """Cache of raw Serper search responses, keyed by normalized query."""
+
+    name = "search"
+
+    def __init__(self, path: str, max_entries: int = 2000, ttl: float = 24 * 60 * 60):
+        super().__init__(path, max_entries=max_entries)
+        self.ttl = ttl
+
+    def key_for(self, payload: dict) -> str:
+        # Every other search parameter (number of results, country...) is part of the key
+        params = {k: v for k, v in payload.items() if k != "q"}
+        return json.dumps([normalize_query(payload["q"]), params], sort_keys=True)
+
+    def get_results(self, payload: dict) -> dict | None:
+        return self.get(self.key_for(payload))
+
+    def put_results(self, payload: dict, results: dict) -> None:
+        self.set(self.key_for(payload), results, ttl=self.ttl)
+
+
+_search_cache: SearchCache | None = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache() -> SearchCache:
+    """Return the search cache shared by the whole process."""
+    global _search_cache
+    with _search_cache_lock:
+        if _search_cache is None:
+            _search_cache = SearchCache(
+                os.environ.get(
+                    "SEARCH_CACHE_PATH",
+                    os.path.join(cache_dir(), "serper_searches.sqlite"),
+                ),
+                max_entries=int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", 2000)),
+                ttl=float(os.environ.get("SEARCH_CACHE_TTL", 24 * 60 * 60)),
+            )
+        return _search_cache
+
+
+class LLMCache(BaseCache):
+    """LangChain cache of LLM responses, stored in a SQLiteCache.
+
+    LangChain keys the lookups on the prompt messages and on `llm_string`, which
+    holds the model name and its parameters. Pass an instance to
+    `AIModel.to_client` to reuse earlier completions when the exact same prompt is
+    sent again, e.g. when a failed run is restarted.
+    """
+
+    def __init__(
+        self, path: str, max_entries: int = 2000, ttl: float = 30 * 24 * 60 * 60
+    ):
+        self.store = SQLiteCache(path, max_entries=max_entries)
+        self.store.name = "llm"
+        self.ttl = ttl
+
+    def _key(self, prompt: str, llm_string: str) -> str:
+        return hashlib.sha256(f"{llm_string}\n{prompt}".encode()).hexdigest()
+
+    def lookup(self, prompt: str, llm_string: str) -> Optional[RETURN_VAL_TYPE]:
+        generations = self.store.get(self._key(prompt, llm_string))
+        if generations is None:
+            return None
+
+        generations = [loads(generation) for generation in generations]
+        for generation in generations:
+            # Lets the metrics tell cached responses from the billed ones
+            if hasattr(generation, "message"):
+                generation.message.response_metadata["cached"] = True
+        return generations
+
+    def update(self, prompt: str, llm_string: str, return_val: Sequence[Any]) -> None:
+        self.store.set(
+            self._key(prompt, llm_string),
+            [dumps(generation) for generation in return_val],
+            ttl=self.ttl,
+        )
+
+    def clear(self, **kwargs: Any) -> None:
+        self.store.clear()
+
+
+_llm_cache: LLMCache | None = None
+_llm_cache_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache:
+    """Return the LLM cache shared by the whole process."""
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = LLMCache(
+                os.environ.get(
+                    "LLM_CACHE_PATH", os.path.join(cache_dir(), "llm_responses.sqlite")
+                ),
+                max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 2000)),
+                ttl=float(os.environ.get("LLM_CACHE_TTL", 30 * 24 * 60 * 60)),
+            )
+        return _llm_cache
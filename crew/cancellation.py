@@ -0,0 +1,123 @@
+"""Cancellation and deadlines of the article generations.
+
+A `CancelToken` made current with `cancellable` is checked between the steps of
+the generation: before each LLM call and streamed token, after each agent step,
+before each HTTP request and during the retry backoffs. Once it's cancelled (or
+its deadline has passed), these checks raise `RunCancelled`, and `run_pipeline`
+stops waiting for the running stages.
+
+Python threads can't be interrupted, so a call already blocked in a client
+library (e.g. the retries of the Anthropic SDK) keeps its thread until it
+returns, but the generation itself returns right away.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+class RunCancelled(Exception):
+    """The generation was cancelled."""
+
+
+class RunTimedOut(RunCancelled):
+    """The generation exceeded its deadline."""
+
+
+class CancelToken:
+    """Cancellation flag of a run, with an optional deadline `timeout` seconds from now."""
+
+    def __init__(self, timeout: float | None = None):
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: str | None = None
+        self._cancelled = threading.Event()
+
+    def cancel(self, reason: str = "The article generation was cancelled.") -> None:
+        if not self._cancelled.is_set():
+            self.reason = reason
+            self._cancelled.set()
+
+    def remaining(self) -> float | None:
+        """Seconds left before the deadline, or None if there is none."""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set() or self.remaining() == 0
+
+    def check(self) -> None:
+        """Raise `RunCancelled` (or `RunTimedOut`) if the run must stop."""
+        if self._cancelled.is_set():
+            raise RunCancelled(self.reason)
+        if self.remaining() == 0:
+            raise RunTimedOut(
+                f"The article generation timed out after {self.timeout:g} seconds."
+            )
+
+    def sleep(self, seconds: float) -> None:
+        """Sleep, waking up to raise as soon as the run is cancelled."""
+        remaining = self.remaining()
+        if remaining is not None:
+            seconds = min(seconds, remaining)
+        self._cancelled.wait(seconds)
+        self.check()
+
+
+_current_token: ContextVar[CancelToken | None] = ContextVar(
+    "current_cancel_token", default=None
+)
+
+
+@contextmanager
+def cancellable(token: CancelToken) -> Iterator[CancelToken]:
+    """Make `token` the cancellation token of the code run in the block."""
+    reset_token = _current_token.set(token)
+    try:
+        yield token
+    finally:
+        _current_token.reset(reset_token)
+
+
+def current_token() -> CancelToken | None:
+    return _current_token.get()
+
+
+def check_cancelled() -> None:
+    """Raise `RunCancelled` if the current run must stop."""
+    token = _current_token.get()
+    if token is not None:
+        token.check()
+
+
+def sleep(seconds: float) -> None:
+    """`time.sleep`, interrupted if the current run is cancelled."""
+    token = _current_token.get()
+    if token is None:
+        time.sleep(seconds)
+    else:
+        token.sleep(seconds)
+
+
+class CancellationCallbackHandler(BaseCallbackHandler):
+    """LangChain callback aborting the LLM calls of a cancelled run."""
+
+    # Otherwise LangChain logs the errors of the callbacks and goes on
+    raise_error = True
+
+    def on_llm_start(self, serialized: dict, prompts: list, **kwargs: Any) -> None:
+        check_cancelled()
+
+    def on_chat_model_start(
+        self, serialized: dict, messages: list, **kwargs: Any
+    ) -> None:
+        check_cancelled()
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        check_cancelled()
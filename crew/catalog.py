@@ -0,0 +1,475 @@
+"""Persistent catalogs of the existing articles of the blogs, to link the new articles to.
+
+A catalog is filled once (from a CSV file, a sitemap, or a list of articles) and
+then referenced by its ID, instead of sending the whole list of articles with
+each generation. Articles are upserted by URL, so importing a sitemap again only
+adds the new articles.
+
+Sitemaps only give URLs, so `precompute` fetches the pages of the articles missing
+a summary to take their title and description, and adds the articles to the
+vector index used to select the link candidates (see `crew.article_index`).
+"""
+
+import csv
+import io
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from contextlib import contextmanager
+from html.parser import HTMLParser
+from typing import Iterator
+from urllib.parse import unquote, urlsplit
+
+from crew.article_index import get_article_index
+from crew.http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+SITEMAP_NAMESPACE = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+
+# Sitemap indexes can nest, but not without limit
+MAX_SITEMAPS = 50
+
+# Longer summaries don't help the Linking Agent, and take room in its prompt
+MAX_SUMMARY_LENGTH = 500
+
+# Accepted names of the CSV columns, e.g. exported from a spreadsheet in French
+CSV_COLUMNS = {
+    "title": ("title", "titre", "name"),
+    "url": ("url", "link", "lien", "loc"),
+    "summary": ("summary", "résumé", "resume", "description"),
+}
+
+
+def catalog_db_path() -> str:
+    return os.environ.get("CATALOG_DB_PATH", os.path.join("data", "catalog.sqlite"))
+
+
+def title_from_url(url: str) -> str:
+    """Guess a title from the slug of an URL: ".../rust-vs-python/" -> "Rust vs python"."""
+    segments = [s for s in urlsplit(url).path.split("/") if s]
+    slug = unquote(segments[-1]) if segments else urlsplit(url).netloc
+    slug = re.sub(r"\.\w+$", "", slug)
+    words = re.sub(r"[-_+]+", " ", slug).strip()
+    return words[:1].upper() + words[1:]
+
+
+def read_csv(text: str) -> list[dict]:
+    """Read articles from a CSV text with a header, with at least the URL column."""
+    reader = csv.DictReader(io.StringIO(text.lstrip("\ufeff")))
+    columns = {}
+    for field, names in CSV_COLUMNS.items():
+        for name in reader.fieldnames or []:
+            if name.strip().lower() in names:
+                columns[field] = name
+                break
+    if "url" not in columns:
+        raise ValueError(
+            f"The CSV must have an URL column, named one of: {', '.join(CSV_COLUMNS['url'])}"
+        )
+
+    articles = []
+    for row in reader:
+        article = {
+            field: (row.get(name) or "").strip() for field, name in columns.items()
+        }
+        if article["url"]:
+            articles.append(article)
+    return articles
+
+
+def read_sitemap(url: str) -> list[dict]:
+    """Read the articles of a sitemap, following the sitemaps of a sitemap index.
+
+    Sitemaps only give URLs: the titles are guessed from them, until `precompute`
+    fetches the pages.
+    """
+    articles = []
+    pending = [url]
+    seen = set()
+    while pending and len(seen) < MAX_SITEMAPS:
+        sitemap_url = pending.pop(0)
+        if sitemap_url in seen:
+            continue
+        seen.add(sitemap_url)
+
+        response = get_http_client().get(sitemap_url)
+        response.raise_for_status()
+        root = ET.fromstring(response.content)
+
+        locations = [
+            loc.text.strip()
+            for loc in root.iter(f"{SITEMAP_NAMESPACE}loc")
+            if loc.text and loc.text.strip()
+        ]
+        if root.tag == f"{SITEMAP_NAMESPACE}sitemapindex":
+            pending.extend(locations)
+        else:
+            articles.extend({"url": location} for location in locations)
+
+    return articles
+
+
+class PageDetailsParser(HTMLParser):
+    """Extract the title and description of an HTML page."""
+
+    def __init__(self):
+        super().__init__()
+        self.title = ""
+        self.description = ""
+        self.first_paragraph = ""
+        self._in = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "meta":
+            name = (attrs.get("name") or attrs.get("property") or "").lower()
+            content = (attrs.get("content") or "").strip()
+            if name == "og:title" and content:
+                self.title = content
+            elif name in ("description", "og:description") and content:
+                self.description = self.description or content
+        elif tag in ("title", "h1", "p"):
+            self._in = tag
+
+    def handle_endtag(self, tag):
+        if tag == self._in:
+            self._in = None
+
+    def handle_data(self, data):
+        if self._in in ("title", "h1") and not self.title:
+            self.title = data.strip()
+        elif self._in == "p" and len(self.first_paragraph) < MAX_SUMMARY_LENGTH:
+            self.first_paragraph += data
+
+
+def fetch_page_details(url: str) -> tuple[str, str]:
+    """Return the title and a summary of a page."""
+    response = get_http_client().get(url)
+    response.raise_for_status()
+
+    parser = PageDetailsParser()
+    parser.feed(response.text)
+    summary = parser.description or " ".join(parser.first_paragraph.split())
+    return parser.title, summary[:MAX_SUMMARY_LENGTH]
+
+
+class ArticleCatalog:
+    """Catalogs of articles stored in a SQLite file, shared by the API, the workers and the app."""
+
+    def __init__(self, path: str | None = None):
+        path = path or catalog_db_path()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        # Catalog IDs being precomputed, and whether `precompute` was called again since
+        self._precomputing: dict[str, bool] = {}
+        self._precomputing_lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS catalogs (
+                    id TEXT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL
+                )
+                """
+            )
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(catalogs)")]
+            if "updated_at" not in columns:
+                # Catalogs created before their versions
+                conn.execute("ALTER TABLE catalogs ADD COLUMN updated_at REAL")
+                conn.execute("UPDATE catalogs SET updated_at = created_at")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS catalog_articles (
+                    catalog_id TEXT NOT NULL REFERENCES catalogs (id) ON DELETE CASCADE,
+                    url TEXT NOT NULL,
+                    title TEXT NOT NULL,
+                    summary TEXT,
+                    title_guessed INTEGER NOT NULL DEFAULT 0,
+                    fetched_at REAL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (catalog_id, url)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA foreign_keys = ON")
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _touch(conn: sqlite3.Connection, catalog_id: str) -> None:
+        """Change the version of a catalog, in the transaction changing its articles."""
+        # Always increasing, even if the clock isn't precise enough
+        conn.execute(
+            "UPDATE catalogs SET updated_at = MAX(?, updated_at + 0.000001) WHERE id = ?",
+            (time.time(), catalog_id),
+        )
+
+    def create(self, name: str, catalog_id: str | None = None) -> str:
+        """Create a catalog (if there is none with this ID yet) and return its ID."""
+        catalog_id = catalog_id or uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO catalogs (id, name, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                (catalog_id, name, time.time(), time.time()),
+            )
+        return catalog_id
+
+    def get(self, catalog_id: str) -> dict | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                SELECT id, name, created_at,
+                    (SELECT COUNT(*) FROM catalog_articles WHERE catalog_id = catalogs.id),
+                    (SELECT COUNT(*) FROM catalog_articles WHERE catalog_id = catalogs.id AND summary IS NULL)
+                FROM catalogs WHERE id = ?
+                """,
+                (catalog_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return {
+            "id": row[0],
+            "name": row[1],
+            "created_at": row[2],
+            "article_count": row[3],
+            "missing_summaries": row[4],
+        }
+
+    def delete(self, catalog_id: str) -> None:
+        with self._connect() as conn:
+            conn.execute("DELETE FROM catalogs WHERE id = ?", (catalog_id,))
+
+    def upsert(self, catalog_id: str, articles: list[dict]) -> tuple[int, int]:
+        """Add articles, or update those with the same URL. Returns the numbers of added and updated articles.
+
+        An article without a title gets one guessed from its URL. A missing
+        summary doesn't erase the one already known.
+        """
+        if not articles:
+            return 0, 0
+
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                known = {
+                    url
+                    for (url,) in conn.execute(
+                        "SELECT url FROM catalog_articles WHERE catalog_id = ?",
+                        (catalog_id,),
+                    )
+                }
+                rows = []
+                for article in articles:
+                    title = (article.get("title") or "").strip()
+                    rows.append(
+                        (
+                            catalog_id,
+                            article["url"],
+                            title or title_from_url(article["url"]),
+                            (article.get("summary") or "").strip() or None,
+                            0 if title else 1,
+                            now,
+                        )
+                    )
+                conn.executemany(
+                    """
+                    INSERT INTO catalog_articles (catalog_id, url, title, summary, title_guessed, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (catalog_id, url) DO UPDATE SET
+                        title = CASE WHEN excluded.title_guessed THEN title ELSE excluded.title END,
+                        title_guessed = title_guessed AND excluded.title_guessed,
+                        summary = COALESCE(excluded.summary, summary),
+                        updated_at = excluded.updated_at
+                    """,
+                    rows,
+                )
+                self._touch(conn, catalog_id)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+        urls = {article["url"] for article in articles}
+        added = len(urls - known)
+        return added, len(urls) - added
+
+    def replace(self, catalog_id: str, articles: list[dict]) -> None:
+        """Make `articles` the content of the catalog."""
+        self.upsert(catalog_id, articles)
+        self.remove(
+            catalog_id,
+            list(
+                {article["url"] for article in self.articles(catalog_id)}
+                - {article["url"] for article in articles}
+            ),
+        )
+
+    def remove(self, catalog_id: str, urls: list[str]) -> None:
+        if not urls:
+            return
+
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.executemany(
+                    "DELETE FROM catalog_articles WHERE catalog_id = ? AND url = ?",
+                    [(catalog_id, url) for url in urls],
+                )
+                self._touch(conn, catalog_id)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def articles(
+        self, catalog_id: str, offset: int = 0, limit: int | None = None
+    ) -> list[dict]:
+        """Return the articles of a catalog, as expected by `generate_article`."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT url, title, summary FROM catalog_articles WHERE catalog_id = ? ORDER BY rowid LIMIT ? OFFSET ?",
+                (catalog_id, -1 if limit is None else limit, offset),
+            ).fetchall()
+        return [
+            {"title": title, "url": url} | ({"summary": summary} if summary else {})
+            for url, title, summary in rows
+        ]
+
+    def version(self, catalog_id: str) -> float | None:
+        """Version of a catalog, changing whenever an article is added, updated or removed.
+
+        None if there is no such catalog.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT updated_at FROM catalogs WHERE id = ?", (catalog_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def precompute(self, catalog_id: str, max_pages: int | None = None) -> int:
+        """Fetch the details of the articles missing a summary, and index the articles.
+
+        Each page is fetched once, even if it has no description. Returns the number
+        of pages fetched.
+
+        Only one precomputation of a catalog runs at a time in the process: a call
+        while one is running returns 0 right away, and the running one fetches the
+        articles added in the meantime too.
+        """
+        if not self._start_precompute(catalog_id):
+            return 0
+        return self._precompute(catalog_id, max_pages)
+
+    def precompute_in_background(self, catalog_id: str) -> None:
+        """Run `precompute` in a daemon thread, unless it's already running for the catalog."""
+        if self._start_precompute(catalog_id):
+            threading.Thread(
+                target=self._precompute, args=(catalog_id,), daemon=True
+            ).start()
+
+    def _start_precompute(self, catalog_id: str) -> bool:
+        """Register a precomputation of a catalog, or return False if one is running.
+
+        The running one is then told to look for new articles before it stops.
+        """
+        with self._precomputing_lock:
+            if catalog_id in self._precomputing:
+                self._precomputing[catalog_id] = True
+                return False
+            self._precomputing[catalog_id] = False
+            return True
+
+    def _precompute(self, catalog_id: str, max_pages: int | None = None) -> int:
+        fetched = 0
+        try:
+            while True:
+                rows = []
+                if max_pages is None or fetched < max_pages:
+                    with self._connect() as conn:
+                        rows = conn.execute(
+                            """
+                            SELECT url FROM catalog_articles
+                            WHERE catalog_id = ? AND fetched_at IS NULL AND (summary IS NULL OR title_guessed)
+                            ORDER BY rowid LIMIT ?
+                            """,
+                            (
+                                catalog_id,
+                                -1 if max_pages is None else max_pages - fetched,
+                            ),
+                        ).fetchall()
+
+                for (url,) in rows:
+                    self._fetch_details(catalog_id, url)
+                fetched += len(rows)
+                if rows:
+                    continue
+
+                get_article_index().add(self.articles(catalog_id))
+                with self._precomputing_lock:
+                    # Unless called again in the meantime, for new articles
+                    if not self._precomputing[catalog_id]:
+                        del self._precomputing[catalog_id]
+                        return fetched
+                    self._precomputing[catalog_id] = False
+        except BaseException:
+            with self._precomputing_lock:
+                del self._precomputing[catalog_id]
+            raise
+
+    def _fetch_details(self, catalog_id: str, url: str) -> None:
+        try:
+            title, summary = fetch_page_details(url)
+        except Exception as e:
+            logger.warning(f"Failed to fetch the details of {url}: {e}")
+            title, summary = "", ""
+
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    """
+                    UPDATE catalog_articles SET
+                        title = CASE WHEN title_guessed AND ? != '' THEN ? ELSE title END,
+                        title_guessed = title_guessed AND ? = '',
+                        summary = COALESCE(summary, NULLIF(?, '')),
+                        fetched_at = ?
+                    WHERE catalog_id = ? AND url = ?
+                    """,
+                    (title, title, title, summary, time.time(), catalog_id, url),
+                )
+                self._touch(conn, catalog_id)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+
+_article_catalog: ArticleCatalog | None = None
+_article_catalog_lock = threading.Lock()
+
+
+def get_article_catalog() -> ArticleCatalog:
+    """Return the article catalog shared by the whole process."""
+    global _article_catalog
+    with _article_catalog_lock:
+        if _article_catalog is None:
+            _article_catalog = ArticleCatalog()
+        return _article_catalog
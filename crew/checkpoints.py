@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+
+from pathvalidate import sanitize_filename
+
+
+def checkpoints_dir() -> str:
+    return os.environ.get("CHECKPOINTS_DIR", os.path.join("data", "checkpoints"))
+
+
+class CheckpointStore:
+    """Outputs of the completed stages of each run, stored as one JSON file per run.
+
+    A run is identified by a run ID chosen by the caller. The inputs of the run are
+    stored alongside the outputs, so that a run can't be resumed with different
+    inputs by mistake.
+    """
+
+    def __init__(self, directory: str | None = None):
+        self.directory = directory or checkpoints_dir()
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _path(self, run_id: str) -> str:
+        return os.path.join(self.directory, f"{sanitize_filename(run_id)}.json")
+
+    def _read(self, run_id: str) -> dict | None:
+        try:
+            with open(self._path(run_id), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write(self, run_id: str, checkpoint: dict) -> None:
+        # Write then rename, so that a crash never leaves a truncated file
+        path = self._path(run_id)
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, run_id: str, inputs: dict) -> dict[str, str]:
+        """Return the raw outputs of the completed stages of a run, by stage name."""
+        with self._lock:
+            checkpoint = self._read(run_id)
+
+        if checkpoint is None:
+            return {}
+
+        if checkpoint["inputs"] != inputs:
+            raise ValueError(
+                f"Run '{run_id}' was started with different inputs, it can't be resumed."
+            )
+
+        return checkpoint["outputs"]
+
+    def save(self, run_id: str, inputs: dict, stage: str, output: str) -> None:
+        with self._lock:
+            checkpoint = self._read(run_id) or {"inputs": inputs, "outputs": {}}
+            checkpoint["outputs"][stage] = output
+            self._write(run_id, checkpoint)
+
+    def delete(self, run_id: str) -> None:
+        with self._lock:
+            try:
+                os.remove(self._path(run_id))
+            except FileNotFoundError:
+                pass
+
+
+_checkpoint_store: CheckpointStore | None = None
+_checkpoint_store_lock = threading.Lock()
+
+
+def get_checkpoint_store() -> CheckpointStore:
+    """Return the checkpoint store shared by the whole process."""
+    global _checkpoint_store
+    with _checkpoint_store_lock:
+        if _checkpoint_store is None:
+            _checkpoint_store = CheckpointStore()
+        return _checkpoint_store
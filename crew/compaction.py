@@ -0,0 +1,215 @@
+"""Compaction of the texts given to the agents, to fit them in a token budget.
+
+The texts are first cleaned up (boilerplate sentences of the StackOverflow answers,
+code blocks repeated across texts), then, if they still don't fit, each text is
+cut to a fair share of the budget: the texts smaller than the share are kept
+whole, and the others keep their beginning, the remaining budget being split
+between them.
+"""
+
+import functools
+import logging
+import re
+
+from crewai import Task
+
+logger = logging.getLogger(__name__)
+
+FENCED_CODE_BLOCK = re.compile(r"(```.*?```)", re.DOTALL)
+
+# Sentences that don't bring any information to the agents
+BOILERPLATE = re.compile(
+    r"(?:^|(?<=[.!?]))\s*(?:"
+    r"hope (?:this|that|it) helps[^.!?\n]*"
+    r"|hth"
+    r"|good luck[^.!?\n]*"
+    r"|happy coding[^.!?\n]*"
+    r"|cheers"
+    r"|thanks? (?:you )?(?:in advance|for reading)[^.!?\n]*"
+    r"|(?:please )?(?:up-?vote|accept)[^.!?\n]*(?:answer|helpful|useful)[^.!?\n]*"
+    r"|if (?:you found )?this (?:answer )?(?:was |is )?(?:useful|helpful)[^.!?\n]*"
+    r")\s*[.!?]*",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+SEPARATOR = re.compile(r"-{5,}")
+
+# Below this, a truncated text would be useless
+MIN_SHARE = 50
+
+
+@functools.lru_cache(maxsize=1)
+def _encoding():
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads its vocabulary on first use (cached in TIKTOKEN_CACHE_DIR)
+        logger.warning(f"tiktoken unavailable ({e}), token counts are estimated")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of `text` with tiktoken, or estimate them if it's unavailable.
+
+    Claude's tokenizer isn't public, the counts of cl100k_base are close enough
+    to enforce budgets.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _split_blocks(text: str) -> list[str]:
+    """Split a markdown text in paragraphs and code blocks."""
+    blocks = []
+    for part in FENCED_CODE_BLOCK.split(text):
+        if part.startswith("```"):
+            blocks.append(part)
+        else:
+            blocks.extend(
+                block for block in re.split(r"\n\s*\n", part) if block.strip()
+            )
+    return blocks
+
+
+def _is_code(block: str) -> bool:
+    if block.startswith("```"):
+        return True
+    # Indented code blocks, as in the `body_markdown` of StackExchange
+    lines = [line for line in block.splitlines() if line.strip()]
+    return all(line.startswith(("    ", "\t")) for line in lines)
+
+
+def trim_boilerplate(text: str) -> str:
+    """Remove the courtesy sentences and shorten the separator lines."""
+    blocks = []
+    for block in _split_blocks(text.replace("\r\n", "\n")):
+        if not _is_code(block):
+            block = SEPARATOR.sub("---", block)
+            block = BOILERPLATE.sub("", block).strip()
+        if block:
+            blocks.append(block)
+    return "\n\n".join(blocks)
+
+
+def dedupe_code_blocks(texts: list[str]) -> list[str]:
+    """Replace the code blocks already seen, in the same text or a previous one."""
+    seen = set()
+    deduped = []
+    for text in texts:
+        blocks = []
+        for block in _split_blocks(text.replace("\r\n", "\n")):
+            if _is_code(block) and len(block) >= 40:
+                key = " ".join(block.split())
+                if key in seen:
+                    block = "(Same code as above.)"
+                seen.add(key)
+            blocks.append(block)
+        deduped.append("\n\n".join(blocks))
+    return deduped
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    """Keep the beginning of `text`, cut at a block or line boundary."""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    kept = []
+    used = 0
+    for block in _split_blocks(text):
+        size = count_tokens(block)
+        if used + size > max_tokens:
+            # Keep the first lines of the block if they fit
+            lines = []
+            for line in block.splitlines():
+                line_size = count_tokens(line) + 1
+                if used + line_size > max_tokens:
+                    break
+                lines.append(line)
+                used += line_size
+            if lines and block.startswith("```"):
+                lines.append("```")
+            if lines:
+                kept.append("\n".join(lines))
+            break
+        kept.append(block)
+        used += size
+
+    omitted = count_tokens(text) - used
+    kept.append(f"[... {omitted} tokens omitted]")
+    return "\n\n".join(kept)
+
+
+def fair_shares(sizes: list[int], budget: int) -> list[int]:
+    """Split `budget` between items of the given sizes ("water-filling").
+
+    The items smaller than an equal share get their size, and what they don't
+    use is split between the others.
+    """
+    shares = [0] * len(sizes)
+    remaining = budget
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining // len(pending)
+        i = pending[0]
+        if sizes[i] <= share:
+            shares[i] = sizes[i]
+            remaining -= sizes[i]
+            pending.pop(0)
+        else:
+            for i in pending:
+                shares[i] = share
+            break
+    return shares
+
+
+def fit_to_budget(texts: list[str], budget: int) -> list[str]:
+    """Compact `texts` so that together they take at most about `budget` tokens."""
+    texts = dedupe_code_blocks([trim_boilerplate(text) for text in texts])
+    sizes = [count_tokens(text) for text in texts]
+    if sum(sizes) <= budget:
+        return texts
+
+    shares = fair_shares(sizes, budget)
+    return [
+        text if size <= share else truncate(text, max(share, MIN_SHARE))
+        for text, size, share in zip(texts, sizes, shares)
+    ]
+
+
+def compact_context(
+    tasks: list[Task], budget: int, keep: list[Task] | None = None
+) -> list[Task]:
+    """Return copies of the context tasks, with outputs fitting in `budget` tokens.
+
+    The outputs of the tasks of `keep` (e.g. the article being revised) are never
+    altered: the other outputs share what they leave of the budget. The tasks are
+    returned unchanged if their outputs already fit.
+    """
+    kept = {id(task) for task in keep or []}
+    done = [task for task in tasks if task.output is not None]
+    raws = [task.output.raw for task in done]  # type: ignore
+    if sum(count_tokens(raw) for raw in raws) <= budget:
+        return tasks
+
+    cut = [i for i, task in enumerate(done) if id(task) not in kept]
+    kept_tokens = sum(count_tokens(raw) for i, raw in enumerate(raws) if i not in cut)
+    compacted = list(raws)
+    for i, raw in zip(
+        cut, fit_to_budget([raws[i] for i in cut], max(0, budget - kept_tokens))
+    ):
+        compacted[i] = raw
+    logger.info(
+        f"Compacted a context from {sum(map(count_tokens, raws))} to {sum(map(count_tokens, compacted))} tokens"
+    )
+    return [
+        task
+        if id(task) in kept
+        else task.model_copy(
+            update={"output": task.output.model_copy(update={"raw": raw})}  # type: ignore
+        )
+        for task, raw in zip(done, compacted)
+    ]
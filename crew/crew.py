@@ -1,11 +1,64 @@
-from typing import Callable, Dict
+import hashlib
+import json
+import logging
+from typing import Any, Callable, Dict
 
-from crewai import Crew, Process
 from langsmith import traceable
 from langchain_core.language_models.chat_models import BaseChatModel
 
 from .agents import CustomAgents
-from .tasks import CustomTasks
+from .article_index import select_link_candidates
+from .cancellation import (
+    CancelToken,
+    RunCancelled,
+    RunTimedOut,
+    cancellable,
+    check_cancelled,
+)
+from .checkpoints import get_checkpoint_store
+from .events import Listener, emit_agent_step, listen
+from .fast_search import format_answers, search_answers
+from .metrics import RunMetrics, get_metrics_store, track_run
+from .pipeline import Stage, run_pipeline
+from .routing import validate_output
+from .tasks import CustomTasks, format_articles_list
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of tokens of the outputs of previous tasks given to a stage. The
+# article being evaluated or revised is never cut (see `Stage.uncut_context`): the
+# other outputs share what it leaves of the budget. The linking stage is only given
+# the article, so it has no budget.
+CONTEXT_BUDGETS = {
+    "write": 6000,
+    "evaluation": 4000,
+    "revision": 8000,
+}
+
+# Number of existing articles given to the Linking Agent, the most relevant to the new article
+LINK_CANDIDATES = 20
+
+
+def generation_fingerprint(
+    topic: str, language: str, context: str = "", model: str = "", **options: Any
+) -> str:
+    """Hash of the parameters of a generation, identifying the requests of the same article.
+
+    Case and whitespace are ignored in the texts. `options` are the other parameters
+    changing the article (e.g. the catalog of the existing articles), JSON serializable.
+    """
+
+    def normalize(text: str | None) -> str:
+        return " ".join((text or "").lower().split())
+
+    parameters = {
+        "topic": normalize(topic),
+        "language": normalize(language),
+        "context": normalize(context),
+        "model": model,
+        "options": {key: value for key, value in options.items() if value},
+    }
+    return hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()
 
 
 @traceable
@@ -16,15 +69,27 @@ def generate_article(
     context: str = "",
     existing_articles: list[Dict] | None = None,
     global_step_callback: Callable | None = None,
+    run_id: str | None = None,
+    metrics: RunMetrics | None = None,
+    on_event: Listener | None = None,
+    cancel_token: CancelToken | None = None,
+    stage_llms: Dict[str, BaseChatModel] | None = None,
+    fast_search: bool = False,
 ) -> str:
     """Kickoff the crew to generate an article based on the given topic and language.
 
     Args:
-        llm : The language model to be used for generating the article.
+        llm : The language model to be used for generating the article, by the stages without a model in `stage_llms`.
         topic : The topic for the article.
         language : The language of the article. Defaults to "FR". Can be any language supported by the model. Format not specified : "FR" / "French" / "Français" ... all work.
-        existing_articles : Existing articles to link to. Defaults to None.
+        existing_articles : Existing articles to link to, with a "title", a "url" and optionally a "summary". Only the `LINK_CANDIDATES` most relevant to the new article are given to the Linking Agent. Defaults to None.
         global_step_callback : Callback to be executed after each step for every agents execution.
+        run_id : If given, the output of each stage is checkpointed under this ID until the article is generated, and calling again with the same ID resumes the run from the first incomplete stage.
+        metrics : If given, filled with the metrics of the run (latency and tokens per stage, tool calls, cache hits...). Use `metrics.summary()` to get them as JSON.
+        on_event : Called with the type and data of each progress event (stages started and finished, tool calls, LLM tokens...), see `crew.events`.
+        cancel_token : If given, the generation raises `RunCancelled` as soon as the token is cancelled, or `RunTimedOut` once its deadline has passed. The completed stages are still checkpointed.
+        stage_llms : Language models of some stages, by stage name (see `crew.routing.get_stage_llm_clients`). A stage whose output fails its validation is run again once with `llm`, even if it already ran with it.
+        fast_search : Search the StackOverflow answers in code, without the search agent (see `crew.fast_search`). The agent still runs if no answer is found.
     """
 
     if not topic:
@@ -33,21 +98,31 @@ def generate_article(
     if not language:
         raise ValueError("Empty language")
 
+    stage_llms = stage_llms or {}
+
     # Initialize custom agents and tasks
     agents = CustomAgents(default_llm=llm)
     tasks = CustomTasks()
 
-    # Create agents
-    search_agent = agents.stackoverflow_search_agent()
-    report_agent = agents.stackoverflow_report_agent()
-    reliable_sources_agent = agents.reliable_sources_agent()
-    writer_agent = agents.blog_writer_agent()
-    evaluator_agent = agents.evaluator_agent()
-    internal_linking_agent = agents.internal_linking_agent()
+    # Create agents. The writing and the revision have their own writer, as they
+    # may use different models.
+    search_agent = agents.stackoverflow_search_agent(llm=stage_llms.get("search"))
+    report_agent = agents.stackoverflow_report_agent(llm=stage_llms.get("report"))
+    reliable_sources_agent = agents.reliable_sources_agent(
+        llm=stage_llms.get("reliable_sources")
+    )
+    writer_agent = agents.blog_writer_agent(llm=stage_llms.get("write"))
+    reviser_agent = agents.blog_writer_agent(llm=stage_llms.get("revision"))
+    evaluator_agent = agents.evaluator_agent(llm=stage_llms.get("evaluation"))
+    internal_linking_agent = agents.internal_linking_agent(
+        llm=stage_llms.get("internal_linking")
+    )
 
     # Create tasks
     search_task = tasks.search_stackoverflow_task(agent=search_agent)
-    report_task = tasks.generate_stackoverflow_technical_report(agent=report_agent)
+    report_task = tasks.generate_stackoverflow_technical_report(
+        agent=report_agent, context_tasks=[search_task]
+    )
     reliable_sources_task = tasks.find_reliable_sources_task(
         agent=reliable_sources_agent
     )
@@ -57,7 +132,7 @@ def generate_article(
     )
     evaluation_task = tasks.evaluation_task(evaluator_agent, context_tasks=[write_task])
     revision_task = tasks.revision_task(
-        agent=writer_agent,
+        agent=reviser_agent,
         context_tasks=[
             reliable_sources_task,
             write_task,
@@ -68,40 +143,120 @@ def generate_article(
     internal_linking_task = (
         tasks.link_existing_articles_task(
             agent=internal_linking_agent,
-            existing_articles=existing_articles,
+            context_tasks=[revision_task],
         )
         if existing_articles is not None and len(existing_articles) > 0
         else None
     )
 
-    agents_list = [
-        search_agent,
-        report_agent,
-        reliable_sources_agent,
-        writer_agent,
-        evaluator_agent,
-        internal_linking_agent,
-    ]
-
-    tasks_list = [
-        search_task,
-        report_task,
-        reliable_sources_task,
-        write_task,
-        evaluation_task,
-        revision_task,
+    # The reliable sources don't depend on the StackOverflow research, so both
+    # branches run concurrently and join at the writing stage.
+    stages = [
+        Stage(
+            "search",
+            search_task,
+            run=(lambda: format_answers(search_answers(topic)))
+            if fast_search
+            else None,
+        ),
+        Stage("report", report_task, depends_on=["search"]),
+        Stage("reliable_sources", reliable_sources_task),
+        Stage("write", write_task, depends_on=["report", "reliable_sources"]),
+        Stage(
+            "evaluation",
+            evaluation_task,
+            depends_on=["write"],
+            uncut_context=[write_task],
+        ),
+        Stage(
+            "revision",
+            revision_task,
+            depends_on=["reliable_sources", "write", "evaluation"],
+            uncut_context=[write_task],
+        ),
     ]
 
     if internal_linking_task is not None:
-        tasks_list.append(internal_linking_task)
+        assert all(
+            "title" in article and "url" in article for article in existing_articles
+        ), "Each article should have a title and a URL key."
 
-    crew = Crew(
-        agents=agents_list,
-        tasks=tasks_list,
-        process=Process.sequential,
-        step_callback=global_step_callback,
-    )
+        def link_candidates():
+            # Selected once the article is written, to match what it ended up covering
+            article = f"{topic}\n\n{revision_task.output.raw}"
+            candidates = select_link_candidates(
+                existing_articles, article, LINK_CANDIDATES
+            )
+            return {"articles_list": format_articles_list(candidates)}
+
+        stages.append(
+            Stage(
+                "internal_linking",
+                internal_linking_task,
+                depends_on=["revision"],
+                extra_inputs=link_candidates,
+                validate=lambda output: validate_output(
+                    "internal_linking", output, article=revision_task.output.raw
+                ),
+            )
+        )
+
+    for stage in stages:
+        stage.context_budget = CONTEXT_BUDGETS.get(stage.name)
+        # A stage already running with `llm` is run again with it, once
+        stage.fallback_llm = llm
+        if stage.validate is None:
+            stage.validate = lambda output, name=stage.name: validate_output(
+                name, output
+            )
+
+    inputs = {"topic": topic, "language": language, "context": context}
+
+    completed = None
+    on_stage_done = None
+    if run_id is not None:
+        checkpoints = get_checkpoint_store()
+        completed = checkpoints.load(run_id, inputs)
+
+        def on_stage_done(stage, output):
+            checkpoints.save(run_id, inputs, stage, output.raw)
+
+    def step_callback(step_output):
+        check_cancelled()
+        emit_agent_step(step_output)
+        if global_step_callback is not None:
+            global_step_callback(step_output)
+
+    run_metrics = metrics if metrics is not None else RunMetrics()
+    status = "failed"
+    try:
+        with (
+            track_run(run_metrics),
+            listen(on_event or (lambda type, data: None)),
+            cancellable(cancel_token or CancelToken()),
+        ):
+            outputs = run_pipeline(
+                stages,
+                inputs=inputs,
+                step_callback=step_callback,
+                completed=completed,
+                on_stage_done=on_stage_done,
+            )
+        status = "succeeded"
+    except RunTimedOut:
+        status = "timed_out"
+        raise
+    except RunCancelled:
+        status = "cancelled"
+        raise
+    finally:
+        # The metrics must never make a generation fail
+        try:
+            get_metrics_store().add_run(run_metrics, status)
+        except Exception:
+            logger.exception("Failed to store the metrics of the run")
+
+    if run_id is not None:
+        checkpoints.delete(run_id)
 
-    return crew.kickoff(
-        inputs={"topic": topic, "language": language, "context": context}
-    ).raw
+    return outputs[stages[-1].name].raw
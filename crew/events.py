@@ -0,0 +1,111 @@
+"""Progress events of the article generations.
+
+A listener made current with `listen` receives the events emitted during the
+generation, as `(type, data)` with `data` JSON serializable:
+
+- "stage_started" / "stage_finished" / "stage_failed": {"stage"}, plus the
+  "output" of the stage when it's finished, or the "error" when it failed;
+- "stage_fallback": {"stage", "reason"}, when the output of a stage failed its
+  validation and the stage is run again: with the main model (see
+  `crew.routing`), or by its agent if the output was computed in code (see
+  `crew.fast_search`);
+- "tool_call": {"stage", "tool", "input", "observation"}, for each step of an
+  agent using a tool;
+- "token": {"stage", "text"}, for each chunk generated by a streaming LLM
+  (see `AIModel.to_client(streaming=True)`).
+
+Like the metrics, the listener is stored in a context variable, so that it
+follows the stages into the pipeline threads.
+"""
+
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Iterator
+
+from langchain_core.agents import AgentAction, AgentStep
+from langchain_core.callbacks import BaseCallbackHandler
+
+logger = logging.getLogger(__name__)
+
+Listener = Callable[[str, dict], None]
+
+# Tool observations can be whole StackOverflow answers
+MAX_OBSERVATION_LENGTH = 1000
+
+_current_listener: ContextVar[Listener | None] = ContextVar(
+    "current_listener", default=None
+)
+_current_stage: ContextVar[str | None] = ContextVar("current_event_stage", default=None)
+
+
+@contextmanager
+def listen(listener: Listener) -> Iterator[None]:
+    """Send the events emitted until the block exits to `listener`."""
+    token = _current_listener.set(listener)
+    try:
+        yield
+    finally:
+        _current_listener.reset(token)
+
+
+def emit(type: str, **data: Any) -> None:
+    """Send an event to the current listener, if any."""
+    listener = _current_listener.get()
+    if listener is None:
+        return
+
+    stage = _current_stage.get()
+    if stage is not None:
+        data.setdefault("stage", stage)
+
+    # A failing listener must not make the generation fail
+    try:
+        listener(type, data)
+    except Exception:
+        logger.exception(f"Failed to handle a {type} event")
+
+
+@contextmanager
+def stage_events(stage: str) -> Iterator[None]:
+    """Emit the start and end of a stage, and attribute the events of the block to it."""
+    token = _current_stage.set(stage)
+    emit("stage_started")
+    try:
+        yield
+    except Exception as e:
+        emit("stage_failed", error=str(e))
+        raise
+    finally:
+        _current_stage.reset(token)
+
+
+def emit_agent_step(step_output: Any) -> None:
+    """Emit the tool calls of an agent step, as given to the crewAI step callbacks."""
+    if not isinstance(step_output, list):
+        # The final answer of the agent, emitted with the end of the stage
+        return
+
+    for step in step_output:
+        if isinstance(step, AgentStep):
+            action, observation = step.action, step.observation
+        elif isinstance(step, tuple) and len(step) == 2:
+            action, observation = step
+        else:
+            continue
+
+        if isinstance(action, AgentAction):
+            emit(
+                "tool_call",
+                tool=action.tool,
+                input=action.tool_input,
+                observation=str(observation)[:MAX_OBSERVATION_LENGTH],
+            )
+
+
+class EventsCallbackHandler(BaseCallbackHandler):
+    """LangChain callback emitting the tokens generated by a streaming LLM."""
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if token:
+            emit("token", text=token)
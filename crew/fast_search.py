@@ -0,0 +1,94 @@
+"""Search of the StackOverflow answers of a topic, without an LLM.
+
+The search agent turns the topic into a few queries, runs them with the
+SearchStackOverflow tool and copies the best answer URLs of the results, each
+step being an LLM turn of several seconds. `search_answers` does the same in
+code: the queries are made from the topic with templates, run concurrently, and
+their results are merged and ranked (see `crew.ranking`).
+
+The queries aren't translated, so a topic in another language than English may
+find fewer answers. If none is found, the search agent takes over (see the `run`
+of `crew.pipeline.Stage`).
+"""
+
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from crew.cancellation import RunCancelled
+from crew.events import emit
+from crew.metrics import track_tool
+from crew.ranking import RankedResult
+from crew.registry import get_tool
+from crew.tools import SearchStackOverflowTool
+
+logger = logging.getLogger(__name__)
+
+QUERY_TEMPLATES = ("{topic}", "{topic} example", "how to {topic}")
+
+# Number of answers given to the report stage, like the search agent is asked to
+MAX_ANSWERS = 5
+
+# Added to the score of a question for each other query that found it
+QUERY_AGREEMENT_BONUS = 1.0
+
+
+def search_queries(topic: str) -> list[str]:
+    topic = " ".join(topic.split())
+    return list(dict.fromkeys(t.format(topic=topic) for t in QUERY_TEMPLATES))
+
+
+def _search(tool: SearchStackOverflowTool, query: str) -> list[RankedResult]:
+    with track_tool(tool.name):
+        ranked = tool.search(query)
+    emit(
+        "tool_call",
+        tool=tool.name,
+        input=query,
+        observation="\n".join(r.result.get("title", "") for r in ranked),
+    )
+    return ranked
+
+
+def search_answers(topic: str, max_answers: int = MAX_ANSWERS) -> list[RankedResult]:
+    """Return the best StackOverflow results of `topic` with an answer, best first."""
+    tool = get_tool(SearchStackOverflowTool)
+    queries = search_queries(topic)
+
+    searches = []
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = [
+            # Copy the context so that the metrics and the cancellation follow the searches
+            executor.submit(contextvars.copy_context().run, _search, tool, query)
+            for query in queries
+        ]
+        for query, future in zip(queries, futures):
+            try:
+                searches.append(future.result())
+            except RunCancelled:
+                raise
+            except Exception as e:
+                logger.warning(f"StackOverflow search failed for '{query}': {e}")
+
+    merged: dict[str, RankedResult] = {}
+    for ranked in searches:
+        for result in ranked:
+            link = result.result.get("link", "")
+            known = merged.get(link)
+            if known is None:
+                merged[link] = RankedResult(
+                    result.result, result.question, result.score
+                )
+            else:
+                known.score = max(known.score, result.score) + QUERY_AGREEMENT_BONUS
+
+    ranked = sorted(merged.values(), key=lambda r: r.score, reverse=True)
+    return [r for r in ranked if r.best_answer_url][:max_answers]
+
+
+def format_answers(ranked: list[RankedResult]) -> str:
+    """Format the results as the output of the search task: the best answer URLs."""
+    return "\n".join(
+        f"- {r.best_answer_url} (answer to: {r.result.get('title', '')})"
+        for r in ranked
+    )
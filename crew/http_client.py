@@ -0,0 +1,204 @@
+import logging
+import random
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from crew import cancellation
+from crew.metrics import record_http_retry
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Methods whose requests can be sent twice without side effects
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+STACKEXCHANGE_HOST = "api.stackexchange.com"
+
+
+class HTTPClient:
+    """Connection-pooled HTTP client with timeouts and retries.
+
+    All the requests share a single `requests.Session`, so the connections (and
+    their TLS handshakes) are reused across calls and threads. Each host gets at most
+    `max_connections_per_host` simultaneous connections, further requests wait for a
+    free one.
+
+    Failed requests (connection errors, timeouts, HTTP 429 and 5xx) are retried with
+    a jittered exponential backoff, honoring the `Retry-After` header. A failed POST
+    may have been processed anyway, so by default it's only retried when it surely
+    wasn't: the connection couldn't be made, or the server answered HTTP 429. The `backoff`
+    field of StackExchange responses is honored too: no request is sent to the
+    host before the requested delay has elapsed.
+
+    In a cancellable run (see `crew.cancellation`), the requests are aborted once
+    the run is cancelled, and their timeout doesn't go past its deadline.
+    """
+
+    def __init__(
+        self,
+        timeout: float | tuple[float, float] = (5, 60),
+        max_retries: int = 4,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30,
+        max_connections_per_host: int = 10,
+    ):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=max_connections_per_host,
+            pool_block=True,
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._not_before: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _wait_for_host(self, host: str) -> None:
+        with self._lock:
+            delay = self._not_before.get(host, 0) - time.time()
+        if delay > 0:
+            logger.info(f"Waiting {delay:.1f}s before calling {host} again")
+            cancellation.sleep(delay)
+
+    def _delay_host(self, host: str, delay: float) -> None:
+        with self._lock:
+            self._not_before[host] = max(
+                self._not_before.get(host, 0), time.time() + delay
+            )
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter" exponential backoff
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def _timeout(self, timeout: float | tuple[float, float]):
+        """Cut the timeout of a request to the time left before the deadline of the run."""
+        token = cancellation.current_token()
+        remaining = token.remaining() if token is not None else None
+        if remaining is None or timeout is None:
+            return timeout
+        if isinstance(timeout, tuple):
+            return tuple(min(t, remaining) for t in timeout)
+        return min(timeout, remaining)
+
+    def _stackexchange_delay(self, response: requests.Response) -> float | None:
+        """Return the delay requested by a StackExchange response, if any."""
+        if urlsplit(response.url).hostname != STACKEXCHANGE_HOST:
+            return None
+        try:
+            body = response.json()
+        except ValueError:
+            return None
+        if not isinstance(body, dict):
+            return None
+
+        if body.get("error_name") == "throttle_violation":
+            # "too many requests from this IP, more requests available in 82 seconds"
+            match = re.search(r"(\d+) seconds", body.get("error_message", ""))
+            return float(match.group(1)) if match else self.backoff_max
+
+        backoff = body.get("backoff")
+        return float(backoff) if backoff else None
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        retry_non_idempotent: bool = False,
+        **kwargs,
+    ) -> requests.Response:
+        """Send a request, retrying it on transient failures.
+
+        Accepts the same arguments as `requests.request`. The response of the last
+        attempt is returned even if its status is an error.
+
+        Args:
+            retry_non_idempotent : Retry the POST and PATCH requests on all the transient
+                failures too, for the requests that can safely be sent twice (e.g. a search).
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc
+        idempotent = retry_non_idempotent or method.upper() in IDEMPOTENT_METHODS
+
+        attempt = 0
+        while True:
+            cancellation.check_cancelled()
+            self._wait_for_host(host)
+            try:
+                response = self.session.request(
+                    method,
+                    url,
+                    **{**kwargs, "timeout": self._timeout(kwargs["timeout"])},
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.max_retries or not (idempotent or _not_sent(e)):
+                    raise
+                delay = self._backoff(attempt)
+                reason = str(e)
+            else:
+                stackexchange_delay = self._stackexchange_delay(response)
+                throttled = (
+                    response.status_code == 400 and stackexchange_delay is not None
+                )
+                if stackexchange_delay:
+                    self._delay_host(host, stackexchange_delay)
+
+                retryable = response.status_code in RETRY_STATUSES or throttled
+                if not idempotent:
+                    # The server refused to process the request
+                    retryable = response.status_code == 429 or throttled
+                if not retryable or attempt >= self.max_retries:
+                    return response
+
+                delay = self._backoff(attempt)
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                reason = f"HTTP {response.status_code}"
+
+            attempt += 1
+            record_http_retry(host)
+            logger.warning(
+                f"{method} {host} failed ({reason}), retry {attempt}/{self.max_retries} in {delay:.1f}s"
+            )
+            cancellation.sleep(delay)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+def _not_sent(error: Exception) -> bool:
+    """Whether a request failed while connecting, before anything was sent."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, "reason", None)
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+_http_client: HTTPClient | None = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> HTTPClient:
+    """Return the HTTP client shared by the whole process."""
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = HTTPClient()
+        return _http_client
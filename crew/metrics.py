@@ -0,0 +1,366 @@
+"""Instrumentation of the article generations.
+
+The metrics of a generation (latency and token counts of each stage, latency of
+each tool, cache hits and HTTP retries) are collected in a `RunMetrics`, made
+current with `track_run`. The `record_*` functions and the `track_*` context
+managers update the current run, and do nothing outside of one.
+
+Once a run is over, its metrics are added to the `MetricsStore`, a SQLite file
+shared by every process, which renders them in the Prometheus text format.
+"""
+
+import functools
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+
+
+def metrics_db_path() -> str:
+    return os.environ.get("METRICS_DB_PATH", os.path.join("data", "metrics.sqlite"))
+
+
+class RunMetrics:
+    """Metrics of a single article generation."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.duration: float | None = None
+        self.stages: dict[str, dict] = {}
+        self.tools: dict[str, dict] = {}
+        self.caches: dict[str, dict] = {}
+        self.http_retries: dict[str, int] = {}
+
+        # Stages run concurrently
+        self._lock = threading.Lock()
+
+    def _stage(self, stage: str) -> dict:
+        return self.stages.setdefault(
+            stage,
+            {"duration": 0.0, "llm_calls": 0, "input_tokens": 0, "output_tokens": 0},
+        )
+
+    def add_stage_duration(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self._stage(stage)["duration"] += seconds
+
+    def add_llm_call(self, stage: str, input_tokens: int, output_tokens: int) -> None:
+        with self._lock:
+            metrics = self._stage(stage)
+            metrics["llm_calls"] += 1
+            metrics["input_tokens"] += input_tokens
+            metrics["output_tokens"] += output_tokens
+
+    def add_tool_call(self, tool: str, seconds: float, failed: bool) -> None:
+        with self._lock:
+            metrics = self.tools.setdefault(
+                tool, {"calls": 0, "errors": 0, "duration": 0.0}
+            )
+            metrics["calls"] += 1
+            metrics["errors"] += int(failed)
+            metrics["duration"] += seconds
+
+    def add_cache_lookups(self, cache: str, hits: int, misses: int) -> None:
+        with self._lock:
+            metrics = self.caches.setdefault(cache, {"hits": 0, "misses": 0})
+            metrics["hits"] += hits
+            metrics["misses"] += misses
+
+    def add_http_retry(self, host: str) -> None:
+        with self._lock:
+            self.http_retries[host] = self.http_retries.get(host, 0) + 1
+
+    def finish(self) -> None:
+        self.duration = time.time() - self.started_at
+
+    def summary(self) -> dict:
+        """Return the metrics as a JSON serializable dict."""
+        with self._lock:
+            stages = {name: dict(metrics) for name, metrics in self.stages.items()}
+            return {
+                "duration": self.duration,
+                "input_tokens": sum(s["input_tokens"] for s in stages.values()),
+                "output_tokens": sum(s["output_tokens"] for s in stages.values()),
+                "stages": stages,
+                "tools": {name: dict(metrics) for name, metrics in self.tools.items()},
+                "caches": {
+                    name: dict(metrics) for name, metrics in self.caches.items()
+                },
+                "http_retries": dict(self.http_retries),
+            }
+
+
+_current_run: ContextVar[RunMetrics | None] = ContextVar("current_run", default=None)
+_current_stage: ContextVar[str | None] = ContextVar("current_stage", default=None)
+
+
+def current_run() -> RunMetrics | None:
+    return _current_run.get()
+
+
+@contextmanager
+def track_run(metrics: RunMetrics | None = None) -> Iterator[RunMetrics]:
+    """Make `metrics` (or new metrics) the current run until the block exits."""
+    metrics = metrics if metrics is not None else RunMetrics()
+    token = _current_run.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_run.reset(token)
+        metrics.finish()
+
+
+@contextmanager
+def track_stage(stage: str) -> Iterator[None]:
+    """Time a stage, and attribute the LLM calls made in the block to it."""
+    token = _current_stage.set(stage)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+        run = current_run()
+        if run is not None:
+            run.add_stage_duration(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def track_tool(tool: str) -> Iterator[None]:
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        run = current_run()
+        if run is not None:
+            run.add_tool_call(tool, time.perf_counter() - start, failed)
+
+
+def tracked_tool_run(run_method):
+    """Decorate the `_run` method of a tool to record its calls."""
+
+    @functools.wraps(run_method)
+    def wrapper(self, *args, **kwargs):
+        with track_tool(self.name):
+            return run_method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def record_cache_lookups(cache: str, hits: int, misses: int) -> None:
+    run = current_run()
+    if run is not None:
+        run.add_cache_lookups(cache, hits, misses)
+
+
+def record_http_retry(host: str) -> None:
+    run = current_run()
+    if run is not None:
+        run.add_http_retry(host)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """LangChain callback counting the LLM calls and tokens of the current stage.
+
+    Responses served by `crew.cache.LLMCache` are flagged as cached and count as
+    calls, but not as tokens.
+    """
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        run = current_run()
+        if run is None:
+            return
+
+        input_tokens = output_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if message is None or message.response_metadata.get("cached"):
+                    continue
+                usage = getattr(message, "usage_metadata", None) or {}
+                input_tokens += usage.get("input_tokens", 0)
+                output_tokens += usage.get("output_tokens", 0)
+
+        run.add_llm_call(_current_stage.get() or "unknown", input_tokens, output_tokens)
+
+
+# Name, type and help of the Prometheus metrics
+METRICS = {
+    "article_generations_total": ("counter", "Article generations, by status."),
+    "article_generation_duration_seconds": (
+        "summary",
+        "Duration of the article generations.",
+    ),
+    "article_stage_duration_seconds": ("summary", "Duration of the pipeline stages."),
+    "article_llm_calls_total": ("counter", "LLM calls, by stage."),
+    "article_llm_tokens_total": ("counter", "LLM tokens, by stage and direction."),
+    "article_tool_duration_seconds": ("summary", "Duration of the tool calls."),
+    "article_tool_errors_total": ("counter", "Tool calls that raised an error."),
+    "article_cache_lookups_total": ("counter", "Cache lookups, by cache and result."),
+    "article_http_retries_total": ("counter", "Retried HTTP requests, by host."),
+}
+
+
+def _samples(summary: dict, status: str) -> list[tuple[str, dict, float]]:
+    samples = [
+        ("article_generations_total", {"status": status}, 1),
+        ("article_generation_duration_seconds_sum", {}, summary["duration"] or 0),
+        ("article_generation_duration_seconds_count", {}, 1),
+    ]
+    for stage, metrics in summary["stages"].items():
+        labels = {"stage": stage}
+        samples += [
+            ("article_stage_duration_seconds_sum", labels, metrics["duration"]),
+            ("article_stage_duration_seconds_count", labels, 1),
+            ("article_llm_calls_total", labels, metrics["llm_calls"]),
+            (
+                "article_llm_tokens_total",
+                {**labels, "direction": "input"},
+                metrics["input_tokens"],
+            ),
+            (
+                "article_llm_tokens_total",
+                {**labels, "direction": "output"},
+                metrics["output_tokens"],
+            ),
+        ]
+    for tool, metrics in summary["tools"].items():
+        labels = {"tool": tool}
+        samples += [
+            ("article_tool_duration_seconds_sum", labels, metrics["duration"]),
+            ("article_tool_duration_seconds_count", labels, metrics["calls"]),
+            ("article_tool_errors_total", labels, metrics["errors"]),
+        ]
+    for cache, metrics in summary["caches"].items():
+        samples += [
+            (
+                "article_cache_lookups_total",
+                {"cache": cache, "result": "hit"},
+                metrics["hits"],
+            ),
+            (
+                "article_cache_lookups_total",
+                {"cache": cache, "result": "miss"},
+                metrics["misses"],
+            ),
+        ]
+    for host, retries in summary["http_retries"].items():
+        samples.append(("article_http_retries_total", {"host": host}, retries))
+
+    return samples
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsStore:
+    """Totals of the metrics of every run, stored in a SQLite file.
+
+    The generations run in the worker processes while the metrics are served by
+    the API processes, so the totals are kept in a file they all share.
+    """
+
+    def __init__(self, path: str | None = None):
+        path = path or metrics_db_path()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS metrics (
+                    name TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    value REAL NOT NULL,
+                    PRIMARY KEY (name, labels)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add_run(self, metrics: RunMetrics, status: str) -> None:
+        """Add the metrics of a finished run to the totals."""
+        samples = _samples(metrics.summary(), status)
+        with self._connect() as conn:
+            conn.executemany(
+                """
+                INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?)
+                ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value
+                """,
+                [
+                    (name, json.dumps(labels, sort_keys=True), value)
+                    for name, labels, value in samples
+                ],
+            )
+
+    def totals(self) -> list[tuple[str, dict, float]]:
+        """Return the totals, as (name, labels, value) samples."""
+        with self._connect() as conn:
+            rows = conn.execute("SELECT name, labels, value FROM metrics").fetchall()
+        return [(name, json.loads(labels), value) for name, labels, value in rows]
+
+    def render_prometheus(self) -> str:
+        """Return the totals in the Prometheus text exposition format."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT name, labels, value FROM metrics ORDER BY name, labels"
+            ).fetchall()
+
+        lines = []
+        for family, (kind, help) in METRICS.items():
+            family_rows = [
+                row
+                for row in rows
+                if row[0] == family or row[0] in (f"{family}_sum", f"{family}_count")
+            ]
+            if not family_rows:
+                continue
+
+            lines.append(f"# HELP {family} {help}")
+            lines.append(f"# TYPE {family} {kind}")
+            for name, labels, value in family_rows:
+                label_string = ",".join(
+                    f'{key}="{_escape_label(label)}"'
+                    for key, label in json.loads(labels).items()
+                )
+                value = int(value) if value.is_integer() else value
+                if label_string:
+                    lines.append(f"{name}{{{label_string}}} {value}")
+                else:
+                    lines.append(f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+_metrics_store: MetricsStore | None = None
+_metrics_store_lock = threading.Lock()
+
+
+def get_metrics_store() -> MetricsStore:
+    """Return the metrics store shared by the whole process."""
+    global _metrics_store
+    with _metrics_store_lock:
+        if _metrics_store is None:
+            _metrics_store = MetricsStore()
+        return _metrics_store
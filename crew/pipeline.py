@@ -0,0 +1,226 @@
+import contextvars
+import logging
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Dict
+
+from crewai import Crew, Process, Task
+from crewai.tasks.task_output import TaskOutput
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from .cancellation import check_cancelled, current_token
+from .compaction import compact_context
+from .events import emit, stage_events
+from .metrics import track_stage
+from .registry import agent_llm
+
+logger = logging.getLogger(__name__)
+
+# How often the pipeline checks whether the run was cancelled, while stages are running
+CANCELLATION_POLL_INTERVAL = 1.0
+
+
+@dataclass
+class Stage:
+    """A task of the pipeline, and the names of the stages it depends on.
+
+    If `context_budget` is set, the outputs of the context tasks are compacted to
+    about this number of tokens before being given to the task, except those of
+    the tasks of `uncut_context`, which are given whole.
+
+    `extra_inputs` computes inputs of the task that depend on the outputs of the
+    previous stages. It's called when the stage starts, and its result is merged
+    into the inputs of the pipeline.
+
+    `run` computes the output of the task in code, instead of its agent.
+
+    `validate` returns why the output of the task is invalid, or None if it's
+    valid. An invalid output is produced again: by the agent if the output was
+    computed by `run`, with `fallback_llm` if it's set otherwise (which can be
+    the LLM the agent already used: the output is produced again once). If there
+    is nothing to fall back to, or if the new output is invalid too, it's kept
+    as is.
+    """
+
+    name: str
+    task: Task
+    depends_on: list[str] = field(default_factory=list)
+    context_budget: int | None = None
+    uncut_context: list[Task] = field(default_factory=list)
+    extra_inputs: Callable[[], Dict] | None = None
+    run: Callable[[], str] | None = None
+    validate: Callable[[str], str | None] | None = None
+    fallback_llm: BaseChatModel | None = None
+
+
+def _set_output(task: Task, raw: str) -> None:
+    # The output is set on the task, as it's read from there by the tasks using it as context
+    task.output = TaskOutput(
+        description=task.description,
+        raw=raw,
+        agent=task.agent.role if task.agent else "None",
+    )
+
+
+def _kickoff(task: Task, inputs: Dict, step_callback: Callable | None) -> None:
+    crew = Crew(
+        agents=[task.agent],
+        tasks=[task],
+        process=Process.sequential,
+        step_callback=step_callback,
+    )
+    crew.kickoff(inputs=inputs)
+    assert task.output is not None
+
+
+def _run_stage(
+    stage: Stage, inputs: Dict, step_callback: Callable | None
+) -> TaskOutput:
+    check_cancelled()
+
+    # Each stage runs in its own single-task crew. The outputs of the stages it
+    # depends on are given through the `context` of the task.
+    if stage.context_budget is not None and stage.task.context:
+        stage.task.context = compact_context(
+            stage.task.context, stage.context_budget, keep=stage.uncut_context
+        )
+
+    if stage.extra_inputs is not None:
+        inputs = {**inputs, **stage.extra_inputs()}
+
+    with track_stage(stage.name), stage_events(stage.name):
+        if stage.run is not None:
+            _set_output(stage.task, stage.run())
+        else:
+            _kickoff(stage.task, inputs, step_callback)
+
+        problem = stage.validate(stage.task.output.raw) if stage.validate else None
+        if problem is not None:
+            agent = stage.task.agent
+            if stage.run is not None:
+                logger.warning(
+                    f"Invalid output of stage '{stage.name}', running its agent: {problem}"
+                )
+                emit("stage_fallback", reason=problem)
+                _kickoff(stage.task, inputs, step_callback)
+                problem = stage.validate(stage.task.output.raw)
+            elif stage.fallback_llm is not None:
+                logger.warning(
+                    f"Invalid output of stage '{stage.name}', running it again with the fallback LLM: {problem}"
+                )
+                emit("stage_fallback", reason=problem)
+                agent.llm = agent_llm(stage.fallback_llm)
+                _kickoff(stage.task, inputs, step_callback)
+                problem = stage.validate(stage.task.output.raw)
+
+            if problem is not None:
+                logger.warning(f"Invalid output of stage '{stage.name}': {problem}")
+
+        emit("stage_finished", output=stage.task.output.raw)
+
+    return stage.task.output
+
+
+def run_pipeline(
+    stages: list[Stage],
+    inputs: Dict,
+    step_callback: Callable | None = None,
+    max_workers: int = 4,
+    completed: dict[str, str] | None = None,
+    on_stage_done: Callable[[str, TaskOutput], None] | None = None,
+) -> dict[str, TaskOutput]:
+    """Run the stages as a dependency graph and return their outputs by name.
+
+    A stage starts as soon as all the stages it depends on are done, so independent
+    branches of the graph run concurrently.
+
+    If the current run is cancelled (see `crew.cancellation`), `RunCancelled` is
+    raised without waiting for the running stages.
+
+    Args:
+        completed : Raw outputs of stages already completed by a previous run, by stage name. These stages are not run again.
+        on_stage_done : Called with the name and output of each stage once it is done.
+    """
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise ValueError("Stage names must be unique.")
+
+    for stage in stages:
+        unknown = set(stage.depends_on) - set(names)
+        if unknown:
+            raise ValueError(
+                f"Stage '{stage.name}' depends on unknown stages: {', '.join(unknown)}"
+            )
+
+    pending = {stage.name: stage for stage in stages}
+    outputs: dict[str, TaskOutput] = {}
+    running: dict[Future, str] = {}
+
+    for name, raw in (completed or {}).items():
+        if name not in pending:
+            continue
+        stage = pending.pop(name)
+        _set_output(stage.task, raw)
+        outputs[name] = stage.task.output
+
+    error: Exception | None = None
+    token = current_token()
+    interrupted = False
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # After a failure, no new stage is started, but the running ones are
+        # allowed to finish so that their outputs are checkpointed.
+        while running or (pending and error is None):
+            if error is None:
+                for name, stage in list(pending.items()):
+                    if all(dependency in outputs for dependency in stage.depends_on):
+                        # Copy the context so that context variables are visible in the stage
+                        context = contextvars.copy_context()
+                        future = executor.submit(
+                            context.run, _run_stage, stage, inputs, step_callback
+                        )
+                        running[future] = name
+                        del pending[name]
+
+            if not running:
+                raise ValueError(
+                    f"Circular dependencies between stages: {', '.join(pending)}"
+                )
+
+            finished, _ = wait(
+                running,
+                timeout=CANCELLATION_POLL_INTERVAL if token is not None else None,
+                return_when=FIRST_COMPLETED,
+            )
+            if token is not None and token.cancelled and not finished:
+                # The stages stuck in a call will stop at their next check
+                token.check()
+
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    outputs[name] = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+
+                if on_stage_done:
+                    on_stage_done(name, outputs[name])
+    except BaseException:
+        # Interrupted (e.g. Ctrl+C): the running stages stop at their next check
+        interrupted = True
+        if token is not None:
+            token.cancel()
+        raise
+    finally:
+        # The stages of a cancelled run that are stuck in a call aren't waited for
+        executor.shutdown(
+            wait=not interrupted and (token is None or not token.cancelled),
+            cancel_futures=True,
+        )
+
+    if error is not None:
+        raise error
+
+    return outputs
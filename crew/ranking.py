@@ -0,0 +1,140 @@
+"""Ranking of the StackOverflow search results, before they reach the search agent.
+
+The questions found by Serper are enriched with their StackExchange metadata
+(fetched in a single request), the duplicated, closed, unanswered and obsolete
+ones are dropped, and the others are ranked by a local score.
+"""
+
+import logging
+import math
+import re
+import time
+from dataclasses import dataclass
+from json import loads
+
+import requests
+
+from crew.cache import get_question_cache
+from crew.http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+# The StackExchange API accepts at most 100 semicolon-separated IDs per request
+MAX_IDS_PER_REQUEST = 100
+
+# Questions about outdated versions
+OBSOLETE_TAGS = {
+    "python-2.x",
+    "python-2.7",
+    "python-2.6",
+    "angularjs",
+    "jquery-1.x",
+    "java-6",
+    "php-5",
+}
+
+YEAR = 365 * 24 * 60 * 60
+
+
+@dataclass(slots=True)
+class RankedResult:
+    """A Serper result, with the metadata of its question and its ranking score."""
+
+    result: dict
+    question: dict | None
+    score: float
+
+    @property
+    def best_answer_url(self) -> str | None:
+        if self.question and self.question.get("accepted_answer_id"):
+            return f"https://stackoverflow.com/a/{self.question['accepted_answer_id']}"
+        try:
+            return self.result["sitelinks"][0]["link"]
+        except (KeyError, IndexError):
+            return None
+
+
+def parse_question_id(url: str) -> str | None:
+    match = re.search(r"stackoverflow\.com/questions/(\d+)", url or "")
+    return match.group(1) if match else None
+
+
+def fetch_questions(question_ids: list[str], use_cache: bool = True) -> dict[str, dict]:
+    """Get the metadata of questions, from the cache or in as few requests as possible."""
+    cache = get_question_cache() if use_cache else None
+    questions = cache.get_many(question_ids) if cache is not None else {}
+
+    missing = [i for i in question_ids if i not in questions]
+    for start in range(0, len(missing), MAX_IDS_PER_REQUEST):
+        ids = ";".join(missing[start : start + MAX_IDS_PER_REQUEST])
+        url = f"https://api.stackexchange.com/2.3/questions/{ids}?site=stackoverflow&pagesize={MAX_IDS_PER_REQUEST}"
+
+        response = get_http_client().get(url)
+        response.raise_for_status()
+
+        for item in loads(response.text).get("items") or []:
+            questions[str(item["question_id"])] = item
+            if cache is not None:
+                cache.put_question(item)
+
+    return questions
+
+
+def is_relevant(question: dict) -> bool:
+    """Whether the question may lead to a useful answer."""
+    if question.get("closed_date") or question.get("closed_reason"):
+        # Closed as duplicate, off-topic, unclear...
+        return False
+    if not question.get("answer_count"):
+        return False
+    return not OBSOLETE_TAGS.intersection(question.get("tags") or [])
+
+
+def score_question(question: dict | None, position: int) -> float:
+    """Score a search result from its question metadata and its search position.
+
+    Votes and answers are log-scaled so that a few very popular questions don't
+    crowd out the search engine's relevance.
+    """
+    score = -0.5 * position
+    if question is None:
+        return score
+
+    score += 2 * math.log1p(max(question.get("score", 0), 0))
+    score += math.log1p(question.get("answer_count", 0))
+    if question.get("accepted_answer_id"):
+        score += 3
+    if time.time() - question.get("last_activity_date", 0) < 3 * YEAR:
+        score += 1
+    return score
+
+
+def rank_results(
+    results: list[dict], top_k: int = 5, use_cache: bool = True
+) -> list[RankedResult]:
+    """Rank the organic Serper results of a StackOverflow search, and return the `top_k` best."""
+    by_question: dict[str, tuple[int, dict]] = {}
+    for position, result in enumerate(results):
+        question_id = parse_question_id(result.get("link", ""))
+        # Results aren't questions (tags, users...) or already seen
+        if question_id and question_id not in by_question:
+            by_question[question_id] = (position, result)
+
+    try:
+        questions = fetch_questions(list(by_question), use_cache=use_cache)
+    except requests.RequestException as e:
+        # The search results are still usable without their metadata
+        logger.warning(f"Failed to get the questions metadata: {e}")
+        questions = {}
+
+    ranked = []
+    for question_id, (position, result) in by_question.items():
+        question = questions.get(question_id)
+        if question is not None and not is_relevant(question):
+            continue
+        ranked.append(
+            RankedResult(result, question, score_question(question, position))
+        )
+
+    ranked.sort(key=lambda r: r.score, reverse=True)
+    return ranked[:top_k]
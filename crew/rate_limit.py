@@ -0,0 +1,412 @@
+"""Rate limiting of the LLM calls, shared by all the processes of the host.
+
+Each model has two token buckets, for its requests and its tokens per minute,
+stored in a SQLite file so that the API workers, the generation workers and the
+CLI draw from the same budget. A call waits until both buckets hold enough, so
+the providers' limits are approached steadily instead of being overshot and
+paid back with retries.
+
+The waiting calls are served in order: by priority (interactive generations
+before batch ones, see `priority`), then first come, first served, whatever
+the process they come from.
+
+The tokens of a call are estimated from its prompt when it starts, and the
+difference with the actual usage is settled when it ends. Calls answered by the
+LLM cache are refunded.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Any, Iterator
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import get_buffer_string
+from langchain_core.outputs import LLMResult
+
+from crew import cancellation
+from crew.compaction import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# Waiting calls poll the buckets at least this often, at most this rarely
+MIN_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1.0
+
+# A waiting call not seen for this long is considered gone (e.g. its process died)
+STALE_WAITER_SECONDS = 30
+
+# How often the waiting calls tell they are still there
+SEEN_INTERVAL = 5
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    requests_per_minute: float
+    tokens_per_minute: float
+
+
+# Limits of the lower tiers of the providers, to be set with LLM_RATE_LIMITS to the tier of the account
+DEFAULT_RATE_LIMITS = {
+    "claude-3-5-sonnet-20240620": RateLimit(1000, 80_000),
+    "claude-3-haiku-20240307": RateLimit(1000, 100_000),
+    "gpt-4o": RateLimit(500, 30_000),
+    "gpt-4o-mini": RateLimit(500, 200_000),
+}
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BATCH = 1
+
+
+_current_priority: ContextVar[Priority] = ContextVar(
+    "current_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def priority(value: Priority) -> Iterator[None]:
+    """Set the priority of the LLM calls made in the block."""
+    token = _current_priority.set(value)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+def rate_limits_db_path() -> str:
+    return os.environ.get(
+        "RATE_LIMITS_DB_PATH", os.path.join("data", "rate_limits.sqlite")
+    )
+
+
+def rate_limits() -> dict[str, RateLimit]:
+    """Return the limits by model: the defaults, overridden by LLM_RATE_LIMITS.
+
+    LLM_RATE_LIMITS is a comma-separated list of "model=requests/tokens" per minute,
+    e.g. "gpt-4o=5000/800000,claude-3-5-sonnet-20240620=1000/80000". A limit of 0
+    disables the rate limiting of the model.
+    """
+    limits = dict(DEFAULT_RATE_LIMITS)
+    for item in os.environ.get("LLM_RATE_LIMITS", "").split(","):
+        if not item.strip():
+            continue
+        model, _, values = item.partition("=")
+        requests, _, tokens = values.partition("/")
+        if float(requests or 0) <= 0 or float(tokens or 0) <= 0:
+            limits.pop(model.strip(), None)
+        else:
+            limits[model.strip()] = RateLimit(float(requests), float(tokens))
+    return limits
+
+
+class RateLimiter:
+    """Token buckets of the LLM calls, stored in a SQLite file shared by the processes."""
+
+    def __init__(
+        self, path: str | None = None, limits: dict[str, RateLimit] | None = None
+    ):
+        path = path or rate_limits_db_path()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.limits = limits if limits is not None else rate_limits()
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS buckets (
+                    model TEXT PRIMARY KEY,
+                    requests REAL NOT NULL,
+                    tokens REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS waiters (
+                    id TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    priority INTEGER NOT NULL,
+                    enqueued_at REAL NOT NULL,
+                    seen_at REAL NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _refill(
+        self, conn: sqlite3.Connection, model: str, limit: RateLimit, now: float
+    ) -> tuple[float, float]:
+        """Return the requests and tokens available in the buckets of `model`."""
+        row = conn.execute(
+            "SELECT requests, tokens, updated_at FROM buckets WHERE model = ?",
+            (model,),
+        ).fetchone()
+        if row is None:
+            return limit.requests_per_minute, limit.tokens_per_minute
+
+        requests, tokens, updated_at = row
+        elapsed = max(0.0, now - updated_at)
+        return (
+            min(
+                limit.requests_per_minute,
+                requests + elapsed * limit.requests_per_minute / 60,
+            ),
+            min(
+                limit.tokens_per_minute,
+                tokens + elapsed * limit.tokens_per_minute / 60,
+            ),
+        )
+
+    def _store(
+        self,
+        conn: sqlite3.Connection,
+        model: str,
+        requests: float,
+        tokens: float,
+        now: float,
+    ) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (model, requests, tokens, updated_at) VALUES (?, ?, ?, ?)",
+            (model, requests, tokens, now),
+        )
+
+    def _register(
+        self,
+        conn: sqlite3.Connection,
+        waiter_id: str,
+        model: str,
+        priority: int,
+        enqueued_at: float,
+        now: float,
+    ) -> None:
+        """Add or refresh a waiting call, and forget the calls not seen for long."""
+        conn.execute(
+            "INSERT OR REPLACE INTO waiters (id, model, priority, enqueued_at, seen_at) VALUES (?, ?, ?, ?, ?)",
+            (waiter_id, model, priority, enqueued_at, now),
+        )
+        conn.execute(
+            "DELETE FROM waiters WHERE seen_at < ?", (now - STALE_WAITER_SECONDS,)
+        )
+
+    def _ahead(
+        self,
+        conn: sqlite3.Connection,
+        waiter_id: str,
+        model: str,
+        priority: int,
+        enqueued_at: float,
+    ) -> int:
+        """Return the number of calls waiting for `model` before a waiting call."""
+        return conn.execute(
+            """
+            SELECT COUNT(*) FROM waiters
+            WHERE model = ? AND id != ? AND seen_at >= ?
+                AND (priority < ? OR (priority = ? AND enqueued_at < ?))
+            """,
+            (
+                model,
+                waiter_id,
+                time.time() - STALE_WAITER_SECONDS,
+                priority,
+                priority,
+                enqueued_at,
+            ),
+        ).fetchone()[0]
+
+    def acquire(self, model: str, tokens: float) -> float:
+        """Wait for a request and `tokens` tokens of `model`, and take them.
+
+        Returns the time waited, in seconds. Raises `RunCancelled` if the current
+        run is cancelled while waiting.
+        """
+        limit = self.limits.get(model)
+        if limit is None:
+            return 0.0
+
+        # A call larger than the bucket would wait forever
+        tokens = min(tokens, limit.tokens_per_minute)
+        waiter_id = uuid.uuid4().hex
+        waiter_priority = int(_current_priority.get())
+        start = last_seen = time.time()
+        with self._transaction() as conn:
+            self._register(conn, waiter_id, model, waiter_priority, start, start)
+        try:
+            while True:
+                # The waiters only read until it's their turn, so that they don't
+                # hold each other on the write lock of the database
+                with self._connect() as conn:
+                    now = time.time()
+                    ahead = self._ahead(conn, waiter_id, model, waiter_priority, start)
+                    requests_left, tokens_left = self._refill(conn, model, limit, now)
+
+                if ahead == 0 and requests_left >= 1 and tokens_left >= tokens:
+                    with self._transaction() as conn:
+                        now = time.time()
+                        ahead = self._ahead(
+                            conn, waiter_id, model, waiter_priority, start
+                        )
+                        requests_left, tokens_left = self._refill(
+                            conn, model, limit, now
+                        )
+                        taken = (
+                            ahead == 0 and requests_left >= 1 and tokens_left >= tokens
+                        )
+                        if taken:
+                            self._store(
+                                conn,
+                                model,
+                                requests_left - 1,
+                                tokens_left - tokens,
+                                now,
+                            )
+                            conn.execute(
+                                "DELETE FROM waiters WHERE id = ?", (waiter_id,)
+                            )
+                    if taken:
+                        break
+
+                if now - last_seen >= SEEN_INTERVAL:
+                    with self._transaction() as conn:
+                        self._register(
+                            conn, waiter_id, model, waiter_priority, start, now
+                        )
+                    last_seen = now
+
+                # No call can go before the buckets hold enough for one, whatever
+                # its place in line: the waiters sleep until then
+                delay = max(
+                    (1 - requests_left) * 60 / limit.requests_per_minute,
+                    (tokens - tokens_left) * 60 / limit.tokens_per_minute,
+                    MIN_POLL_INTERVAL,
+                )
+                cancellation.sleep(min(delay, MAX_POLL_INTERVAL))
+        except BaseException:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+            raise
+
+        waited = time.time() - start
+        if waited > 1:
+            logger.info(f"Waited {waited:.1f}s for the rate limit of {model}")
+        return waited
+
+    def settle(self, model: str, requests: float, tokens: float) -> None:
+        """Give back (or take, if negative) requests and tokens to the buckets of `model`."""
+        limit = self.limits.get(model)
+        if limit is None or (requests == 0 and tokens == 0):
+            return
+
+        with self._transaction() as conn:
+            now = time.time()
+            requests_left, tokens_left = self._refill(conn, model, limit, now)
+            # The tokens can go below zero, delaying the next calls
+            self._store(
+                conn,
+                model,
+                min(limit.requests_per_minute, requests_left + requests),
+                min(limit.tokens_per_minute, tokens_left + tokens),
+                now,
+            )
+
+
+class RateLimitCallbackHandler(BaseCallbackHandler):
+    """LangChain callback making the calls of a model wait for its rate limit."""
+
+    # Otherwise LangChain logs the errors (e.g. a cancellation while waiting) and goes on
+    raise_error = True
+
+    def __init__(self, model: str):
+        self.model = model
+        self._estimates: dict[UUID, int] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, prompt: str) -> None:
+        estimate = count_tokens(prompt)
+        get_rate_limiter().acquire(self.model, estimate)
+        with self._lock:
+            self._estimates[run_id] = estimate
+
+    def on_chat_model_start(
+        self, serialized: dict, messages: list, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._start(run_id, "\n".join(get_buffer_string(m) for m in messages))
+
+    def on_llm_start(
+        self, serialized: dict, prompts: list, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self._start(run_id, "\n".join(prompts))
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        with self._lock:
+            estimate = self._estimates.pop(run_id, None)
+        if estimate is None:
+            return
+
+        used = 0
+        cached = False
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                if message is None:
+                    continue
+                if message.response_metadata.get("cached"):
+                    cached = True
+                    continue
+                usage = getattr(message, "usage_metadata", None) or {}
+                used += usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+
+        if cached:
+            # Served by the LLM cache, the provider never saw the call
+            get_rate_limiter().settle(self.model, 1, estimate)
+        elif used:
+            get_rate_limiter().settle(self.model, 0, estimate - used)
+
+    def on_llm_error(
+        self, error: BaseException, *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        with self._lock:
+            self._estimates.pop(run_id, None)
+
+
+_rate_limiter: RateLimiter | None = None
+_rate_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter() -> RateLimiter:
+    """Return the rate limiter shared by the whole process."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
@@ -0,0 +1,72 @@
+"""Objects shared by all the generations of the process.
+
+Tools are stateless between calls (the state of a run, like its metrics or its
+cancellation, is kept in context variables), so a single instance of each can
+serve the concurrent generations. So can the LLM clients and their connection
+pools, which stay warm from one generation to the next, except for their
+callbacks: crewAI adds the token counter of each agent to the callbacks of its
+LLM. Each agent gets its own copy of the client (see `agent_llm`), sharing the
+connection pool.
+
+The agents can't be shared: crewAI interpolates the inputs of the run into them.
+"""
+
+import copy
+import threading
+from typing import TypeVar
+
+from crewai_tools import BaseTool
+from langchain_core.caches import BaseCache
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from crew.ai_models import AIModel
+
+ToolT = TypeVar("ToolT", bound=BaseTool)
+
+_llm_clients: dict[tuple, BaseChatModel] = {}
+_tools: dict[type, BaseTool] = {}
+_lock = threading.Lock()
+
+
+def get_llm_client(
+    model: AIModel,
+    max_tokens: int = 4096,
+    max_retries: int = 6,
+    cache: BaseCache | None = None,
+    streaming: bool = False,
+) -> BaseChatModel:
+    """Return the client of `model` with these options, created on first use (see `AIModel.to_client`)."""
+    key = (model, max_tokens, max_retries, cache, streaming)
+    with _lock:
+        if key not in _llm_clients:
+            _llm_clients[key] = model.to_client(
+                max_tokens=max_tokens,
+                max_retries=max_retries,
+                cache=cache,
+                streaming=streaming,
+            )
+        return _llm_clients[key]
+
+
+def agent_llm(llm: BaseChatModel) -> BaseChatModel:
+    """Return a copy of a shared LLM client for an agent, with its own callbacks list.
+
+    The copy shares the HTTP client, and so the connection pool, of the original.
+    """
+    agent_copy = copy.copy(llm)
+    # The shallow copy of a pydantic v1 model shares its attributes, they are copied too
+    object.__setattr__(
+        agent_copy,
+        "__dict__",
+        {**llm.__dict__, "callbacks": list(llm.callbacks or [])},
+    )
+    object.__setattr__(agent_copy, "__fields_set__", set(llm.__fields_set__))
+    return agent_copy
+
+
+def get_tool(tool_class: type[ToolT]) -> ToolT:
+    """Return the instance of `tool_class` shared by the whole process."""
+    with _lock:
+        if tool_class not in _tools:
+            _tools[tool_class] = tool_class()
+        return _tools[tool_class]  # type: ignore
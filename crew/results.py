@@ -0,0 +1,231 @@
+"""Store of the generated articles, shared by the API workers, the CLI and the app.
+
+Each article is stored with the parameters of its generation and their
+fingerprint (see `crew.crew.generation_fingerprint`), so that it can be looked up by
+topic, language, model or date, and served again to an identical request
+arriving within a freshness window instead of being generated again.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Iterator
+
+# Pages of results are never larger than this
+MAX_LIMIT = 100
+
+
+def results_db_path() -> str:
+    return os.environ.get("RESULTS_DB_PATH", os.path.join("data", "results.sqlite"))
+
+
+def results_max_age() -> float:
+    """Default age (in seconds) under which a stored article is served again, 0 to never serve one."""
+    return float(os.environ.get("RESULTS_MAX_AGE", 24 * 60 * 60))
+
+
+def article_title(article: str) -> str:
+    """The h1 title the articles start with, or their first line."""
+    for line in article.splitlines():
+        if line.strip():
+            return line.strip().lstrip("#").strip()
+    return ""
+
+
+@dataclass
+class StoredArticle:
+    id: str
+    fingerprint: str
+    topic: str
+    language: str
+    context: str
+    model: str
+    title: str
+    article: str
+    created_at: float
+    metrics: dict | None = None
+
+
+class ResultStore:
+    """Generated articles stored in a SQLite file."""
+
+    def __init__(self, path: str | None = None):
+        path = path or results_db_path()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS articles (
+                    id TEXT PRIMARY KEY,
+                    fingerprint TEXT NOT NULL,
+                    topic TEXT NOT NULL,
+                    language TEXT NOT NULL COLLATE NOCASE,
+                    context TEXT NOT NULL,
+                    model TEXT NOT NULL COLLATE NOCASE,
+                    title TEXT NOT NULL,
+                    article TEXT NOT NULL,
+                    metrics TEXT,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            for column in ("fingerprint", "topic", "language", "model"):
+                conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS articles_{column} ON articles ({column}, created_at)"
+                )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS articles_created_at ON articles (created_at)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _row_to_article(self, row) -> StoredArticle:
+        return StoredArticle(
+            id=row[0],
+            fingerprint=row[1],
+            topic=row[2],
+            language=row[3],
+            context=row[4],
+            model=row[5],
+            title=row[6],
+            article=row[7],
+            metrics=json.loads(row[8]) if row[8] else None,
+            created_at=row[9],
+        )
+
+    def add(
+        self,
+        fingerprint: str,
+        topic: str,
+        language: str,
+        context: str,
+        model: str,
+        article: str,
+        metrics: dict | None = None,
+    ) -> str:
+        """Store a generated article and return its ID."""
+        article_id = uuid.uuid4().hex
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO articles (id, fingerprint, topic, language, context, model, title, article, metrics, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    article_id,
+                    fingerprint,
+                    topic,
+                    language or "",
+                    context or "",
+                    model,
+                    article_title(article),
+                    article,
+                    json.dumps(metrics) if metrics is not None else None,
+                    time.time(),
+                ),
+            )
+        return article_id
+
+    def get(self, article_id: str) -> StoredArticle | None:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id, fingerprint, topic, language, context, model, title, article, metrics, created_at FROM articles WHERE id = ?",
+                (article_id,),
+            ).fetchone()
+        return self._row_to_article(row) if row else None
+
+    def latest(self, fingerprint: str, max_age: float) -> StoredArticle | None:
+        """Return the latest article of a request fingerprint, if generated less than `max_age` seconds ago."""
+        with self._connect() as conn:
+            row = conn.execute(
+                """
+                SELECT id, fingerprint, topic, language, context, model, title, article, metrics, created_at
+                FROM articles
+                WHERE fingerprint = ? AND created_at >= ?
+                ORDER BY created_at DESC
+                LIMIT 1
+                """,
+                (fingerprint, time.time() - max_age),
+            ).fetchone()
+        return self._row_to_article(row) if row else None
+
+    def search(
+        self,
+        topic: str | None = None,
+        language: str | None = None,
+        model: str | None = None,
+        fingerprint: str | None = None,
+        since: float | None = None,
+        until: float | None = None,
+        offset: int = 0,
+        limit: int = 20,
+    ) -> list[StoredArticle]:
+        """Return the articles matching all the given filters, the latest first.
+
+        `topic` matches the topics containing it, ignoring case. `language` and
+        `model` match exactly, ignoring case. `since` and `until` are Unix timestamps.
+        """
+        conditions = []
+        parameters: list = []
+        if topic:
+            conditions.append("topic LIKE ? ESCAPE '\\'")
+            escaped = (
+                topic.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            )
+            parameters.append(f"%{escaped}%")
+        if language:
+            conditions.append("language = ?")
+            parameters.append(language)
+        if model:
+            conditions.append("model = ?")
+            parameters.append(model)
+        if fingerprint:
+            conditions.append("fingerprint = ?")
+            parameters.append(fingerprint)
+        if since is not None:
+            conditions.append("created_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("created_at < ?")
+            parameters.append(until)
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT id, fingerprint, topic, language, context, model, title, article, metrics, created_at
+                FROM articles {where}
+                ORDER BY created_at DESC
+                LIMIT ? OFFSET ?
+                """,
+                (*parameters, min(limit, MAX_LIMIT), offset),
+            ).fetchall()
+        return [self._row_to_article(row) for row in rows]
+
+
+_result_store: ResultStore | None = None
+_result_store_lock = threading.Lock()
+
+
+def get_result_store() -> ResultStore:
+    """Return the result store shared by the whole process."""
+    global _result_store
+    with _result_store_lock:
+        if _result_store is None:
+            _result_store = ResultStore()
+        return _result_store
@@ -0,0 +1,131 @@
+"""Routing of the stages of the generation to the AI models.
+
+The stages that select, extract or check things (the StackOverflow search and
+report, the reliable sources, the evaluation, the internal links) run on the fast
+model of the provider of the main model, which is kept for the writing and the
+revision of the article. The routes can be overridden per stage.
+
+The output of each stage is validated (see `validate_output`): a stage that fails
+its validation is run again once with the main model, on which the writing and
+the revision already run (see `crew.pipeline.Stage`).
+"""
+
+import re
+
+from langchain_core.caches import BaseCache
+from langchain_core.language_models.chat_models import BaseChatModel
+
+from crew.ai_models import AIModel
+from crew.registry import get_llm_client
+
+STAGES = (
+    "search",
+    "report",
+    "reliable_sources",
+    "write",
+    "evaluation",
+    "revision",
+    "internal_linking",
+)
+
+# Fast model of each provider, so that a generation keeps using the API keys of a single provider
+FAST_MODELS = {
+    "anthropic": AIModel.CLAUDE_3_HAIKU,
+    "openai": AIModel.GPT_4O_MINI,
+}
+
+# Stages run on the fast model by default
+FAST_STAGES = ("search", "report", "reliable_sources", "evaluation", "internal_linking")
+
+# Shorter outputs are the sign of a model that gave up, or answered something else
+MIN_OUTPUT_LENGTHS = {
+    "report": 500,
+    "evaluation": 200,
+    "write": 1000,
+    "revision": 1000,
+}
+
+# The linked article is the revised one with a few links added: it can't be much shorter
+MIN_LINKED_ARTICLE_RATIO = 0.8
+
+STACKOVERFLOW_URL = re.compile(r"stackoverflow\.com/(a|questions)/\d+")
+
+
+def route_models(
+    model: AIModel, overrides: dict[str, AIModel] | None = None
+) -> dict[str, AIModel]:
+    """Return the model of each stage, for a generation with `model` as main model.
+
+    Args:
+        overrides : Models of some stages, by stage name, replacing the default routes.
+    """
+    unknown = set(overrides or {}) - set(STAGES)
+    if unknown:
+        raise ValueError(
+            f"Unknown stages: {', '.join(sorted(unknown))}. Stages are: {', '.join(STAGES)}"
+        )
+
+    routes = {
+        stage: FAST_MODELS[model.provider] if stage in FAST_STAGES else model
+        for stage in STAGES
+    }
+    routes.update(overrides or {})
+    return routes
+
+
+def parse_stage_models(values: list[str]) -> dict[str, AIModel]:
+    """Parse "stage=model" values, e.g. from the command line."""
+    routes = {}
+    for value in values:
+        stage, _, model = value.partition("=")
+        try:
+            routes[stage.strip()] = AIModel(model.strip())
+        except ValueError:
+            raise ValueError(
+                f"Invalid model for stage '{stage}': '{model}'. One of: {', '.join(m.value for m in AIModel)}"
+            )
+    return routes
+
+
+def get_stage_llm_clients(
+    model: AIModel,
+    overrides: dict[str, AIModel] | None = None,
+    cache: BaseCache | None = None,
+    streaming: bool = False,
+) -> dict[str, BaseChatModel]:
+    """Return the LLM client of each stage (see `route_models`), as expected by `generate_article`."""
+    return {
+        stage: get_llm_client(stage_model, cache=cache, streaming=streaming)
+        for stage, stage_model in route_models(model, overrides).items()
+    }
+
+
+def validate_output(stage: str, output: str, article: str | None = None) -> str | None:
+    """Return why the output of a stage is invalid, or None if it looks right.
+
+    Args:
+        article : For the "internal_linking" stage, the article the links were added to.
+    """
+    output = output.strip()
+    if not output:
+        return "The output is empty."
+
+    if stage == "search" and not STACKOVERFLOW_URL.search(output):
+        return "No StackOverflow answer URL in the output."
+
+    if len(output) < MIN_OUTPUT_LENGTHS.get(stage, 0):
+        return f"The output is too short ({len(output)} characters)."
+
+    if stage in ("write", "revision", "internal_linking") and not output.startswith(
+        "# "
+    ):
+        return "The article doesn't start with a h1 title."
+
+    if (
+        stage == "internal_linking"
+        and article is not None
+        and len(output) < MIN_LINKED_ARTICLE_RATIO * len(article.strip())
+    ):
+        return f"The article with links is much shorter than the article ({len(output)} vs {len(article.strip())} characters)."
+
+    return None
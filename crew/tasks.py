@@ -3,6 +3,18 @@ from crewai import Task
 from textwrap import dedent
 
 
+def format_articles_list(articles: List[dict]) -> str:
+    """Format the existing articles for the `articles_list` input of the linking task."""
+
+    def format_one_article(article):
+        markdown_link = f"[**{article['title']}**]({article['url']})"
+        summary = f" - {article['summary']}" if "summary" in article else ""
+
+        return f"- {markdown_link}{summary}"
+
+    return "\n".join(map(format_one_article, articles))
+
+
 class CustomTasks:
     def search_stackoverflow_task(self, agent):
         """Task to search for Stack Overflow posts related to a topic."""
@@ -21,12 +33,13 @@ class CustomTasks:
             agent=agent,
         )
 
-    def generate_stackoverflow_technical_report(self, agent):
+    def generate_stackoverflow_technical_report(self, agent, context_tasks: List[Task]):
         """Task to create a detailed technical report from Stack Overflow answers."""
         return Task(
             description=dedent(
                 """
-                Read the answers from the provided Stack Overflow URLs using the StackOverflowAnswerTool. 
+                Read the answers from the provided Stack Overflow URLs using the GetAnswersFromStackOverflow tool. 
+                Fetch all the answers at once, by giving the complete list of URLs in a single tool call.
                 Create a detailed technical report that focuses on common issues and technical details of the solutions. 
                 Ensure that no user-specific references or mentions of Stack Overflow are included. 
                 The report should be comprehensive and retain all significant information from the answers.
@@ -36,6 +49,7 @@ class CustomTasks:
             ),
             expected_output="A detailed technical report highlighting key problems and solutions from the Stack Overflow answers.",
             agent=agent,
+            context=context_tasks,
         )
 
     def find_reliable_sources_task(self, agent):
@@ -133,25 +147,16 @@ class CustomTasks:
             context=context_tasks,
         )  # TODO find subjects in the generated blog post that would benefit from a clarification. For instance, if the term "microtask" occurs in a blog on a javascript subject, it should be explained in a way that a beginner can understand, or removed and replaced with simpler terms.
 
-    def link_existing_articles_task(self, agent, existing_articles: List[dict]):
-        """Task to add links to existing articles within the new article."""
-
-        assert len(existing_articles) > 0, "At least one existing article is required."
-        assert all(
-            "title" in article and "url" in article for article in existing_articles
-        ), "Each article should have a title and a URL key."
-
-        def format_one_article(article):
-            markdown_link = f"[**{article['title']}**]({article['url']})"
-            summary = f" - {article['summary']}" if "summary" in article else ""
+    def link_existing_articles_task(self, agent, context_tasks: List[Task]):
+        """Task to add links to existing articles within the new article.
 
-            return f"- {markdown_link}{summary}"
-
-        articles_list = "\n".join(map(format_one_article, existing_articles))
+        The articles that can be linked to are given by the `articles_list` input,
+        formatted with `format_articles_list`.
+        """
 
         return Task(
             description=dedent(
-                f"""Review the new article and identify opportunities to add links to existing articles of the blog to enhance its content and provide additional resources for the readers.
+                """Review the new article and identify opportunities to add links to existing articles of the blog to enhance its content and provide additional resources for the readers.
 
             The goal is to add a maximum of 3 highly relevant links within the body of the new article. These links should enhance the content and provide significant additional value to the readers.
             Ensure that the relationship between the new article and the linked articles is clear and contextually relevant. Only add a link if it is highly relevant to the topic being discussed.
@@ -180,6 +185,7 @@ class CustomTasks:
             """
             ),
             agent=agent,
+            context=context_tasks,
             expected_output="A revised article with highly relevant links to existing articles, or the original article if no highly relevant links were found.",
             # TODO : instruct to introduce the link with a sentence that makes sense in the context of the new article.
             # TODO : it once confused our articles with the reliable sources. Add instructions : "Do not mix up the external sources that are already at the end of the article, with our own articles of {blog_base_url}"
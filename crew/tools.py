@@ -1,13 +1,60 @@
 from textwrap import dedent
-from crewai_tools import BaseTool
+from crewai_tools import BaseTool, SerperDevTool
 from pydantic.v1 import BaseModel, Field
-from typing import Type
+from typing import Any, List, Type
+import re
+import time
 import requests
 from json import loads, dumps
-from datetime import datetime
 import os
 
-#TODO : put this in a module and test it
+from crew.answers import Answer
+from crew.cache import get_answer_cache, get_search_cache
+from crew.compaction import fit_to_budget
+from crew.http_client import get_http_client
+from crew.metrics import tracked_tool_run
+from crew.ranking import MAX_IDS_PER_REQUEST, RankedResult, rank_results
+
+# TODO : put this in a module and test it
+
+
+def parse_answer_id(value: str) -> str | None:
+    """Extract the answer ID from an ID or an answer URL.
+
+    Accepts "30810322", "https://stackoverflow.com/a/30810322" and
+    "https://stackoverflow.com/questions/120001/some-title/30810322#30810322".
+    """
+    value = value.strip()
+    if value.isdigit():
+        return value
+
+    match = re.search(r"/a/(\d+)", value) or re.search(r"#(\d+)$", value)
+    return match.group(1) if match else None
+
+
+def serper_search(search_url: str, payload: dict, use_cache: bool = True) -> dict:
+    """Send a search to Serper, or get its results from the search cache."""
+    cache = get_search_cache() if use_cache else None
+    results = cache.get_results(payload) if cache is not None else None
+    if results is not None:
+        return results
+
+    headers = {
+        "X-API-KEY": os.environ["SERPER_API_KEY"],
+        "content-type": "application/json",
+    }
+    # A search has no side effect, it can be sent again
+    response = get_http_client().post(
+        search_url, headers=headers, data=dumps(payload), retry_non_idempotent=True
+    )
+    results = response.json()
+
+    # Errors and empty results are not cached
+    if cache is not None and results.get("organic"):
+        cache.put_results(payload, results)
+
+    return results
+
 
 class SearchStackOverflowToolSchema(BaseModel):
     """Input for SearchStackOverflow tool."""
@@ -22,8 +69,12 @@ class SearchStackOverflowTool(BaseTool):
     )
     args_schema: Type[BaseModel] = SearchStackOverflowToolSchema
     search_url: str = "https://google.serper.dev/search"
+    use_cache: bool = True
+    # Number of results given to the agent, after ranking
+    top_k: int = 5
 
-    def _format_organic_result(self, result: dict) -> str:
+    def _format_result(self, ranked: RankedResult) -> str:
+        # The Serper result:
         #   "title": "Copy the text to the Clipboard without using any input",
         #   "link": "https://stackoverflow.com/questions/63033012/copy-the-text-to-the-clipboard-without-using-any-input",
         #   "snippet": "How to copy text to the clipboard in Javascript? ... How to copy text to clipboard HTML? 1 · Copy text to clipboard without using IDs · Hot ...",
@@ -33,52 +84,106 @@ class SearchStackOverflowTool(BaseTool):
         #       "link": "https://stackoverflow.com/a/63035539" <-- Best answer URL
         #     }
         #   ],
+        # The best answer is the accepted one when the question metadata is known.
 
-        question_title = result.get("title")
-        question_link = result.get("link")
-        snippet = result.get("snippet")
-
-        try:
-            best_answer_url = result.get("sitelinks")[0].get("link")  # type: ignore
-        except Exception:
-            best_answer_url = "No best answer found."
+        result = ranked.result
+        question = ranked.question
 
-        return dedent(
+        text = dedent(
             f"""
-            Question title: {question_title}
-            Question link: {question_link}
-            Snippet: {snippet}
-            Best answer URL: {best_answer_url}
-        """
+            Question title: {result.get("title")}
+            Question link: {result.get("link")}
+            Snippet: {result.get("snippet")}
+            Best answer URL: {ranked.best_answer_url or "No best answer found."}
+            """
         )
 
-    def _run(self, **kwargs) -> str:  # type: ignore
-        query = kwargs.get("query")
-        if not query:
-            return "No query provided."
+        if question is not None:
+            last_activity_days = int(
+                (time.time() - question.get("last_activity_date", 0)) // 86400
+            )
+            text += (
+                f"Question score: {question.get('score', 0)}, "
+                f"answers: {question.get('answer_count', 0)}, "
+                f"last activity {last_activity_days} days ago, "
+                f"tags: {', '.join(question.get('tags') or [])}\n"
+            )
+
+        return text
 
-        if "site:stackoverflow.com" not in query:
+    def search(self, query: str) -> List[RankedResult]:
+        """Search StackOverflow and return the `top_k` best results, best first."""
+        if "site:stackoverflow.com" not in query.lower():
             query += " site:stackoverflow.com"
 
-        payload = dumps({"q": query})
-        headers = {
-            "X-API-KEY": os.environ["SERPER_API_KEY"],
-            "content-type": "application/json",
-        }
-        response = requests.request(
-            "POST", self.search_url, headers=headers, data=payload
+        # `num` is Serper's default, made explicit to share cache entries with SerperSearchTool
+        results = serper_search(
+            self.search_url, {"q": query, "num": 10}, use_cache=self.use_cache
         )
-        results = response.json()
         if "organic" not in results:
             raise NotImplementedError("No organic search results found.")
 
-        results = results["organic"]
+        # Closed, duplicated and unanswered questions are dropped, the best ranked first
+        return rank_results(results["organic"], self.top_k, use_cache=self.use_cache)
+
+    @tracked_tool_run
+    def _run(self, **kwargs) -> str:  # type: ignore
+        query = kwargs.get("query")
+        if not query:
+            return "No query provided."
+
+        ranked = self.search(query)
+        if not ranked:
+            return "No relevant Stack Overflow question found, try another query."
 
-        string = "\n---\n".join(map(self._format_organic_result, results))
+        string = "\n---\n".join(map(self._format_result, ranked))
 
         return f"\nSearch results: {string}\n"
 
 
+class SerperSearchTool(SerperDevTool):
+    """SerperDevTool sending its requests through the shared HTTP client and search cache."""
+
+    use_cache: bool = True
+
+    @tracked_tool_run
+    def _run(self, **kwargs: Any) -> Any:
+        search_query = kwargs.get("search_query") or kwargs.get("query")
+        n_results = kwargs.get("n_results", self.n_results)
+
+        payload: dict[str, Any] = {"q": search_query, "num": n_results}
+        if self.country:
+            payload["gl"] = self.country
+        if self.location:
+            payload["location"] = self.location
+        if self.locale:
+            payload["hl"] = self.locale
+
+        results = serper_search(self.search_url, payload, use_cache=self.use_cache)
+        if "organic" not in results:
+            return results
+
+        # Same format as SerperDevTool
+        string = []
+        for result in results["organic"][: self.n_results]:
+            try:
+                string.append(
+                    "\n".join(
+                        [
+                            f"Title: {result['title']}",
+                            f"Link: {result['link']}",
+                            f"Snippet: {result['snippet']}",
+                            "---",
+                        ]
+                    )
+                )
+            except KeyError:
+                continue
+
+        content = "\n".join(string)
+        return f"\nSearch results: {content}\n"
+
+
 class StackOverflowAnswerToolSchema(BaseModel):
     """Input for GetAnswerFromStackOverflow tool."""
 
@@ -92,25 +197,51 @@ class StackOverflowAnswerTool(
     description: str = "Gets the answer from Stack Overflow for a given answer ID."
     args_schema: Type[BaseModel] = StackOverflowAnswerToolSchema
 
-    def _run(self, **kwargs) -> str:  # type: ignore
-        answer_id = kwargs.get("answer_id")
-        if not answer_id:
-            return "No answer ID provided."
+    use_cache: bool = True
+    # The answers are cleaned up, and cut if they exceed this number of tokens
+    max_output_tokens: int = 6000
 
-        url = f"https://api.stackexchange.com/2.3/answers/{answer_id}?site=stackoverflow&filter=!*Mg4Pjg.VeqYI.wE"
+    def _fetch_answers(self, answer_ids: List[str]) -> dict[str, dict]:
+        """Fetch answers from the StackExchange API, 100 IDs per request at most."""
+        items = {}
+        for i in range(0, len(answer_ids), MAX_IDS_PER_REQUEST):
+            ids = ";".join(answer_ids[i : i + MAX_IDS_PER_REQUEST])
+            url = f"https://api.stackexchange.com/2.3/answers/{ids}?site=stackoverflow&pagesize={MAX_IDS_PER_REQUEST}&filter=!*Mg4Pjg.VeqYI.wE"
 
-        try:
-            response = requests.get(url)
+            response = get_http_client().get(url)
             response.raise_for_status()
-        except requests.RequestException as e:
-            return f"Failed to get answer from Stack Overflow. Error: {e}"
 
-        items = loads(response.text).get("items")
-        if not items:
-            return "No answer found for the provided ID."
+            for item in loads(response.text).get("items") or []:
+                items[str(item["answer_id"])] = item
+
+        return items
+
+    def _get_answers(self, answer_ids: List[str]) -> dict[str, dict]:
+        """Get answers from the cache, and fetch the missing ones in a single batch."""
+        cache = get_answer_cache() if self.use_cache else None
+
+        # Answers are cached raw, so that the "days ago" is computed at read time
+        items = cache.get_many(answer_ids) if cache is not None else {}
 
-        item = items[0]
+        missing = [answer_id for answer_id in answer_ids if answer_id not in items]
+        if missing:
+            fetched = self._fetch_answers(missing)
+            if cache is not None:
+                for item in fetched.values():
+                    cache.put_answer(item)
+            items.update(fetched)
 
+        return items
+
+    def get_answers(self, answer_ids: List[str]) -> List[Answer]:
+        """Return the parsed answers, e.g. to pick their code blocks without an LLM.
+
+        The answers are in the order of `answer_ids`, the ones not found are skipped.
+        """
+        items = self._get_answers(answer_ids)
+        return [Answer.from_item(items[i]) for i in answer_ids if i in items]
+
+    def _format_answer(self, item: dict) -> str:
         # Extract the answer content
         #  "is_accepted":false,
         #  "score":4,
@@ -123,32 +254,75 @@ class StackOverflowAnswerTool(
         #  "link":"https://stackoverflow.com/questions/120001/load-excel-data-sheet-to-oracle-database/123456#123456",
         #  "title":"Load Excel data sheet to Oracle database"
 
-        # Extract the answer content #TODO : extract method
-        answer = item.get("body_markdown")
-        title = item.get("title")
-        link = item.get("link")
-        last_activity_date = item.get("last_activity_date")
+        # The answer is parsed into prose, code blocks and links, see crew.answers
+        return Answer.from_item(item).to_prompt()
+
+    @tracked_tool_run
+    def _run(self, **kwargs) -> str:  # type: ignore
+        answer_id = kwargs.get("answer_id")
+        if not answer_id:
+            return "No answer ID provided."
+
+        answer_id = parse_answer_id(str(answer_id))
+        if not answer_id:
+            return "Invalid answer ID."
 
-        text = ""
+        try:
+            item = self._get_answers([answer_id]).get(answer_id)
+        except requests.RequestException as e:
+            return f"Failed to get answer from Stack Overflow. Error: {e}"
 
-        if title:
-            text += f"Question title: {title}\n"
+        if item is None:
+            return "No answer found for the provided ID."
+
+        return fit_to_budget([self._format_answer(item)], self.max_output_tokens)[0]
 
-        if link:
-            text += f"Answer Link: {link}\n"
 
-        if last_activity_date:
-            # Convert the timestamp to a datetime object
-            last_activity_date = datetime.fromtimestamp(last_activity_date)
-            now = datetime.now()
-            time_diff = now - last_activity_date
+class StackOverflowAnswersToolSchema(BaseModel):
+    """Input for GetAnswersFromStackOverflow tool."""
 
-            text += f"Last Activity: {time_diff.days} days ago\n"
+    answer_ids: List[str] = Field(
+        ...,
+        description="Mandatory list of answer IDs or answer URLs (https://stackoverflow.com/a/<answer_id>).",
+    )
 
-        if answer:
-            text += f"------------------Answer---------------------:\n{answer}\n\n-------------------------------------------------"
 
-        return text
+class StackOverflowAnswersTool(StackOverflowAnswerTool):
+    name: str = "GetAnswersFromStackOverflow"
+    description: str = (
+        "Gets several answers from Stack Overflow at once, given a list of answer IDs or answer URLs. "
+        "Always request all the answers you need in a single call."
+    )
+    args_schema: Type[BaseModel] = StackOverflowAnswersToolSchema
+
+    @tracked_tool_run
+    def _run(self, **kwargs) -> str:  # type: ignore
+        values = kwargs.get("answer_ids")
+        if not values:
+            return "No answer IDs provided."
+
+        if isinstance(values, str):
+            values = re.split(r"[\s,;]+", values)
+
+        answer_ids = list(dict.fromkeys(filter(None, map(parse_answer_id, values))))
+        if not answer_ids:
+            return "No valid answer ID provided."
+
+        try:
+            items = self._get_answers(answer_ids)
+        except requests.RequestException as e:
+            return f"Failed to get answers from Stack Overflow. Error: {e}"
+
+        texts = []
+        for answer_id in answer_ids:
+            item = items.get(answer_id)
+            if item is None:
+                texts.append(f"No answer found for the ID {answer_id}.")
+            else:
+                texts.append(self._format_answer(item))
+
+        # Code blocks repeated across answers are kept once
+        return "\n\n".join(fit_to_budget(texts, self.max_output_tokens))
 
 
 # Test the tools
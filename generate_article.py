@@ -1,12 +1,30 @@
 import argparse
+import csv
+import hashlib
+import json
 import os
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
 from datetime import datetime
 
 from dotenv import load_dotenv
+from langchain_core.caches import BaseCache
 from pathvalidate import sanitize_filename
 
 from crew import generate_article
 from crew.ai_models import AIModel
+from crew.cache import get_llm_cache
+from crew.cancellation import CancelToken
+from crew.catalog import get_article_catalog
+from crew.crew import generation_fingerprint
+from crew.metrics import RunMetrics
+from crew.rate_limit import Priority, priority
+from crew.registry import get_llm_client
+from crew.results import get_result_store
+from crew.routing import STAGES, get_stage_llm_clients, parse_stage_models
 
 
 def get_arguments():
@@ -14,7 +32,7 @@ def get_arguments():
     parser = argparse.ArgumentParser(
         description="Generate and save an article based on a given topic."
     )
-    parser.add_argument("topic", type=str, help="The topic for the article.")
+    parser.add_argument("topic", type=str, nargs="?", help="The topic for the article.")
     parser.add_argument(
         "-L",
         "--language",
@@ -29,9 +47,80 @@ def get_arguments():
         default="",
         help="Additional context to provide to the AI model.",
     )
+    parser.add_argument(
+        "-M",
+        "--model",
+        type=AIModel,
+        default=AIModel.GPT_4O_MINI,
+        choices=list(AIModel),
+        metavar="MODEL",
+        help=f"The AI model to use (default: {AIModel.GPT_4O_MINI.value}). One of: {', '.join(m.value for m in AIModel)}.",
+    )
+    parser.add_argument(
+        "--stage-model",
+        type=str,
+        action="append",
+        default=[],
+        metavar="STAGE=MODEL",
+        help=f"The AI model of a stage, e.g. 'evaluation=gpt-4o'. Can be repeated. By default, the writing and the revision use the main model, and the other stages the fast model of its provider. Stages are: {', '.join(STAGES)}.",
+    )
+    parser.add_argument(
+        "--fast-search",
+        action="store_true",
+        help="Search the StackOverflow answers without the AI model, from queries made from the topic. Faster, best suited to topics in English.",
+    )
+    parser.add_argument(
+        "-B",
+        "--batch",
+        type=str,
+        help="Generate an article for each topic of a JSONL or CSV file, instead of a single topic. "
+        "Each line/row has a 'topic' and optionally a 'language', 'context' and 'model', "
+        "which default to the values of the command-line options.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=2,
+        help="Batch mode: number of articles generated concurrently (default: 2).",
+    )
+    parser.add_argument(
+        "--provider-limit",
+        type=str,
+        action="append",
+        default=[],
+        metavar="PROVIDER=N",
+        help="Batch mode: maximum number of concurrent generations using a provider, e.g. 'anthropic=1'. Can be repeated.",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        metavar="RUN_ID",
+        help="Resume a failed generation from its first incomplete stage. Use the same topic and options.",
+    )
+    parser.add_argument(
+        "--catalog",
+        type=str,
+        metavar="CATALOG_ID",
+        help="Add links to the most relevant articles of this catalog of existing articles (see the API's /catalogs).",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="Stop the generation of an article that takes longer than this. It can then be resumed.",
+    )
+    parser.add_argument(
+        "--llm-cache",
+        action="store_true",
+        help="Reuse the cached responses of the AI model when the exact same prompts were already sent, e.g. to re-run a topic.",
+    )
+
+    args = parser.parse_args()
+    if not args.topic and not args.batch:
+        parser.error("a topic or a --batch file is required")
 
-    # TODO : add ai model choice
-    return parser.parse_args()
+    return args
 
 
 def sanitize_title(title: str, topic: str) -> str:
@@ -44,7 +133,8 @@ def sanitize_title(title: str, topic: str) -> str:
 
 def save_article(article: str, sanitized_title: str) -> str:
     """Save the article to a file and return the file path."""
-    filename = f"{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}_{sanitized_title}.md"
+    # The suffix keeps the articles of the same title generated concurrently apart
+    filename = f"{datetime.now().strftime('%Y_%m_%d_%H_%M_%S')}_{sanitized_title}_{uuid.uuid4().hex[:8]}.md"
     path = os.path.join("posts", filename)
     os.makedirs(os.path.dirname(path), exist_ok=True)
 
@@ -54,30 +144,323 @@ def save_article(article: str, sanitized_title: str) -> str:
     return path
 
 
+def store_article(
+    article: str,
+    topic: str,
+    language: str,
+    context: str,
+    model: AIModel,
+    metrics: RunMetrics,
+    catalog_id: str | None = None,
+    stage_models: dict[str, AIModel] | None = None,
+    fast_search: bool = False,
+    catalog_version: float | None = None,
+) -> str:
+    """Add the article to the store of the generated articles (see `crew.results`) and return its ID.
+
+    The article is identified like those of the API, so that an identical request
+    to the API gets it back. `catalog_version` is the version of the catalog when
+    its articles were read (see `ArticleCatalog.version`).
+    """
+    fingerprint = generation_fingerprint(
+        topic,
+        language,
+        context,
+        model.value,
+        catalog_id=catalog_id,
+        catalog_version=catalog_version,
+        fast_search=fast_search,
+        stage_models={
+            stage: stage_model.value
+            for stage, stage_model in (stage_models or {}).items()
+        },
+    )
+    return get_result_store().add(
+        fingerprint,
+        topic=topic,
+        language=language,
+        context=context,
+        model=model.value,
+        article=article,
+        metrics=metrics.summary(),
+    )
+
+
+@dataclass
+class BatchItem:
+    topic: str
+    language: str
+    context: str
+    model: AIModel
+
+    @property
+    def key(self) -> str:
+        """Identifies the item in the progress file, to resume an interrupted batch."""
+        source = json.dumps([self.topic, self.language, self.context, self.model.value])
+        return hashlib.sha1(source.encode()).hexdigest()
+
+
+def read_batch_file(
+    path: str, default_language: str, default_context: str, default_model: AIModel
+) -> list[BatchItem]:
+    """Read the topics of a JSONL or CSV batch file."""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    items = []
+    for i, row in enumerate(rows, start=1):
+        if not row.get("topic"):
+            raise ValueError(f"{path}: missing topic on entry {i}")
+
+        items.append(
+            BatchItem(
+                topic=row["topic"],
+                language=row.get("language") or default_language,
+                context=row.get("context") or default_context,
+                model=AIModel(row["model"]) if row.get("model") else default_model,
+            )
+        )
+
+    return items
+
+
+def parse_provider_limits(values: list[str]) -> dict[str, int]:
+    limits = {}
+    for value in values:
+        provider, _, limit = value.partition("=")
+        if not limit.isdigit() or int(limit) < 1:
+            raise ValueError(f"Invalid provider limit: {value}")
+        limits[provider.strip().lower()] = int(limit)
+    return limits
+
+
+def run_batch(
+    items: list[BatchItem],
+    progress_path: str,
+    workers: int = 2,
+    provider_limits: dict[str, int] | None = None,
+    llm_cache: BaseCache | None = None,
+    timeout: float | None = None,
+    existing_articles: list[dict] | None = None,
+    stage_models: dict[str, AIModel] | None = None,
+    fast_search: bool = False,
+    catalog_id: str | None = None,
+    catalog_version: float | None = None,
+) -> tuple[int, int]:
+    """Generate and save the articles of a batch, and return the number of successes and failures.
+
+    Every saved article is recorded in the progress file, and the items already
+    recorded there are skipped, so that an interrupted batch can be resumed.
+
+    `catalog_id` is the catalog `existing_articles` come from, if any, and
+    `catalog_version` its version, to identify the articles in the store of the
+    generated articles.
+    """
+    completed = set()
+    if os.path.exists(progress_path):
+        with open(progress_path, encoding="utf-8") as f:
+            completed = {json.loads(line)["key"] for line in f if line.strip()}
+
+    todo = [item for item in items if item.key not in completed]
+    print(f"{len(items) - len(todo)} articles already generated, {len(todo)} to go.")
+
+    provider_limits = provider_limits or {}
+    progress_lock = threading.Lock()
+
+    def generate_one(item: BatchItem, cancel_token: CancelToken) -> str:
+        metrics = RunMetrics()
+        # Interactive generations sharing the rate limits go first
+        with priority(Priority.BATCH):
+            article = generate_article(
+                llm=get_llm_client(item.model, cache=llm_cache),
+                stage_llms=get_stage_llm_clients(
+                    item.model, stage_models, cache=llm_cache
+                ),
+                topic=item.topic,
+                language=item.language,
+                context=item.context,
+                existing_articles=existing_articles,
+                run_id=f"batch-{item.key}",
+                metrics=metrics,
+                cancel_token=cancel_token,
+                fast_search=fast_search,
+            )
+
+        path = save_article(article, sanitize_title(article, item.topic))
+        # The article is saved: the store must never make the item fail
+        try:
+            store_article(
+                article,
+                item.topic,
+                item.language,
+                item.context,
+                item.model,
+                metrics,
+                catalog_id=catalog_id,
+                stage_models=stage_models,
+                fast_search=fast_search,
+                catalog_version=catalog_version,
+            )
+        except Exception as e:
+            print(f"Error storing the article on '{item.topic}': {e}")
+        with progress_lock, open(progress_path, "a", encoding="utf-8") as f:
+            record = {
+                "key": item.key,
+                "topic": item.topic,
+                "path": path,
+                "metrics": metrics.summary(),
+            }
+            f.write(json.dumps(record))
+            f.write("\n")
+        return path
+
+    succeeded = failed = 0
+    pending = list(todo)
+    running: dict[Future, tuple[BatchItem, CancelToken]] = {}
+    running_by_provider: Counter[str] = Counter()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while pending or running:
+            # Items are only submitted once their provider has room, so that the
+            # items of a saturated provider don't hold the workers of the others
+            for item in list(pending):
+                if len(running) >= workers:
+                    break
+                provider = item.model.provider
+                if running_by_provider[provider] >= provider_limits.get(
+                    provider, workers
+                ):
+                    continue
+                pending.remove(item)
+                running_by_provider[provider] += 1
+                cancel_token = CancelToken(timeout)
+                future = executor.submit(generate_one, item, cancel_token)
+                running[future] = (item, cancel_token)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item, _ = running.pop(future)
+                running_by_provider[item.model.provider] -= 1
+                try:
+                    path = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"Error generating article on '{item.topic}': {e}")
+                else:
+                    succeeded += 1
+                    print(f"Article on '{item.topic}' saved to {path}")
+    finally:
+        # On interruption, stop the running articles (they can be resumed)
+        for _, cancel_token in running.values():
+            cancel_token.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    return succeeded, failed
+
+
+def print_metrics(metrics: RunMetrics) -> None:
+    summary = metrics.summary()
+    print(
+        f"Generated in {summary['duration']:.1f}s, "
+        f"{summary['input_tokens']} input tokens, {summary['output_tokens']} output tokens."
+    )
+    for name, stage in summary["stages"].items():
+        print(
+            f"  {name}: {stage['duration']:.1f}s, {stage['llm_calls']} LLM calls, "
+            f"{stage['input_tokens']}/{stage['output_tokens']} tokens"
+        )
+    for name, tool in summary["tools"].items():
+        print(f"  {name}: {tool['calls']} calls, {tool['duration']:.1f}s")
+
+
 def main():
     """Main function to generate and save the article."""
     args = get_arguments()
+    llm_cache = get_llm_cache() if args.llm_cache else None
+    stage_models = parse_stage_models(args.stage_model)
+
+    existing_articles = None
+    catalog_version = None
+    if args.catalog:
+        # Before the articles: a change in between only makes the version older
+        catalog_version = get_article_catalog().version(args.catalog)
+        existing_articles = get_article_catalog().articles(args.catalog)
+        if not existing_articles:
+            print(f"The catalog {args.catalog} is empty or doesn't exist.")
+            return
 
-    llm = AIModel.GPT_4O_MINI.to_client()
+    if args.batch:
+        items = read_batch_file(args.batch, args.language, args.context, args.model)
+        try:
+            succeeded, failed = run_batch(
+                items,
+                progress_path=f"{args.batch}.progress.jsonl",
+                workers=args.workers,
+                provider_limits=parse_provider_limits(args.provider_limit),
+                llm_cache=llm_cache,
+                timeout=args.timeout,
+                existing_articles=existing_articles,
+                stage_models=stage_models,
+                fast_search=args.fast_search,
+                catalog_id=args.catalog,
+                catalog_version=catalog_version,
+            )
+            print(f"Batch finished: {succeeded} articles generated, {failed} failed.")
+        except KeyboardInterrupt:
+            print("Operation cancelled by user. Run the same command to resume.")
+        return
+
+    llm = get_llm_client(args.model, cache=llm_cache)
+    stage_llms = get_stage_llm_clients(args.model, stage_models, cache=llm_cache)
+    run_id = args.resume or uuid.uuid4().hex
+    metrics = RunMetrics()
 
     try:
         article = generate_article(
             llm=llm,
+            stage_llms=stage_llms,
             topic=args.topic,
             language=args.language,
             context=args.context,
+            existing_articles=existing_articles,
+            run_id=run_id,
+            metrics=metrics,
+            cancel_token=CancelToken(args.timeout),
+            fast_search=args.fast_search,
         )
         print(article)
 
         title = sanitize_title(article, args.topic)
         path = save_article(article, title)
-
-        print(f"Article saved to {path}")
+        # The article is saved: the store must never make the run fail
+        try:
+            article_id = store_article(
+                article,
+                args.topic,
+                args.language,
+                args.context,
+                args.model,
+                metrics,
+                catalog_id=args.catalog,
+                stage_models=stage_models,
+                fast_search=args.fast_search,
+                catalog_version=catalog_version,
+            )
+            print(f"Article saved to {path} (stored as {article_id})")
+        except Exception as e:
+            print(f"Article saved to {path} but not stored: {e}")
+        print_metrics(metrics)
 
     except KeyboardInterrupt:
         print("Operation cancelled by user.")
+        print(f"Add --resume {run_id} to the same command to resume it.")
     except Exception as e:
         print(f"Error generating article: {e}")
+        print(f"Add --resume {run_id} to the same command to resume it.")
+
 
 if __name__ == "__main__":
     load_dotenv()
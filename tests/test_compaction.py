@@ -0,0 +1,59 @@
+from crewai import Task
+from crewai.tasks.task_output import TaskOutput
+
+from crew.compaction import compact_context, count_tokens
+from crew.crew import CONTEXT_BUDGETS
+
+
+def make_task(raw: str) -> Task:
+    task = Task(description="Task", expected_output="Output")
+    task.output = TaskOutput(description="Task", raw=raw, agent="Agent")
+    return task
+
+
+def make_article(tokens: int) -> str:
+    """A markdown article of about `tokens` tokens."""
+    paragraphs = ["# How to use asyncio.gather"]
+    i = 0
+    while count_tokens("\n\n".join(paragraphs)) < tokens:
+        i += 1
+        paragraphs.append(f"## Section {i}")
+        paragraphs.append(
+            f"Paragraph {i} explains how the coroutines given to gather run "
+            "concurrently, and how their results are returned in order."
+        )
+    return "\n\n".join(paragraphs)
+
+
+def test_article_of_max_output_length_is_not_cut():
+    # The largest article the revision can output
+    article = make_task(make_article(4096))
+    sources = make_task(make_article(3000).replace("# ", "Source: "))
+    evaluation = make_task(make_article(3000).replace("# ", "Evaluation: "))
+
+    context = compact_context(
+        [sources, article, evaluation], CONTEXT_BUDGETS["revision"], keep=[article]
+    )
+
+    assert context[1].output.raw == article.output.raw
+    assert "tokens omitted" in context[0].output.raw
+    assert "tokens omitted" in context[2].output.raw
+
+
+def test_kept_output_larger_than_the_budget_is_not_cut():
+    article = make_task(make_article(4096))
+
+    context = compact_context([article], 1000, keep=[article])
+
+    assert context[0].output.raw == article.output.raw
+
+
+def test_context_fitting_the_budget_is_unchanged():
+    tasks = [make_task("Short output."), make_task("Another short output.")]
+
+    assert compact_context(tasks, 1000) == tasks
+
+
+def test_linking_stage_has_no_budget():
+    # The linking stage is only given the article, which must reach it whole
+    assert "internal_linking" not in CONTEXT_BUDGETS